@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Time common git operations before and after GitData.maintain()
+
+Builds a synthetic treenexus-like repository in a temporary directory,
+with every object loose, as the API leaves them, then times history
+walks, path-limited logs, merge-bases, study reads and pages of study
+history, runs maintain(force=True) and times them again.
+
+    python bin/benchmark_maintenance.py [COMMITS [STUDIES]]
+"""
+import os, sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"))
+from gitdata import GitData
+
+def build_repo(repo, commits, studies):
+    "Create a repo where each commit changes one study, with all objects loose"
+    subprocess.check_call(["git", "init", "-q", "-b", "master", repo])
+    importer = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=repo, stdin=subprocess.PIPE)
+    for n in xrange(commits):
+        study_id = n % studies
+        content  = '{"nexml": {"@id": "study%d", "revision": %d, "otus": [%s]}}' % (
+            study_id, n, ",\n".join(['{"@id": "otu%d"}' % i for i in xrange(50)]))
+        message  = "Update Study #%d via OpenTree API" % study_id
+        importer.stdin.write("commit refs/heads/master\n")
+        importer.stdin.write("committer OpenTree API <api@opentreeoflife.org> %d +0000\n" % (1400000000 + n))
+        importer.stdin.write("data %d\n%s\n" % (len(message), message))
+        importer.stdin.write("M 100644 inline study/%d/%d.json\n" % (study_id, study_id))
+        importer.stdin.write("data %d\n%s\n" % (len(content), content))
+    importer.stdin.close()
+    importer.wait()
+    subprocess.check_call(["git", "branch", "johndoe_study_1", "master~%d" % (commits / 2)], cwd=repo)
+
+    # explode the pack fast-import wrote into loose objects
+    pack_dir = os.path.join(repo, ".git", "objects", "pack")
+    for name in os.listdir(pack_dir):
+        if name.endswith(".pack"):
+            pack = os.path.join(pack_dir, name)
+            os.rename(pack, pack + ".old")
+            os.remove(pack[:-len(".pack")] + ".idx")
+            subprocess.check_call(["git", "unpack-objects", "-q"], cwd=repo, stdin=open(pack + ".old"))
+            os.remove(pack + ".old")
+
+def timings(repo, studies):
+    "Return a list of (operation, seconds)"
+    devnull = open(os.devnull, 'w')
+    def timed(name, args, repeat=3):
+        started = time.time()
+        for i in xrange(repeat):
+            subprocess.check_call(args, cwd=repo, stdout=devnull)
+        return (name, (time.time() - started) / repeat)
+
+    results = [
+        timed("rev-list --count master", ["git", "rev-list", "--count", "master"]),
+        timed("log -- study/7/7.json", ["git", "log", "--format=%H", "--", "study/7/7.json"]),
+        timed("merge-base", ["git", "merge-base", "master", "johndoe_study_1"]),
+    ]
+
+    # a cold read of every study, like a new API process
+    gd = GitData(repo=repo)
+    for cache in [ gd.blob_cache, gd.path_cache ]:
+        cache.clear()
+    started = time.time()
+    for study_id in xrange(studies):
+        gd.fetch_study(study_id, "master")
+    results.append(("read %d studies" % studies, time.time() - started))
+
+    # a page of the history of a study, as GET /study/<id>/history does it
+    started = time.time()
+    for study_id in xrange(3):
+        gd.history_cache.clear()
+        gd.study_history(study_id, "master")
+    results.append(("study_history", (time.time() - started) / 3))
+    gd.cat_file.close()
+    gd.cat_file_check.close()
+    return results
+
+def main(argv):
+    commits = int(argv[0]) if argv else 5000
+    studies = int(argv[1]) if len(argv) > 1 else 200
+    repo = tempfile.mkdtemp(prefix="benchmark_maintenance_")
+    try:
+        build_repo(repo, commits, studies)
+        gd = GitData(repo=repo)
+        before = timings(repo, studies)
+        report = gd.maintain(force=True)
+        after  = timings(repo, studies)
+
+        print "%d commits, %d studies" % (commits, studies)
+        print "objects before: %(loose)d loose (%(loose_size)d KiB), %(packs)d packs" % report["before"]
+        print "objects after:  %(loose)d loose, %(packs)d packs (%(pack_size)d KiB)" % report["after"]
+        for task, seconds in sorted(report["tasks"].items()):
+            print "%-28s %8.3fs" % (task, seconds)
+        print
+        print "%-28s %9s %9s %8s" % ("operation", "before", "after", "speedup")
+        for (name, t_before), (_, t_after) in zip(before, after):
+            print "%-28s %8.3fs %8.3fs %7.1fx" % (name, t_before, t_after, t_before / max(t_after, 1e-6))
+    finally:
+        shutil.rmtree(repo)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Set up the treenexus repo of a new API server
+
+    python bin/bootstrap_repo.py [--checkout full|sparse|none] [--history full|lazy] URL REPO_PATH
+
+clones URL in REPO_PATH with a sparse working tree, or with --history
+lazy makes a blobless partial clone, with only the blobs of the tip of
+master (see modules/bootstrap.py for the trade-off), checks that the
+API can read and write it, and reports how long it took and how much
+disk it uses. Then set repo_path in private/config.
+"""
+import os, sys
+import time
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"))
+from bootstrap import clone, validate, disk_usage, CHECKOUTS, HISTORIES
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [--checkout full|sparse|none] [--history full|lazy] URL REPO_PATH")
+    parser.add_option("--checkout", choices=CHECKOUTS, default="sparse",
+        help="what to check out: the whole tree, only the top-level files (default) or nothing")
+    parser.add_option("--history", choices=HISTORIES, default="full",
+        help="clone every version of the studies (default), or only those of master, fetching others when read")
+    parser.add_option("--remote", default="origin", help="the name of the remote [origin]")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("expected URL and REPO_PATH")
+    url, repo = args
+
+    started = time.time()
+    clone(url, repo, checkout=options.checkout, remote=options.remote, history=options.history)
+    print "Cloned %s in %.1fs, using %.1f MB" % (url, time.time() - started, disk_usage(repo) / 1048576.0)
+
+    failed = 0
+    for check, ok, detail in validate(repo):
+        print "%-4s %s: %s" % (ok and "ok" or "FAIL", check, detail)
+        failed += not ok
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Write a snapshot of every study at a commit
+
+    python bin/export_studies.py [--ref REF] [--format tar|ndjson] [--gzip] REPO_PATH > snapshot
+
+reads every study at REF (master by default) from the object database
+of the repo in REPO_PATH, without checking anything out or taking a
+lock (see GitData.export_studies), and writes it to stdout as a tar
+archive of the study directory, or one JSON object per study and line.
+"""
+import os, sys
+import time
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules"))
+from gitdata import GitData
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [--ref REF] [--format tar|ndjson] [--gzip] REPO_PATH > snapshot")
+    parser.add_option("--ref", default="master", help="the branch or commit to export [master]")
+    parser.add_option("--format", choices=GitData.export_formats, default="ndjson",
+        help="a tar archive, or one JSON object per study and line (default)")
+    parser.add_option("--gzip", action="store_true", default=False, help="gzip the snapshot")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected REPO_PATH")
+
+    gd = GitData(repo=args[0])
+    started = time.time()
+    chunks  = gd.export_studies(options.ref, options.format, options.gzip)
+    if chunks is None:
+        sys.stderr.write("%s does not exist\n" % options.ref)
+        return 1
+
+    size = 0
+    for chunk in chunks:
+        sys.stdout.write(chunk)
+        size += len(chunk)
+    sys.stdout.flush()
+    sys.stderr.write("Exported %s in %.1fs, %.1f MB\n" % (options.ref, time.time() - started, size / 1048576.0))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -6,6 +6,15 @@
 
 # Admins can manage deployment keys for treenexus here: https://github.com/OpenTreeOfLife/treenexus/settings/keys
 
+# If SSH_CONTROL_PATH is set (GitData does this, see modules/ssh_master.py),
+# the first connection becomes a master listening on that socket, and later
+# fetches and pushes reuse it instead of doing a new SSH handshake. The master
+# exits after SSH_CONTROL_PERSIST idle seconds.
+if [ -n "$SSH_CONTROL_PATH" ]; then
+    set -- -oControlMaster=auto -oControlPath="$SSH_CONTROL_PATH" \
+        -oControlPersist="${SSH_CONTROL_PERSIST:-300}" -oServerAliveInterval=30 "$@"
+fi
+
 if [ -z "$PKEY" ]; then
     # if PKEY is not specified, run ssh using default keyfile
     ssh "$@"
@@ -13,4 +22,3 @@ else
     # prevent "Are you sure you want to continue connecting?"
     ssh -oStrictHostKeyChecking=no -i "$PKEY" "$@"
 fi
-
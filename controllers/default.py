@@ -49,9 +49,17 @@ def v1():
                                         annotation_label="Open Tree NexSON validation")
         return annotation, validation_log, nexson_obj
 
-    def GET(resource,resource_id,jsoncallback=None,callback=None,_=None,**kwargs):
-        "OpenTree API methods relating to reading"
-        valid_resources = ('study')
+    def GET(resource,resource_id=None,subresource=None,jsoncallback=None,callback=None,_=None,**kwargs):
+        """OpenTree API methods relating to reading
+
+        GET /study/<id> returns a study, GET /study/<id>/branches
+        lists its WIP branches, see GitData.study_branches(),
+        GET /study/<id>/history lists the commits which changed it,
+        see GitData.study_history(), and GET /study/<id>/diff lists the
+        elements which changed between two refs, see
+        GitData.study_diff().
+        """
+        valid_resources = ('study', 'cache', 'push', 'sync', 'export')
 
         if resource not in valid_resources:
             raise HTTP(400, json.dumps({"error": 1,
@@ -61,6 +69,113 @@ def v1():
         if jsoncallback or callback:
             response.view = 'generic.jsonp'
 
+        # hit and miss counters of the study caches in this process
+        if resource == 'cache':
+            return GitData(repo=repo_path).cache_stats()
+
+        # whether a commit made by a write has reached Github yet
+        if resource == 'push':
+            push_status = GitData(repo=repo_path).push_status(resource_id)
+            if push_status is None:
+                raise HTTP(404, json.dumps({"error": 1,
+                    "description": "No push of %s was queued" % resource_id}))
+            return push_status
+
+        # when our branches were last brought up to date with the remote
+        if resource == 'sync':
+            return GitData(repo=repo_path).sync_status()
+
+        # the WIP branches of a study, from the branch index, with an ETag
+        # which changes when any of them or master moves
+        if subresource == 'branches':
+            gd = GitData(repo=repo_path)
+            branches = gd.study_branches(resource_id)
+            response.headers['ETag'] = '"%s"' % hashlib.sha1(" ".join(
+                [ gd.branch_index.sha('master') or '' ] + [ b["sha"] for b in branches ])).hexdigest()
+            if api_utils.etag_matches(request.env.http_if_none_match, response.headers['ETag']):
+                raise HTTP(304, **response.headers)
+            return { "study_id": resource_id, "base_branch": "master", "branches": branches }
+        elif subresource == 'history':
+            try:
+                skip  = int(kwargs.get('skip', 0))
+                limit = int(kwargs.get('limit', 20))
+            except ValueError:
+                raise HTTP(400, json.dumps({"error": 1,
+                    "description": "skip and limit must be numbers"}))
+            if skip < 0 or limit < 1:
+                raise HTTP(400, json.dumps({"error": 1,
+                    "description": "skip must be at least 0 and limit at least 1"}))
+            ref = kwargs.get('sha') or kwargs.get('branch') or 'master'
+            history = GitData(repo=repo_path).study_history(resource_id, ref, skip, limit)
+            if history is None:
+                raise HTTP(404, json.dumps({"error": 1,
+                    "description": "Branch or commit %s does not exist" % ref}))
+
+            # the history up to a commit never changes
+            response.headers['ETag'] = '"%s-%d-%d"' % (history["sha"], skip, limit)
+            if api_utils.etag_matches(request.env.http_if_none_match, response.headers['ETag']):
+                raise HTTP(304, **response.headers)
+            history.update({ "study_id": resource_id, "ref": ref, "skip": skip })
+            return history
+        elif subresource == 'diff':
+            old_ref = kwargs.get('from')
+            new_ref = kwargs.get('to') or 'master'
+            if not old_ref:
+                raise HTTP(400, json.dumps({"error": 1,
+                    "description": "Give the branch or commit to diff from as from"}))
+            gd = GitData(repo=repo_path)
+            for ref in [ old_ref, new_ref ]:
+                if gd.resolve_ref(ref) is None:
+                    raise HTTP(404, json.dumps({"error": 1,
+                        "description": "Branch or commit %s does not exist" % ref}))
+            try:
+                result = gd.study_diff(resource_id, old_ref, new_ref)
+            except ValueError, e:
+                raise HTTP(400, json.dumps({"error": 1,
+                    "description": "Could not parse study #%s: %s" % (resource_id, e)}))
+            if result is None:
+                raise HTTP(404, json.dumps({"error": 1,
+                    "description": "Study #%s does not exist at %s or %s" % (resource_id, old_ref, new_ref)}))
+
+            # the diff of two versions of a study never changes
+            response.headers['ETag'] = '"%s-%s"' % (result["old_sha"], result["new_sha"])
+            if api_utils.etag_matches(request.env.http_if_none_match, response.headers['ETag']):
+                raise HTTP(304, **response.headers)
+            result.update({ "study_id": resource_id, "from": old_ref, "to": new_ref })
+            return result
+        elif subresource is not None:
+            raise HTTP(400, json.dumps({"error": 1,
+                "description": "Unknown study resource %s" % subresource}))
+
+        # a snapshot of every study, see GitData.export_studies()
+        if resource == 'export':
+            ref      = kwargs.get('sha') or kwargs.get('branch') or 'master'
+            format   = kwargs.get('format', 'ndjson')
+            compress = kwargs.get('gzip') in ('1', 'true')
+            gd = GitData(repo=repo_path)
+            if format not in gd.export_formats:
+                raise HTTP(400, json.dumps({"error": 1,
+                    "description": "format must be one of %s" % (gd.export_formats,)}))
+            tip = gd.resolve_ref(ref)
+            if tip is None:
+                raise HTTP(404, json.dumps({"error": 1,
+                    "description": "Branch or commit %s does not exist" % ref}))
+
+            # a snapshot of a commit never changes
+            response.headers['ETag'] = '"%s-%s%s"' % (tip, format, compress and "-gzip" or "")
+            if api_utils.etag_matches(request.env.http_if_none_match, response.headers['ETag']):
+                raise HTTP(304, **response.headers)
+            filename = "studies-%s.%s" % (tip, format == 'tar' and 'tar' or 'ndjson')
+            if compress:
+                filename += ".gz"
+                response.headers['Content-Type'] = 'application/gzip'
+            elif format == 'tar':
+                response.headers['Content-Type'] = 'application/x-tar'
+            else:
+                response.headers['Content-Type'] = 'application/x-ndjson'
+            response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+            raise HTTP(200, gd.export_studies(tip, format, compress), **response.headers)
+
         # fetch using the GitHub API auth-token for a logged-in curator
         auth_token = kwargs.get('auth_token', 'ANONYMOUS')
         if auth_token == 'ANONYMOUS':
@@ -69,10 +184,54 @@ def v1():
             if auth_header:
                 auth_token = auth_header.split()[1]
 
-        # return the correct nexson of study_id, using the specified view
+        # read from the given commit SHA or branch, defaulting to master
+        ref = kwargs.get('sha') or kwargs.get('branch') or 'master'
+
+        # the SHA of the study's blob (or of its directory, if it is sharded)
+        # identifies this exact version of the study, so it is our ETag,
+        # and clients which already have it get a 304
         try:
             gd = GitData(repo=repo_path)
-            study_nexson = gd.fetch_study(resource_id)
+            study_sha = gd.study_sha(resource_id, ref)
+        except Exception, e:
+            return 'ERROR fetching study:\n%s' % e
+
+        # gzipped studies are compressed once and cached by SHA,
+        # but JSONP responses are wrapped by the view, so never gzipped
+        gzipped = bool(study_sha) and response.view == 'generic.json' and \
+            api_utils.accepts_gzip(request.env.http_accept_encoding)
+        response.headers['Vary'] = 'Accept-Encoding'
+
+        if study_sha:
+            if gzipped:
+                response.headers['ETag'] = '"%s-gzip"' % study_sha
+            else:
+                response.headers['ETag'] = '"%s"' % study_sha
+            if api_utils.etag_matches(request.env.http_if_none_match, response.headers['ETag']):
+                raise HTTP(304, **response.headers)
+
+        # big studies are streamed straight from git, compressed on the
+        # way if the client takes gzip, unless the view has to wrap them
+        if study_sha and response.view == 'generic.json':
+            size = gd.study_size(resource_id, study_sha)
+            if size > gd.stream_threshold:
+                response.headers['Content-Type'] = 'application/json'
+                if gzipped:
+                    # the compressed size is only known at the end
+                    response.headers['Content-Encoding'] = 'gzip'
+                    raise HTTP(200, gd.stream_study_sha_gzipped(resource_id, study_sha), **response.headers)
+                response.headers['Content-Length'] = str(size)
+                raise HTTP(200, gd.stream_study_sha(resource_id, study_sha), **response.headers)
+
+        # return the correct nexson of study_id, using the specified view
+        try:
+            if gzipped:
+                study_nexson = gd.read_study_sha_gzipped(resource_id, study_sha)
+                response.headers['Content-Encoding'] = 'gzip'
+            elif study_sha:
+                study_nexson = gd.read_study_sha(resource_id, study_sha)
+            else:
+                study_nexson = ''
             return dict(FULL_RESPONSE=study_nexson)
         except Exception, e:
             return 'ERROR fetching study:\n%s' % e
@@ -84,6 +243,10 @@ def v1():
         if kwargs.get('jsoncallback',None) or kwargs.get('callback',None):
             response.view = 'generic.jsonp'
 
+        # reading many studies at once
+        if resource == 'studies':
+            fetch_studies(**kwargs)
+
         # check for HTTP method override (passed on query string)
         if _method == 'PUT':
             PUT(resource, resource_id, kwargs)
@@ -111,7 +274,7 @@ def v1():
 
         # studies created by the OpenTree API start with o,
         # so they don't conflict with new study id's from other sources
-        new_resource_id = "o%d" % (gd.newest_study_id() + 1)
+        new_resource_id = "o%d" % gd.reserve_study_ids()
 
         unadulterated_content_commit = do_commit(gd, gh, nexson, author_name, author_email, new_resource_id)
         if unadulterated_content_commit['error'] != 0:
@@ -127,6 +290,64 @@ def v1():
         else:
             return unadulterated_content_commit
 
+    def fetch_studies(study_ids=None, ref='master', format='json', **kwargs):
+        """Stream many studies in one response
+
+        study_ids is a list (or a comma-separated string) of study ids,
+        which are all read from the same commit of ref. The response is
+        a JSON array, or one JSON object per line if format is "ndjson".
+        Each element looks like
+
+            {"id": "10", "sha": "<study SHA>", "nexson": {...}}
+
+        A study which can't be read doesn't fail the whole request, its
+        element is an error instead:
+
+            {"id": "10", "error": 1, "description": "..."}
+        """
+        if not study_ids:
+            raise HTTP(400, json.dumps({"error": 1, "description": "study_ids must be given"}))
+        if not isinstance(study_ids, list):
+            study_ids = [ s.strip() for s in study_ids.split(',') if s.strip() ]
+
+        gd = GitData(repo=repo_path)
+
+        def elements():
+            studies = gd.fetch_studies(study_ids, ref)
+            while True:
+                try:
+                    study_id, sha, content = studies.next()
+                except StopIteration:
+                    return
+                except Exception, e:
+                    yield json.dumps({"error": 1, "description": "Could not read studies: %s" % e})
+                    return
+                if content is None:
+                    yield json.dumps({"id": study_id, "error": 1,
+                        "description": "Study #%s does not exist at %s" % (study_id, ref)})
+                else:
+                    # the stored NexSON is already JSON, so it is not re-serialized
+                    yield '{"id": %s, "sha": "%s", "nexson": %s}' % (json.dumps(study_id), sha, content)
+
+        def ndjson():
+            for element in elements():
+                yield element + "\n"
+
+        def json_array():
+            separator = "["
+            for element in elements():
+                yield separator + element
+                separator = ",\n"
+            if separator == "[":
+                yield "["
+            yield "]"
+
+        if format == 'ndjson':
+            response.headers['Content-Type'] = 'application/x-ndjson'
+            raise HTTP(200, ndjson(), **response.headers)
+        response.headers['Content-Type'] = 'application/json'
+        raise HTTP(200, json_array(), **response.headers)
+
     def validate_and_normalize_nexson(**kwargs):
         """A wrapper around __validate() which also sorts JSON keys and checks for invalid JSON"""
         try:
@@ -162,8 +383,14 @@ def v1():
 
         # We compare sha1's instead of the actual data to reduce memory use
         # when comparing large studies
+        # against the curator's WIP branch, or master if there is none yet
+        branch_name = "%s_study_%s" % (gh.get_user().login, resource_id)
+        if gd.branch_exists(branch_name):
+            current_ref = branch_name
+        else:
+            current_ref = "master"
         posted_nexson_sha1 = hashlib.sha1(nexson).hexdigest()
-        nexson_sha1        = hashlib.sha1( gd.fetch_study(resource_id) ).hexdigest()
+        nexson_sha1        = hashlib.sha1( gd.fetch_study(resource_id, current_ref) ).hexdigest()
 
         # the POSTed data is the same as what we currently have, do nothing and return successfully
         if posted_nexson_sha1 == nexson_sha1:
@@ -191,8 +418,9 @@ def v1():
 
         branch_name  = "%s_study_%s" % (gh.get_user().login, resource_id)
 
+        # a write only touches our WIP branch, so only lock that branch
         try:
-            gd.acquire_lock()
+            gd.acquire_branch_locks(branch_name)
         except LockError, e:
             raise HTTP(400, json.dumps({
                 "error": 1,
@@ -200,18 +428,15 @@ def v1():
             }))
 
         try:
-            gd.pull(repo_remote, env=git_env, branch=branch_name)
+            # usually the remote branch is already in ours (we pushed it),
+            # or does not exist yet, and there is nothing to pull
+            if gd.needs_pull(repo_remote, branch_name, env=git_env):
+                gd.pull(repo_remote, env=git_env, branch=branch_name)
         except Exception, e:
             # We can ignore this if the branch doesn't exist yet on the remote,
-            # otherwise raise a 400
-            if "Couldn't find remote ref" not in e.message:
-                gd.release_lock()
-
-                # Attempt to abort a merge, in case of conflicts
-                try:
-                    git.merge("--abort")
-                except:
-                    pass
+            # otherwise raise a 400. A failed merge has already been aborted.
+            if "couldn't find remote ref" not in e.message.lower():
+                gd.release_branch_locks()
 
                 raise HTTP(400, json.dumps({
                     "error": 1,
@@ -221,7 +446,7 @@ def v1():
         try:
             new_sha = gd.write_study(resource_id,file_content,branch_name,author)
         except Exception, e:
-            gd.release_lock()
+            gd.release_branch_locks()
 
             raise HTTP(400, json.dumps({
                 "error": 1,
@@ -229,22 +454,24 @@ def v1():
             }))
 
         try:
-            # actually push the changes to Github
-            gd.push(repo_remote, env=git_env, branch=branch_name)
+            # push the changes to Github in the background
+            gd.queue_push(repo_remote, branch_name, new_sha, env=git_env)
         except Exception, e:
             raise HTTP(400, json.dumps({
                 "error": 1,
                 "description": "Could not push change to study #%s. Details:\n %s" % (resource_id, e.message)
             }))
         finally:
-            gd.release_lock()
+            gd.release_branch_locks()
 
         # What other useful information should be returned on a successful write?
         return {
             "error": 0,
             "branch_name": branch_name,
             "description": "Updated study #%s" % resource_id,
-            "sha":  new_sha
+            "sha":  new_sha,
+            "push_status": "pending",
+            "lock_wait": gd.lock_wait
         }
 
     def DELETE(resource, resource_id=None, **kwargs):
@@ -264,7 +491,7 @@ def v1():
         gd = GitData(repo=repo_path)
 
         try:
-            gd.acquire_lock()
+            gd.acquire_branch_locks(branch_name)
         except LockError, e:
             raise HTTP(400, json.dumps({
                 "error": 1,
@@ -274,7 +501,7 @@ def v1():
         try:
             new_sha = gd.remove_study(resource_id, branch_name, author)
         except Exception, e:
-            gd.release_lock()
+            gd.release_branch_locks()
 
             raise HTTP(400, json.dumps({
                 "error": 1,
@@ -282,21 +509,23 @@ def v1():
             }))
 
         try:
-            # actually push the changes to Github
-            gd.push(repo_remote, env=git_env, branch=branch_name)
+            # push the changes to Github in the background
+            gd.queue_push(repo_remote, branch_name, new_sha, env=git_env)
         except Exception, e:
             raise HTTP(400, json.dumps({
                 "error": 1,
                 "description": "Could not push deletion of study #%s! Details:\n%s" % (resource_id, e.message)
             }))
         finally:
-            gd.release_lock()
+            gd.release_branch_locks()
 
         return {
             "error": 0,
             "branch_name": branch_name,
             "description": "Deleted study #%s" % resource_id,
-            "sha":  new_sha
+            "sha":  new_sha,
+            "push_status": "pending",
+            "lock_wait": gd.lock_wait
         }
 
     def OPTIONS(args, **kwargs):
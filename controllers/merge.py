@@ -11,6 +11,125 @@ def v1():
     "The OpenTree API v1: Merge Controller"
     response.view = 'generic.json'
 
+    def GET(branch,base_branch="master",action=None,jsoncallback=None,callback=None,_=None,**kwargs):
+        """Find out whether a branch can be merged, without merging it
+
+        For example, to see if leto_study_12 can be merged into master:
+
+        curl http://localhost:8000/api/merge/v1/leto_study_12/master/check
+
+        which returns a JSON response similar to this:
+
+        {
+            "branch_sha": "dcab222749c9185797645378d0bda08d598f81e7",
+            "base_sha": "4b0a2e5b4e3c1f5a0b2c6f0b8d1e9a7c3f2d1e0b",
+            "mergeable": true,
+            "already_merged": false,
+            "conflicts": []
+        }
+
+        where conflicts is the same list a failed merge returns. Nothing is
+        locked or changed, and the answer is cached by the SHAs of the two
+        branches, which are also its ETag, so polling this is cheap.
+        """
+        if action != 'check':
+            raise HTTP(400, json.dumps({
+                "error": 1,
+                "description": "Use GET /merge/v1/<branch>/<base_branch>/check"
+            }))
+
+        # support JSONP request from another domain
+        if jsoncallback or callback:
+            response.view = 'generic.jsonp'
+
+        repo_path, repo_remote, git_ssh, pkey = api_utils.read_config(request)
+        gd = GitData(repo=repo_path)
+
+        result = gd.merge_check(branch, base_branch)
+        if result is None:
+            raise HTTP(404, json.dumps({
+                "error": 1,
+                "description": "Cannot check merge of non-existent branch %s or %s" % (branch, base_branch)
+            }))
+
+        response.headers['ETag'] = '"%s-%s"' % (result["base_sha"], result["branch_sha"])
+        if api_utils.etag_matches(request.env.http_if_none_match, response.headers['ETag']):
+            raise HTTP(304, **response.headers)
+        return result
+
+    def merge_bulk(gd, base_branch, branches, on_conflict, repo_remote, git_env):
+        "Merge a list of branches into base_branch, and push them all at once"
+        if isinstance(branches, basestring):
+            branches = [ b.strip() for b in branches.split(",") if b.strip() ]
+        if not branches:
+            raise HTTP(400, json.dumps({
+                "error": 1,
+                "description": "Give the branches to merge as branches"
+            }))
+        if on_conflict not in ('stop', 'skip'):
+            raise HTTP(400, json.dumps({
+                "error": 1,
+                "description": "on_conflict must be stop or skip"
+            }))
+        if base_branch in branches:
+            raise HTTP(400, json.dumps({
+                "error": 1,
+                "description": "Cannot merge %s branch to itself" % base_branch
+            }))
+        if gd.branch_index.sha(base_branch) is None:
+            raise HTTP(400, json.dumps({
+                "error": 1,
+                "description": "Cannot merge into non-existent branch %s" % base_branch
+            }))
+
+        try:
+            gd.acquire_branch_locks(*(list(branches) + [ base_branch ]))
+        except LockError, e:
+            raise HTTP(400, json.dumps({
+                "error": 1,
+                "description": "Could not acquire locks to merge into branch %s" % base_branch
+            }))
+
+        try:
+            new_sha, results = gd.merge_many(branches, base_branch, on_conflict)
+        except Exception, e:
+            gd.release_branch_locks()
+
+            raise HTTP(400, json.dumps({
+                "error": 1,
+                "description": "Could not merge into %s! Details: %s" % (base_branch, e.message)
+            }))
+        merged = [ r["branch"] for r in results if r["status"] in ("merged", "already_merged") ]
+
+        # one push updates base_branch and deletes every merged branch
+        # which is on our remote, all or nothing. Whether it is comes from
+        # remote_refs, which our pushes keep up to date, since deleting a
+        # branch which is not there would fail the whole push.
+        try:
+            refspecs = [ base_branch ] + [ ":%s" % b for b in merged
+                if gd.remote_refs.get(repo_remote, b, git_env) is not None ]
+            if len(refspecs) > 1 or any(r["status"] == "merged" for r in results):
+                gd.push(repo_remote, env=git_env, branch=refspecs, atomic=True)
+        except Exception, e:
+            raise HTTP(400, json.dumps({
+                "error": 1,
+                "description": "Could not push %s branch! Details: \n%s" % (base_branch, e.message)
+            }))
+        finally:
+            gd.release_branch_locks()
+
+        for b in merged:
+            gd.push_queue.discard(b, "pushed", "Pushed as part of %s" % base_branch)
+
+        return {
+            "error": 0,
+            "branch_name": base_branch,
+            "description": "Merged %d of %d branches" % (len(merged), len(results)),
+            "sha": new_sha,
+            "results": results,
+            "lock_wait": gd.lock_wait
+        }
+
     def POST(branch,base_branch="master",jsoncallback=None,callback=None,_=None,**kwargs):
         """OpenTree API methods relating to merging branches
 
@@ -42,6 +161,35 @@ def v1():
             "error": 1,
             "description": "Could not push foo branch"
         }
+
+        To merge many branches into base_branch at once, give them in order,
+        separated by commas, as "branches" with the branch "bulk":
+
+        curl -X POST http://localhost:8000/api/merge/v1/bulk/master?auth_token=$GITHUB_OAUTH_TOKEN \
+            -d branches=leto_study_12,jessica_study_7,paul_study_9 -d on_conflict=skip
+
+        They are merged one after another, and base_branch and the deletions
+        of the merged branches are pushed once, at the end. A branch given more
+        than once is only merged the first time. If a branch conflicts,
+        no more branches are merged with on_conflict=stop (the default), and it is
+        left out with on_conflict=skip. The response has a "results" list with the
+        "branch", "sha" and "status" of each branch: "merged", "already_merged",
+        "conflict" (with "conflicts"), "missing" or "not_attempted".
+
+        If the branches conflict, the response also has a "conflicts" list, with
+        the path of each conflicting file, the blob SHAs of the merge base ("base"),
+        base_branch ("ours") and branch ("theirs"), and what kind of conflict it is:
+
+        {
+            "error": 1,
+            "description": "Could not merge! Details: Merge conflicts in study/12/12.json",
+            "conflicts": [{
+                "path": "study/12/12.json",
+                "base": "6c1fa3d0...", "ours": "93ae8e2b...", "theirs": "0d4f8e0c...",
+                "types": ["CONFLICT (contents)"],
+                "messages": ["CONFLICT (content): Merge conflict in study/12/12.json"]
+            }]
+        }
         """
 
         # support JSONP request from another domain
@@ -55,6 +203,10 @@ def v1():
 
         gd = GitData(repo=repo_path)
 
+        if branch == 'bulk':
+            return merge_bulk(gd, base_branch, kwargs.get('branches'), kwargs.get('on_conflict', 'stop'),
+                repo_remote, git_env)
+
         if branch == base_branch:
             raise HTTP(400, json.dumps({
                 "error": 1,
@@ -62,14 +214,16 @@ def v1():
             }))
 
         for b in [ branch, base_branch ]:
-            if not gd.branch_exists(b):
+            if gd.branch_index.sha(b) is None:
                 raise HTTP(400, json.dumps({
                     "error": 1,
                     "description": "Cannot merge non-existent branch %s" % b
                 }))
 
+        # the merge is done in memory, so it only needs the locks of
+        # the two branches, not the working tree
         try:
-            gd.acquire_lock()
+            gd.acquire_branch_locks(branch, base_branch)
         except LockError, e:
             raise HTTP(400, json.dumps({
                 "error": 1,
@@ -79,42 +233,51 @@ def v1():
         try:
             # do the merge
             new_sha = gd.merge(branch, base_branch)
-        except Exception, e:
-            gd.release_lock()
+        except gitdata.MergeException, e:
+            gd.release_branch_locks()
 
             raise HTTP(400, json.dumps({
                 "error": 1,
-                "description": "Could not merge! Details: %s" % (e.message)
+                "description": "Could not merge! Details: %s" % (e.message),
+                "conflicts": e.conflicts
             }))
-
-        try:
-            # actually push the changes to Github
-            gd.push(repo_remote, env=git_env,branch=base_branch)
         except Exception, e:
-            gd.release_lock()
+            gd.release_branch_locks()
 
             raise HTTP(400, json.dumps({
                 "error": 1,
-                "description": "Could not push %s branch! Details: \n%s" % (base_branch, e.message)
+                "description": "Could not merge! Details: %s" % (e.message)
             }))
 
+        # update base_branch and delete the WIP branch we just merged in on
+        # our remote in one push, which either does both or neither. If the
+        # WIP branch is not on our remote (see remote_refs), there is nothing
+        # to delete, and trying would fail the whole push.
         try:
-            # delete the WIP branch we just merged in on our remote
-            gd.delete_remote_branch(repo_remote, env=git_env, branch=branch)
+            refspecs = [ base_branch ]
+            if gd.remote_refs.get(repo_remote, branch, git_env) is not None:
+                refspecs.append(":%s" % branch)
+
+            # actually push the changes to Github
+            gd.push(repo_remote, env=git_env, branch=refspecs, atomic=True)
         except Exception, e:
             raise HTTP(400, json.dumps({
                 "error": 1,
-                "description": "Could not delete remote branch %s! Details:\n%s" % (branch, e.message)
+                "description": "Could not push %s branch! Details: \n%s" % (base_branch, e.message)
             }))
-
         finally:
-            gd.release_lock()
+            gd.release_branch_locks()
+
+        # the WIP commits reached Github with base_branch, so pushing the
+        # WIP branch now would only recreate the branch we just deleted
+        gd.push_queue.discard(branch, "pushed", "Pushed as part of %s" % base_branch)
 
         return {
             "error": 0,
             "branch_name": base_branch,
             "description": "Merged branch %s" % branch,
-            "sha":  new_sha
+            "sha":  new_sha,
+            "lock_wait": gd.lock_wait
         }
 
     return locals()
@@ -57,7 +57,7 @@ def v1():
         gd = GitData(repo=repo_path)
 
         try:
-            gd.acquire_lock()
+            gd.acquire_branch_locks(branch)
         except LockError, e:
             raise HTTP(400, json.dumps({
                 "error": 1,
@@ -68,26 +68,20 @@ def v1():
             # do the pull
             new_sha = gd.pull(repo_remote, env=git_env, branch=branch)
         except Exception, e:
-            gd.release_lock()
-
-            # Attempt to abort a merge, in case of conflicts
-            try:
-                git.merge("--abort")
-            except:
-                pass
-
+            # a failed merge has already been aborted by GitData.pull
             raise HTTP(409, json.dumps({
                 "error": 1,
                 "description": "Could not pull! Details: %s" % (e.message)
             }))
         finally:
-            gd.release_lock()
+            gd.release_branch_locks()
 
         return {
             "error": 0,
             "branch_name": branch,
             "description": "Updated branch %s" % branch,
-            "sha":  new_sha
+            "sha":  new_sha,
+            "lock_wait": gd.lock_wait
         }
 
     return locals()
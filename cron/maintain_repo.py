@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""Repack the treenexus repo and update its commit-graph
+
+Runs GitData.maintain(), which does nothing while the API is busy
+writing, and prints what it did. It is run every ten minutes by web2py
+cron (see cron/crontab). With --force, it runs even if the repository
+is busy or has few loose objects.
+"""
+import sys
+import json
+from sync_remote import read_config
+from gitdata import GitData
+
+def main(argv):
+    if argv not in ([], ["--force"]):
+        sys.stderr.write("Usage: %s [--force]\n" % sys.argv[0])
+        return 2
+    repo_path, repo_remote, git_env = read_config()
+    report = GitData(repo=repo_path).maintain(force=bool(argv))
+    if "skipped" not in report:
+        print json.dumps(report, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Keep the local treenexus repo in sync with its remote
+
+Runs GitData.sync() once, which fetches every branch of repo_remote
+and fast-forwards the local branches which are behind, so API
+requests rarely have to pull. It is run every minute by web2py cron
+(see cron/crontab). To run it as a daemon instead:
+
+    python cron/sync_remote.py --every 30
+
+The config is read from private/localconfig or private/config, like
+the API does. If another sync is still running, this one does nothing.
+"""
+import os, sys
+import time
+import locket
+from locket import LockError
+from ConfigParser import SafeConfigParser
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(app_dir, "modules"))
+from gitdata import GitData
+
+def read_config():
+    conf = SafeConfigParser(allow_no_value=True)
+    if os.path.isfile("%s/private/localconfig" % app_dir):
+        conf.read("%s/private/localconfig" % app_dir)
+    else:
+        conf.read("%s/private/config" % app_dir)
+
+    repo_path   = conf.get("apis", "repo_path")
+    repo_remote = conf.get("apis", "repo_remote")
+    git_env     = {"GIT_SSH": conf.get("apis", "git_ssh"), "PKEY": conf.get("apis", "pkey")}
+    return repo_path, repo_remote, git_env
+
+def sync_once(gd, remote, env):
+    "Sync remote, returning its sync status, or None if another sync is running"
+    lock = locket.lock_file("%s/.git/API_SYNC.lock" % gd.repo, timeout=0)
+    try:
+        lock.acquire()
+    except LockError:
+        return None
+    try:
+        return gd.sync(remote, env)
+    finally:
+        lock.release()
+
+def main(argv):
+    repo_path, repo_remote, git_env = read_config()
+    gd = GitData(repo=repo_path)
+
+    if len(argv) == 2 and argv[0] == "--every":
+        interval = float(argv[1])
+    elif not argv:
+        interval = None
+    else:
+        sys.stderr.write("Usage: %s [--every SECONDS]\n" % sys.argv[0])
+        return 2
+
+    while True:
+        try:
+            status = sync_once(gd, repo_remote, git_env)
+            if status and status["updated"]:
+                print "Fast-forwarded %s" % ", ".join(status["updated"])
+        except Exception, e:
+            sys.stderr.write("Could not sync with %s: %s\n" % (repo_remote, e))
+            if interval is None:
+                return 1
+        if interval is None:
+            return 0
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -24,6 +24,39 @@ def read_config(request):
 
     return repo_path, repo_remote, git_ssh, pkey
 
+def etag_matches(if_none_match, etag):
+    """Returns true if an If-None-Match header value matches etag
+
+    The header can be "*" or a comma-separated list of (possibly
+    weak) entity tags. For If-None-Match, weak tags match too.
+    """
+    if not if_none_match:
+        return False
+    tags = [ tag.strip() for tag in if_none_match.split(",") ]
+    tags = [ tag[2:] if tag.startswith("W/") else tag for tag in tags ]
+    return "*" in tags or etag in tags
+
+def accepts_gzip(accept_encoding):
+    """Returns true if an Accept-Encoding header value allows gzip
+
+    gzip is acceptable if it, or "*", is listed without q=0.
+    """
+    if not accept_encoding:
+        return False
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        params = coding.strip().split(";")
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[params[0].strip().lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
 def authenticate(**kwargs):
     """Verify that we received a valid Github authentication token
 
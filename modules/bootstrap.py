@@ -0,0 +1,143 @@
+"""Setting up the repo of a new API server quickly
+
+A full clone of treenexus has every revision of every study, which is
+what clone() makes by default (history="full").
+
+With history="lazy" it makes a blobless partial clone instead: all
+commits and trees, but only the blobs (study files) of the tip of
+master, which are fetched in one go. That is much quicker to make and
+smaller, but any other blob is fetched from the remote the first time
+it is read, which git does by itself, inside the "git cat-file"
+process GitData shares between requests. So every read of an old
+version of a study (?sha=, diffs, history, the merge base of a merge)
+can wait for a round trip to the remote, holding up all other reads
+meanwhile, and the fetch runs without the GIT_SSH and PKEY of the
+API, so only works for a remote readable without them, like an https
+URL. Lazy clones suit mirrors which rarely read old versions.
+
+Reads and writes go through the object database (see GitData), so
+the working tree is sparse: either only the files at the top of the
+repo ("sparse"), or nothing at all ("none").
+
+Example:
+clone("git@github.com:OpenTreeOfLife/treenexus.git", "/srv/treenexus")
+for check, ok, detail in validate("/srv/treenexus"):
+    ...
+
+See also bin/bootstrap_repo.py.
+"""
+import os
+import time
+import subprocess
+from gitdata import GitData, check_git_version
+
+# what is checked out: "full", only the files at the top ("sparse"), or nothing ("none")
+CHECKOUTS = ("full", "sparse", "none")
+# which blobs are cloned: all of them ("full"), or those of branch, fetching others when read ("lazy")
+HISTORIES = ("full", "lazy")
+
+def _git(repo, *args, **kwargs):
+    return subprocess.check_output(("git",) + args, cwd=repo, **kwargs)
+
+def clone(url, repo, checkout="sparse", remote="origin", branch="master", history="full"):
+    "Clone url in repo, with every blob, or with history=\"lazy\" only the blobs of branch"
+    if checkout not in CHECKOUTS:
+        raise ValueError("checkout must be one of %s" % (CHECKOUTS,))
+    if history not in HISTORIES:
+        raise ValueError("history must be one of %s" % (HISTORIES,))
+    check_git_version()
+    if history == "lazy":
+        subprocess.check_call(["git", "clone", "--quiet", "--filter=blob:none", "--no-checkout",
+            "--origin", remote, "--branch", branch, url, repo])
+        prefetch_blobs(repo, remote, branch)
+    else:
+        subprocess.check_call(["git", "clone", "--quiet", "--no-checkout",
+            "--origin", remote, "--branch", branch, url, repo])
+
+    if checkout == "sparse":
+        _git(repo, "sparse-checkout", "set", "--cone")
+    elif checkout == "none":
+        # a pattern matching nothing, so every path is skip-worktree
+        _git(repo, "sparse-checkout", "set", "--no-cone", "!/*")
+    _git(repo, "checkout", "--quiet", branch)
+    GitData(repo=repo).register_merge_driver()
+
+def prefetch_blobs(repo, remote, ref):
+    """Fetch the blobs of the tree of ref which we don't have yet
+
+    They are fetched from remote with a single "git fetch", rather
+    than one at a time when they are first read. Returns how many
+    blobs were fetched.
+    """
+    objects = _git(repo, "rev-list", "--objects", "--no-walk", "--missing=print", ref)
+    missing = [ line[1:] for line in objects.splitlines() if line.startswith("?") ]
+    if missing:
+        process = subprocess.Popen(["git", "fetch", "--quiet", "--no-tags", "--no-write-fetch-head",
+            "--filter=blob:none", "--stdin", remote], cwd=repo, stdin=subprocess.PIPE)
+        process.communicate("\n".join(missing) + "\n")
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, "git fetch --stdin %s" % remote)
+    return len(missing)
+
+def disk_usage(path):
+    "Return the bytes used by the files under path"
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+def validate(repo, branch="master"):
+    """Check that GitData works on repo, returning a list of (check, ok, detail)
+
+    The last study on branch (by the name of its directory, so API
+    studies like "o7" come last) is read, and a commit is made on a
+    scratch branch, which is deleted afterwards.
+    """
+    gd      = GitData(repo=repo)
+    results = []
+
+    def check(name, function):
+        started = time.time()
+        try:
+            detail = function()
+            if detail is None:
+                raise LookupError("not found")
+            results.append((name, True, "%s (%.3fs)" % (detail, time.time() - started)))
+            return detail
+        except Exception, e:
+            results.append((name, False, "%s: %s" % (e.__class__.__name__, e)))
+            return None
+
+    def last_study_id():
+        studies = _git(repo, "ls-tree", "-d", "--name-only", branch, "study/").splitlines()
+        if studies:
+            return studies[-1][len("study/"):]
+        return None
+
+    def read_study():
+        content = gd.fetch_study(study_id, branch)
+        if not content:
+            raise LookupError("study %s is empty" % study_id)
+        return "%d bytes" % len(content)
+
+    check("resolve %s" % branch, lambda: gd.resolve_ref(branch))
+    study_id = check("last study id", last_study_id)
+    if study_id is not None:
+        check("study SHA", lambda: gd.study_sha(study_id, branch))
+        check("read study %s" % study_id, read_study)
+
+    scratch = "api_bootstrap_check_%d" % os.getpid()
+    def commit():
+        return gd.commit_changes(scratch, { "study/bootstrap_check.json": "{}" },
+            "OpenTree API <api@opentreeoflife.org>", "Bootstrap check", base_branch=branch)
+    try:
+        check("commit to a scratch branch", commit)
+    finally:
+        if gd.branch_exists(scratch):
+            _git(repo, "update-ref", "-d", "refs/heads/%s" % scratch)
+
+    return results
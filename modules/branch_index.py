@@ -0,0 +1,143 @@
+import re
+import threading
+from lrucache import LRUCache
+
+# WIP branches are named <curator>_study_<study id>, see controllers/default.py
+_wip_branch_re = re.compile(r"^(.+)_study_([^_/]+)$")
+
+def parse_wip_branch(branch):
+    "Return (curator, study id) of a WIP branch, or None for any other branch"
+    mo = _wip_branch_re.match(branch)
+    if mo:
+        return mo.groups()
+    return None
+
+class BranchIndex(object):
+    """The local branches, and the WIP branches of each study, in memory
+
+    Example:
+    index = BranchIndex(list_branches, stamp, ahead_behind)
+    index.study_branches("12")
+
+    where list_branches() returns a dict mapping every local branch to
+    its SHA (like one "git for-each-ref"), stamp() returns something
+    which changes whenever a branch is created, moved or deleted (like
+    the modification times of the ref files), and
+    ahead_behind(sha, base_sha) returns how many commits sha is ahead
+    and behind base_sha.
+
+    The branches are listed once, and listed again only when the stamp
+    changed, which is how changes made by other processes are noticed.
+    Our own changes are recorded with update() as we make them. How far
+    a branch is ahead and behind the base branch is worked out when it
+    is first asked for, and remembered by the SHAs of both branches.
+    """
+    def __init__(self, list_branches, stamp, ahead_behind, base_branch="master", cache_size=10000):
+        self.list_branches = list_branches
+        self.stamp         = stamp
+        self.ahead_behind  = ahead_behind
+        self.base_branch   = base_branch
+        # (base SHA, branch SHA) -> (ahead, behind)
+        self.counts        = LRUCache(cache_size, sizeof=lambda counts: 1)
+        self.listed_stamp  = None
+        # branch -> SHA
+        self.shas          = None
+        # study id -> { branch: curator }
+        self.studies       = {}
+        self.lock          = threading.Lock()
+
+    def _add(self, branch, sha):
+        self.shas[branch] = sha
+        wip = parse_wip_branch(branch)
+        if wip:
+            curator, study_id = wip
+            self.studies.setdefault(study_id, {})[branch] = curator
+
+    def _remove(self, branch):
+        self.shas.pop(branch, None)
+        wip = parse_wip_branch(branch)
+        if wip:
+            branches = self.studies.get(wip[1], {})
+            branches.pop(branch, None)
+            if not branches:
+                self.studies.pop(wip[1], None)
+
+    def _current(self):
+        "List the branches again if they changed since they were listed, with the lock held"
+        stamp = self.stamp()
+        if self.shas is None or stamp != self.listed_stamp:
+            # take the stamp first, so a change made while we are
+            # listing is picked up next time
+            self.shas    = {}
+            self.studies = {}
+            for branch, sha in self.list_branches().items():
+                self._add(branch, sha)
+            self.listed_stamp = stamp
+
+    def branches(self):
+        "Return a dict of the local branches and their SHAs"
+        with self.lock:
+            self._current()
+            return dict(self.shas)
+
+    def sha(self, branch):
+        "Return the SHA of the tip of branch, or None if it does not exist"
+        with self.lock:
+            self._current()
+            return self.shas.get(branch)
+
+    def study_ids(self):
+        "Return the ids of the studies which have WIP branches"
+        with self.lock:
+            self._current()
+            return self.studies.keys()
+
+    def study_branches(self, study_id):
+        """Return the WIP branches of study_id, sorted by name
+
+        Each is a dict with the keys curator, branch, sha, and ahead
+        and behind, the number of commits it has which the base branch
+        does not have and the other way around (None if there is no
+        base branch).
+        """
+        with self.lock:
+            self._current()
+            base_sha = self.shas.get(self.base_branch)
+            branches = [ (branch, curator, self.shas[branch])
+                for branch, curator in sorted(self.studies.get(study_id, {}).items()) ]
+
+        results = []
+        for branch, curator, sha in branches:
+            counts = self.counts.get((base_sha, sha))
+            if base_sha is None:
+                counts = (None, None)
+            elif counts is None:
+                counts = self.ahead_behind(sha, base_sha)
+                self.counts.put((base_sha, sha), counts)
+            results.append({
+                "curator": curator,
+                "branch":  branch,
+                "sha":     sha,
+                "ahead":   counts[0],
+                "behind":  counts[1],
+            })
+        return results
+
+    def update(self, branch, sha):
+        """Record that branch now points at sha
+
+        A sha of None means that branch was deleted. Nothing is
+        recorded before the branches were first listed, since the
+        listing will include it.
+        """
+        with self.lock:
+            if self.shas is None:
+                return
+            self._remove(branch)
+            if sha is not None:
+                self._add(branch, sha)
+
+    def invalidate(self):
+        "Forget the branches, so they are listed again"
+        with self.lock:
+            self.shas = None
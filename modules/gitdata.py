@@ -4,12 +4,188 @@ import re
 import os, sys
 import locket
 import functools
+import time
+import urllib
+import threading
+import subprocess
+import fnmatch
+import gzip
+import zlib
+import json
+from cStringIO import StringIO
 from locket import LockError
+from lrucache import LRUCache
+from push_queue import PushQueue
+from study_shards import split_study, shard_filename, sort_shards, SHARD_SIZE
+from ssh_master import SSHMaster, CONTROL_PERSIST
+from remote_refs import RemoteRefs
+from branch_index import BranchIndex
+from shared_lock import SharedLock
+from history_index import HistoryIndex
+import nexson_merge
+import nexson_diff
 
-class MergeException(Exception):
+# the oldest git with everything used here: "merge-tree --write-tree"
+# (2.38), "repack --geometric --write-midx" (2.34) and
+# "fetch --no-write-fetch-head" (2.29)
+MIN_GIT_VERSION = (2, 38)
+
+class GitVersionError(Exception):
+    "The installed git is older than MIN_GIT_VERSION"
     pass
 
+def git_version():
+    "Return the version of the installed git as a tuple, like (2, 39, 5)"
+    output = subprocess.check_output(["git", "--version"])
+    mo = re.match(r"git version (\d+(?:\.\d+)*)", output)
+    if not mo:
+        raise GitVersionError("Cannot tell the version of git from %r" % output.strip())
+    return tuple([ int(n) for n in mo.group(1).split(".") ])
+
+def check_git_version(version=None):
+    """Raise a GitVersionError if git (or the given version) is too old
+
+    Returns the version.
+    """
+    if version is None:
+        version = git_version()
+    if version < MIN_GIT_VERSION:
+        raise GitVersionError("git %s or later is needed, but this is git %s" % (
+            ".".join(map(str, MIN_GIT_VERSION)), ".".join(map(str, version))))
+    return version
+
+class MergeException(Exception):
+    """A merge which has conflicts
+
+    conflicts is a list of dicts, one per conflicted path, see
+    GitData.merge_trees().
+    """
+    def __init__(self, message, conflicts=None):
+        Exception.__init__(self, message)
+        self.conflicts = conflicts or []
+
+class CatFile(object):
+    """A long-lived "git cat-file --batch" child process
+
+    Object names (a SHA, or "<ref>:<path>") are written to the
+    stdin of a single git process and the objects are read back
+    from its stdout, so looking up an object does not need a new
+    process or a checkout. A lock serializes requests, since the
+    batch protocol is strictly one question, one answer.
+
+    With check_only, "git cat-file --batch-check" is run instead,
+    which only reports the SHA, type and size of objects.
+
+    The process is started on first use and restarted if it dies.
+    """
+    def __init__(self, repo, check_only=False):
+        self.repo       = repo
+        self.check_only = check_only
+        self.lock       = threading.Lock()
+        self.process    = None
+
+    def _start(self):
+        if self.check_only:
+            mode = "--batch-check"
+        else:
+            mode = "--batch"
+        self.process = subprocess.Popen(["git", "cat-file", mode],
+            cwd=self.repo, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def close(self):
+        "Terminate the child process, if it is running"
+        with self.lock:
+            if self.process:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process = None
+
+    def _request(self, name):
+        if self.process is None or self.process.poll() is not None:
+            self._start()
+        self.process.stdin.write(name + "\n")
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline()
+        if not header:
+            raise IOError("git cat-file exited unexpectedly")
+        fields = header.split()
+        if len(fields) != 3:
+            # "<name> missing" or "<name> ambiguous"
+            return None
+
+        sha, type, size = fields[0], fields[1], int(fields[2])
+        if self.check_only:
+            return sha, type, size
+        content = self.process.stdout.read(size)
+        # every object is followed by a newline
+        self.process.stdout.read(1)
+        return sha, type, content
+
+    def get(self, name):
+        """Return a (sha, type, content) tuple for the object called name
+
+        A check_only CatFile returns the size of the object instead of
+        its content. Returns None if the object does not exist.
+        """
+        if "\n" in name or name != name.strip():
+            raise ValueError("Invalid git object name: %r" % name)
+        with self.lock:
+            try:
+                return self._request(name)
+            except (IOError, ValueError):
+                # the child went away, possibly in the middle of an
+                # object, so start over with a fresh process
+                self.process = None
+                return self._request(name)
+
+# objects shared by every GitData for the same repository in this
+# process, such as the cat-file processes and the caches
+_shared      = {}
+_shared_lock = threading.Lock()
+
+def _shared_for(repo, name, factory):
+    with _shared_lock:
+        if (repo, name) not in _shared:
+            _shared[(repo, name)] = factory()
+        return _shared[(repo, name)]
+
 class GitData(object):
+    # the most bytes of study content cached per repository
+    study_cache_size = 256 * 1024 * 1024
+    # the most bytes of gzipped study content cached per repository
+    gzip_cache_size  = 64 * 1024 * 1024
+    # blobs bigger than this are streamed instead of read into memory
+    stream_threshold = 4 * 1024 * 1024
+    # the size of the chunks in which blobs are streamed
+    stream_chunk_size = 64 * 1024
+    # studies bigger than this are stored in shards of about shard_size
+    shard_threshold  = 50 * 1024 * 1024
+    shard_size       = SHARD_SIZE
+    # the most refs for which study paths are remembered
+    path_cache_refs  = 10000
+    # the most merge checks remembered, see merge_check()
+    merge_check_cache_size = 10000
+    # the most pages of study history remembered, see study_history()
+    history_cache_size = 10000
+    # the most commits in a page of study history
+    history_page_limit = 100
+    # the most study diffs remembered, see study_diff()
+    diff_cache_size  = 1000
+    # the formats of export_studies()
+    export_formats   = ("tar", "ndjson")
+    # the most ahead/behind counts of WIP branches remembered, see study_branches()
+    ahead_behind_cache_size = 10000
+    # seconds an idle shared SSH connection to a remote is kept open
+    ssh_control_persist = CONTROL_PERSIST
+    # seconds a listing of the branches on a remote is trusted
+    remote_refs_ttl  = 30
+    # maintain() repacks when there are more loose objects or packs than this
+    loose_object_limit = 1000
+    pack_limit       = 20
+    # maintain() only runs when no branch was written for this many seconds
+    maintenance_idle = 60
+
     def __init__(self, repo):
         """Create a GitData object to interact with a Git repository
 
@@ -20,13 +196,68 @@ class GitData(object):
         git repository directory, so it can create a
         lockfile in the .git directory.
 
+        Raises a GitVersionError if git is older
+        than MIN_GIT_VERSION.
+
         """
         self.repo = repo
+        # once per process, rather than failing in the middle of a merge
+        _shared_for(None, "git_version", check_git_version)
 
+        # the global lock guards the working tree, branch locks guard refs
         self.lock_file     = "%s/.git/API_WRITE_LOCK" % self.repo
+        self.lock_dir      = "%s/.git/API_WRITE_LOCKS" % self.repo
         self.lock_timeout  = 30
         self.lock          = locket.lock_file(self.lock_file, timeout=self.lock_timeout)
+        self.branch_locks  = []
+        # total seconds spent waiting for locks, so callers can report it
+        self.lock_wait     = 0.0
+
+        # when each remote was last fetched by sync(), one file per remote
+        self.sync_dir           = "%s/.git/API_SYNC" % self.repo
+        # the report of the last maintain()
+        self.maintenance_file   = "%s/.git/API_MAINTENANCE" % self.repo
+        # held shared by writers, and exclusively by maintain()
+        self.maintenance_lock_file = "%s/.git/API_MAINTENANCE.lock" % self.repo
+
+        # the newest study id handed out by reserve_study_ids()
+        self.study_id_file      = "%s/.git/API_STUDY_ID" % self.repo
+        self.study_id_lock_file = "%s/.git/API_STUDY_ID.lock" % self.repo
+
+        self.cat_file       = _shared_for(self.repo, "cat_file", lambda: CatFile(self.repo))
+        self.cat_file_check = _shared_for(self.repo, "cat_file_check", lambda: CatFile(self.repo, check_only=True))
+        # blob SHA -> content
+        self.blob_cache     = _shared_for(self.repo, "blob_cache", lambda: LRUCache(self.study_cache_size))
+        # blob SHA -> gzipped content
+        self.gzip_cache     = _shared_for(self.repo, "gzip_cache", lambda: LRUCache(self.gzip_cache_size))
+        # ref -> { path: (tip SHA of ref, blob SHA) }
+        self.path_cache     = _shared_for(self.repo, "path_cache",
+            lambda: LRUCache(self.path_cache_refs, sizeof=lambda paths: 1))
 
+        repo = self.repo
+        self.push_queue     = _shared_for(self.repo, "push_queue",
+            lambda: PushQueue(repo, lambda remote, env, branch: GitData(repo).push(remote, env, branch),
+                lambda branch: GitData(repo).branch_sha(branch) is not None))
+        # (base SHA, branch SHA) -> result of merge_check()
+        self.merge_check_cache = _shared_for(self.repo, "merge_check_cache",
+            lambda: LRUCache(self.merge_check_cache_size, sizeof=lambda result: 1))
+        # (tip SHA, study id, skip, limit) -> result of study_history()
+        self.history_cache  = _shared_for(self.repo, "history_cache",
+            lambda: LRUCache(self.history_cache_size, sizeof=lambda result: 1))
+        # (old study SHA, new study SHA) -> result of study_diff()
+        self.diff_cache     = _shared_for(self.repo, "diff_cache",
+            lambda: LRUCache(self.diff_cache_size, sizeof=lambda result: 1))
+        # study id -> the commits of master which changed it, see update_history()
+        self.history_index  = _shared_for(self.repo, "history_index",
+            lambda: HistoryIndex("%s/.git/API_HISTORY" % repo))
+        # remote -> { branch: SHA } as of the last ls-remote, fetch or push
+        self.remote_refs    = _shared_for(self.repo, "remote_refs",
+            lambda: RemoteRefs(lambda remote, env: GitData(repo).ls_remote(remote, env), self.remote_refs_ttl))
+        # the local branches, and the WIP branches of each study
+        self.branch_index   = _shared_for(self.repo, "branch_index",
+            lambda: BranchIndex(lambda: GitData(repo)._ref_shas("refs/heads/"), self._refs_stamp,
+                lambda sha, base_sha: GitData(repo).ahead_behind(sha, base_sha),
+                cache_size=self.ahead_behind_cache_size))
 
     def preserve_cwd(function):
         """
@@ -44,14 +275,67 @@ class GitData(object):
                 os.chdir(cwd)
         return decorator
 
+    def _timed_acquire(self, lock):
+        start = time.time()
+        try:
+            lock.acquire()
+        finally:
+            self.lock_wait += time.time() - start
+
     def acquire_lock(self):
-        "Acquire a lock on the git repository"
-        self.lock.acquire()
+        """Acquire the global lock on the git repository
+
+        This is only needed by operations which touch the working
+        tree. When branch locks are needed as well, they must be
+        acquired first.
+        """
+        self._timed_acquire(self.lock)
 
     def release_lock(self):
-        "Release a lock on the git repository"
+        "Release the global lock on the git repository"
         self.lock.release()
 
+    def branch_lock(self, branch, timeout=None):
+        """Return a lock which guards updates to the given branch
+
+        By default, acquiring it gives up after lock_timeout seconds.
+        """
+        try:
+            os.makedirs(self.lock_dir)
+        except OSError:
+            # it already exists
+            pass
+        lock_file = "%s/%s" % (self.lock_dir, urllib.quote(branch, safe=''))
+        if timeout is None:
+            timeout = self.lock_timeout
+        return locket.lock_file(lock_file, timeout=timeout)
+
+    def acquire_branch_locks(self, *branches):
+        """Acquire the locks of the given branches
+
+        The locks are always taken in sorted order, so two callers
+        locking the same branches can't deadlock. If one of them can't
+        be acquired, the ones we already hold are released and the
+        LockError is re-raised.
+
+        The maintenance lock is taken first, shared with the other
+        writers, so maintain() does not run while anything is written.
+        """
+        locks = [ SharedLock(self.maintenance_lock_file, shared=True, timeout=self.lock_timeout) ]
+        locks += [ self.branch_lock(branch) for branch in sorted(set(branches)) ]
+        for lock in locks:
+            try:
+                self._timed_acquire(lock)
+            except LockError:
+                self.release_branch_locks()
+                raise
+            self.branch_locks.append(lock)
+
+    def release_branch_locks(self):
+        "Release all branch locks held by this object"
+        while self.branch_locks:
+            self.branch_locks.pop().release()
+
     @preserve_cwd
     def current_branch(self):
         "Return the current branch name"
@@ -59,44 +343,570 @@ class GitData(object):
         branch_name = git("symbolic-ref", "HEAD")
         return branch_name.replace('refs/heads/','').strip()
 
+    @preserve_cwd
     def newest_study_id(self):
-        "Return the numeric part of the newest study_id"
+        """Return the numeric part of the newest study_id
+
+        This scans the studies on master and the WIP branches in the
+        branch index, so it gets slower as the repository grows. New ids
+        should come from reserve_study_ids(), which only falls back
+        to this scan when its counter is missing.
+        """
         os.chdir(self.repo)
 
-        git.checkout("master")
         dirs = []
         # first we look for studies already in our master branch
-        for f in os.listdir("study/"):
-            if os.path.isdir("study/%s" % f):
-                # ignore alphabetic prefix, o = created by opentree API
-                if f[0].isalpha():
-                    dirs.append(int(f[1:]))
-                else:
-                    dirs.append(int(f))
+        for f in git("ls-tree", "--name-only", "master", "study/"):
+            f = f.strip().replace("study/", "", 1)
+            if not f:
+                continue
+            # ignore alphabetic prefix, o = created by opentree API
+            if f[0].isalpha():
+                dirs.append(int(f[1:]))
+            else:
+                dirs.append(int(f))
 
         # next we must look at local branch names for new studies
-        # without --no-color we get terminal color codes in the branch output
-        branches = git.branch("--no-color")
-        branches = [ b.strip() for b in branches ]
-        for b in branches:
-            mo = re.match(".+_o(\d+)",b)
+        for study_id in self.branch_index.study_ids():
+            mo = re.match("o(\d+)$", study_id)
             if mo:
                 dirs.append(int(mo.group(1)))
 
         dirs.sort()
         return dirs[-1]
 
-    def fetch_study(self, study_id):
+    def reserve_study_ids(self, count=1):
+        """Reserve count new study ids and return the first one
+
+        The newest id handed out is kept in a counter file in the .git
+        directory, which is read and incremented under its own lock,
+        so concurrent callers always get distinct ids. If the counter
+        is missing, it is rebuilt with newest_study_id().
+
+        The ids first, first+1, ..., first+count-1 belong to the caller.
+        """
+        lock = locket.lock_file(self.study_id_lock_file, timeout=self.lock_timeout)
+        self._timed_acquire(lock)
+        try:
+            try:
+                newest = int(open(self.study_id_file).read())
+            except (IOError, ValueError):
+                newest = self.newest_study_id()
+
+            # write a new file and rename it, so a crash can never
+            # leave a truncated counter behind
+            tmp_file = "%s.tmp" % self.study_id_file
+            file = open(tmp_file, 'w')
+            file.write("%d\n" % (newest + count))
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+            os.rename(tmp_file, self.study_id_file)
+        finally:
+            lock.release()
+
+        return newest + 1
+
+    def resolve_ref(self, ref):
+        """Return the SHA of the commit ref points to, or None
+
+        ref can be a branch name or a commit SHA. Full SHAs are
+        checked too, so a SHA which is unknown, or is not a commit
+        (like a tree or a blob), gives None.
+        """
+        obj = self.cat_file_check.get("%s^{commit}" % ref)
+        if obj is None or obj[1] != "commit":
+            return None
+        return obj[0]
+
+    def resolve_path(self, ref, path, type="blob"):
+        """Return the SHA of the object of the given type at path in ref, or None
+
+        The answer is remembered along with the SHA that ref pointed
+        to, so it is only looked up again once ref moves. Checking
+        where ref points is a single round trip to a cat-file process.
+        """
+        tip = self.resolve_ref(ref)
+        if tip is None:
+            return None
+
+        paths = self.path_cache.get(ref)
+        if paths is None:
+            paths = {}
+            self.path_cache.put(ref, paths)
+
+        entry = paths.get(path)
+        if entry and entry[0] == tip:
+            return entry[1]
+
+        obj = self.cat_file_check.get("%s:%s" % (tip, path))
+        if obj is None or obj[1] != type:
+            return None
+        paths[path] = (tip, obj[0])
+        return obj[0]
+
+    def read_blob(self, ref, path):
+        """Return the contents of path at ref, read from the object database
+
+        ref can be a branch name or a commit SHA. Nothing is checked
+        out. If ref or path does not exist, None is returned.
+
+        Contents are cached by blob SHA, see cache_stats().
+        """
+        blob_sha = self.resolve_path(ref, path)
+        if blob_sha is None:
+            return None
+        return self.read_blob_sha(blob_sha)
+
+    def read_blob_sha(self, blob_sha):
+        "Return the contents of the blob with the given SHA, or None"
+        content = self.blob_cache.get(blob_sha)
+        if content is None:
+            obj = self.cat_file.get(blob_sha)
+            if obj is None:
+                return None
+            content = obj[2]
+            self.blob_cache.put(blob_sha, content)
+        return content
+
+    def stream_blob_sha(self, blob_sha):
+        """Generate the contents of the blob with the given SHA in chunks
+
+        If the blob is not cached, it is read from its own "git
+        cat-file blob" process, stream_chunk_size bytes at a time, so
+        memory use does not depend on the size of the blob. Streamed
+        blobs are not added to the cache.
+        """
+        content = self.blob_cache.get(blob_sha)
+        if content is not None:
+            for start in xrange(0, len(content), self.stream_chunk_size):
+                yield content[start:start + self.stream_chunk_size]
+            return
+
+        process = subprocess.Popen(["git", "cat-file", "blob", blob_sha],
+            cwd=self.repo, stdout=subprocess.PIPE)
+        try:
+            while True:
+                chunk = process.stdout.read(self.stream_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    def read_tree_sha(self, tree_sha):
+        """Return a dict mapping the names in the tree with the given SHA to their SHAs
+
+        Returns None if there is no such tree.
+        """
+        entries = self._read_tree_entries(tree_sha)
+        if entries is None:
+            return None
+        return dict([ (name, sha) for name, (mode, sha) in entries.items() ])
+
+    def _read_tree_entries(self, tree_sha):
+        "Return a dict mapping the names in the tree with the given SHA to (mode, SHA), or None"
+        obj = self.cat_file.get(tree_sha)
+        if obj is None or obj[1] != "tree":
+            return None
+
+        # each entry is "<mode> <name>\0" followed by a 20 byte binary SHA
+        entries = {}
+        content = obj[2]
+        start   = 0
+        while start < len(content):
+            nul  = content.index("\0", start)
+            mode, name = content[start:nul].split(" ", 1)
+            entries[name] = (mode, content[nul + 1:nul + 21].encode("hex"))
+            start = nul + 21
+        return entries
+
+    def invalidate_cache(self, ref):
+        """Forget the cached paths of ref, after it was changed
+
+        Every cached path of a ref is checked against the tip of ref
+        anyway, so once it moves they are all stale.
+        """
+        self.path_cache.pop(ref)
+
+    def cache_stats(self):
+        "Return hit and miss counters and sizes of the study caches"
+        return {
+            "blobs": self.blob_cache.stats(),
+            "gzip":  self.gzip_cache.stats(),
+            "paths": self.path_cache.stats(),
+            "merge_checks": self.merge_check_cache.stats(),
+            "history": self.history_cache.stats(),
+            "diffs": self.diff_cache.stats(),
+        }
+
+    def study_sha(self, study_id, ref):
+        """Return the SHA which identifies study_id at ref, or None if it does not exist
+
+        This is the blob SHA of study/N/N.json, or for a sharded study,
+        the tree SHA of study/N, which changes whenever any shard does.
+        It comes from the tree of ref, so no file is hashed.
+        """
+        sha = self.resolve_path(ref, "study/%s/%s.json" % (study_id, study_id))
+        if sha is None:
+            sha = self.resolve_path(ref, "study/%s" % study_id, type="tree")
+            if sha is not None and not self.study_shards(study_id, sha):
+                return None
+        return sha
+
+    def study_shards(self, study_id, sha):
+        """Return the blob SHAs of the shards of study_id, in order
+
+        sha is a SHA returned by study_sha(). For a study which is not
+        sharded, this is a list with just that SHA.
+        """
+        obj = self.cat_file_check.get(sha)
+        if obj is None:
+            return []
+        if obj[1] == "blob":
+            return [ sha ]
+        entries = self.read_tree_sha(sha)
+        return [ entries[name] for name in sort_shards(study_id, entries.keys()) ]
+
+    def study_size(self, study_id, sha):
+        "Return the size in bytes of the study with the given study_sha()"
+        return sum([ self.cat_file_check.get(shard)[2] for shard in self.study_shards(study_id, sha) ])
+
+    def read_study_sha(self, study_id, sha):
+        """Return the contents of the study with the given study_sha()
+
+        A sharded study is put back together from its shards, which
+        are each cached by blob SHA.
+        """
+        return "".join([ self.read_blob_sha(shard) for shard in self.study_shards(study_id, sha) ])
+
+    def stream_study_sha(self, study_id, sha):
+        """Generate the contents of the study with the given study_sha() in chunks
+
+        See stream_blob_sha(). The shards of a sharded study are
+        streamed one after the other.
+        """
+        for shard in self.study_shards(study_id, sha):
+            for chunk in self.stream_blob_sha(shard):
+                yield chunk
+
+    def read_study_sha_gzipped(self, study_id, sha):
+        """Return the gzipped contents of the study with the given study_sha()
+
+        Each version of a study is only compressed once, the result
+        is cached by SHA.
+        """
+        compressed = self.gzip_cache.get(sha)
+        if compressed is None:
+            buf = StringIO()
+            # a fixed mtime makes the output the same every time
+            gz  = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0)
+            for shard in self.study_shards(study_id, sha):
+                gz.write(self.read_blob_sha(shard))
+            gz.close()
+            compressed = buf.getvalue()
+            self.gzip_cache.put(sha, compressed)
+        return compressed
+
+    def stream_study_sha_gzipped(self, study_id, sha):
+        """Generate the gzipped contents of the study with the given study_sha() in chunks
+
+        The study is compressed as it is streamed (see
+        stream_study_sha()), so memory use does not depend on its size.
+        Unless it is already in the gzip cache, nothing is cached.
+        """
+        compressed = self.gzip_cache.get(sha)
+        if compressed is not None:
+            for start in xrange(0, len(compressed), self.stream_chunk_size):
+                yield compressed[start:start + self.stream_chunk_size]
+            return
+        for chunk in self._gzip_chunks(self.stream_study_sha(study_id, sha)):
+            yield chunk
+
+    @preserve_cwd
+    def study_history(self, study_id, ref="master", skip=0, limit=20):
+        """Return a page of the commits which changed study_id, newest first
+
+        Returns a dict with the keys sha (the commit ref points to),
+        commits, a list of dicts with the keys sha, author_name,
+        author_email, date (ISO 8601) and message, and next, the skip
+        of the next page, or None if this is the last one. Returns None
+        if ref does not exist. Merge commits are left out.
+
+        The commits come from the history index (see update_history),
+        and only the commits between the indexed commit and ref are
+        looked up, which usually are few. Without an index, this is
+        "git log -- study/<id>", which uses the Bloom filters of
+        changed paths in the commit-graph but still has to look at
+        every commit. Pages are cached by the commit ref points to.
+        """
+        os.chdir(self.repo)
+        limit = max(1, min(limit, self.history_page_limit))
+        sha   = self.resolve_ref(ref)
+        if sha is None:
+            return None
+
+        key     = (sha, str(study_id), skip, limit)
+        history = self.history_cache.get(key)
+        if history is None:
+            # one more commit than asked for tells us whether there is a next page
+            indexed, studies = self.history_index.current()
+            try:
+                if indexed is None:
+                    raise LookupError("there is no history index")
+                shas, gone = [], set()
+                if sha != indexed:
+                    shas = self._study_commits(study_id, "%s..%s" % (indexed, sha))
+                    # commits of the index which ref does not have, if it is not a descendant
+                    gone = set(self._study_commits(study_id, "%s..%s" % (sha, indexed)))
+                shas += [ commit for commit in studies.get(str(study_id), []) if commit not in gone ]
+                commits = self._log_commits("--no-walk=unsorted", *shas[skip:skip + limit + 1])
+            except (LookupError, sh.ErrorReturnCode):
+                commits = self._log_commits("--full-history", "--no-merges", "--skip=%d" % skip,
+                    "--max-count=%d" % (limit + 1), sha, "--", "study/%s" % study_id)
+            history = {
+                "sha":     sha,
+                "commits": commits[:limit],
+                "next":    skip + limit if len(commits) > limit else None,
+            }
+            self.history_cache.put(key, history)
+        return dict(history)
+
+    def study_diff(self, study_id, old_ref, new_ref):
+        """Return what changed in study_id between old_ref and new_ref
+
+        The result is from nexson_diff.diff(): lists of the added,
+        removed and modified elements, and a summary, plus old_sha and
+        new_sha, the study_sha() of the study at each ref (None if it
+        does not exist there). Returns None if either ref does not
+        exist, or the study exists at neither ref.
+
+        Results are cached by the two study SHAs, so a diff is only
+        worked out once.
+        """
+        if self.resolve_ref(old_ref) is None or self.resolve_ref(new_ref) is None:
+            return None
+        old_sha = self.study_sha(study_id, old_ref)
+        new_sha = self.study_sha(study_id, new_ref)
+        if old_sha is None and new_sha is None:
+            return None
+
+        result = self.diff_cache.get((old_sha, new_sha))
+        if result is None:
+            if old_sha == new_sha:
+                result = nexson_diff.diff(None, None)
+            else:
+                result = nexson_diff.diff_json(old_sha and self.read_study_sha(study_id, old_sha),
+                    new_sha and self.read_study_sha(study_id, new_sha))
+            result.update({ "old_sha": old_sha, "new_sha": new_sha })
+            self.diff_cache.put((old_sha, new_sha), result)
+        return dict(result)
+
+    def _study_commits(self, study_id, *revisions):
+        "Return the SHAs of the commits in revisions which changed study_id, newest first"
+        return git("rev-list", "--full-history", "--no-merges", *(revisions + ("--", "study/%s" % study_id))).split()
+
+    def _log_commits(self, *args):
+        "Return a dict with the sha, author and message of each commit git log lists with args"
+        if args[0] == "--no-walk=unsorted" and len(args) == 1:
+            return []
+        output  = git("--no-pager", "log", "-z", "--format=%H%x1f%an%x1f%ae%x1f%aI%x1f%B", *args)
+        commits = []
+        for entry in output.split("\0"):
+            if not entry.strip():
+                continue
+            fields = entry.split("\x1f", 4)
+            commits.append({
+                "sha":          fields[0],
+                "author_name":  fields[1],
+                "author_email": fields[2],
+                "date":         fields[3],
+                "message":      fields[4].rstrip("\n"),
+            })
+        return commits
+
+    @preserve_cwd
+    def update_history(self, branch="master"):
+        """Bring the history index up to date with branch
+
+        The index maps every study to the commits of branch which
+        changed it, see HistoryIndex. If the index was made at an
+        ancestor of branch, only the newer commits are looked at,
+        otherwise it is made from scratch. Merge commits are left out,
+        like in study_history(). Returns the SHA of branch.
+
+        This runs with maintain(). Making the index of a long history
+        from scratch takes a while, but a request never has to.
+        """
+        os.chdir(self.repo)
+        tip = self.branch_sha(branch)
+        indexed, studies = self.history_index.current()
+        if tip is None or tip == indexed:
+            return tip
+
+        if indexed and self.cat_file_check.get(indexed) is not None and self.is_ancestor(indexed, tip):
+            revisions = "%s..%s" % (indexed, tip)
+            studies   = dict(studies)
+        else:
+            revisions = tip
+            studies   = {}
+
+        output  = git("--no-pager", "log", "--full-history", "--no-merges", "--format=%x00%H",
+            "--name-only", revisions, "--", "study/")
+        changed = {}
+        for entry in output.split("\0"):
+            lines = entry.split()
+            if not lines:
+                continue
+            for study_id in set([ path.split("/")[1] for path in lines[1:] ]):
+                changed.setdefault(study_id, []).append(lines[0])
+        for study_id, commits in changed.items():
+            studies[study_id] = commits + studies.get(study_id, [])
+
+        self.history_index.save(branch, tip, studies)
+        return tip
+
+    def fetch_studies(self, study_ids, ref="master"):
+        """Generate a (study_id, sha, content) tuple for each of study_ids
+
+        sha is the study_sha() of the study. ref is resolved once, so
+        every study is read from the same commit even if ref moves in
+        the meantime. sha and content are None for a study which does
+        not exist at ref.
+        """
+        tip = self.resolve_ref(ref)
+        for study_id in study_ids:
+            sha = None
+            if tip is not None:
+                sha = self.study_sha(study_id, tip)
+            if sha is None:
+                yield study_id, None, None
+            else:
+                yield study_id, sha, self.read_study_sha(study_id, sha)
+
+    def export_studies(self, ref="master", format="ndjson", compress=False):
+        """Return a generator of the chunks of a snapshot of every study at ref
+
+        With format "tar", the snapshot is a tar archive of the study
+        directory, as "git archive" writes it, so sharded studies are
+        in shards. With "ndjson", each study is one line
+
+            {"id": "10", "sha": "<study SHA>", "nexson": {...}}
+
+        in the order of their paths. With compress, the snapshot is
+        gzipped. Returns None if ref does not exist.
+
+        ref is resolved once, and the studies are read from the object
+        database in one pass of a git process of their own, so nothing
+        is checked out, no lock is taken, and other requests are not
+        held up, however long the export takes.
+        """
+        if format not in self.export_formats:
+            raise ValueError("format must be one of %s" % (self.export_formats,))
+        tip = self.resolve_ref(ref)
+        if tip is None:
+            return None
+        if format == "tar":
+            return self._export_tar(tip, compress)
+        chunks = self._export_ndjson(tip)
+        if compress:
+            chunks = self._gzip_chunks(chunks)
+        return chunks
+
+    def _export_tar(self, tip, compress):
+        "Generate the chunks of git archive of the studies at tip"
+        process = subprocess.Popen(["git", "archive", "--format=%s" % (compress and "tar.gz" or "tar"),
+            tip, "study/"], cwd=self.repo, stdout=subprocess.PIPE)
+        finished = False
+        try:
+            while True:
+                chunk = process.stdout.read(self.stream_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            finished = True
+        finally:
+            process.stdout.close()
+            if not finished:
+                # we were stopped early, e.g. the client went away,
+                # which is not an error of git archive
+                process.kill()
+                process.wait()
+        if process.wait() != 0:
+            raise IOError("git archive of %s failed" % tip)
+
+    def _export_ndjson(self, tip):
+        "Generate the lines of the studies at tip, one study per line"
+        # every file and directory under study/, in the order of their paths
+        listing = subprocess.Popen(["git", "ls-tree", "-r", "-t", "-z", tip, "study/"],
+            cwd=self.repo, stdout=subprocess.PIPE).communicate()[0]
+        studies = {}
+        order   = []
+        for entry in listing.split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            parts = path.split("/")
+            if len(parts) == 2 and info.split()[1] == "tree":
+                order.append(parts[1])
+                studies[parts[1]] = (info.split()[2], {})
+            elif len(parts) == 3 and parts[1] in studies:
+                studies[parts[1]][1][parts[2]] = info.split()[2]
+
+        objects = CatFile(self.repo)
+        try:
+            for study_id in order:
+                tree_sha, files = studies[study_id]
+                if "%s.json" % study_id in files:
+                    sha    = files["%s.json" % study_id]
+                    shards = [ sha ]
+                else:
+                    sha    = tree_sha
+                    shards = [ files[name] for name in sort_shards(study_id, files.keys()) ]
+                if not shards:
+                    continue
+
+                yield '{"id": %s, "sha": "%s", "nexson": ' % (json.dumps(study_id), sha)
+                for shard in shards:
+                    # studies are written with indent=0, and JSON strings
+                    # can't contain a raw newline, so every newline is
+                    # whitespace between tokens
+                    yield objects.get(shard)[2].replace("\n", "")
+                yield "}\n"
+        finally:
+            objects.close()
+
+    def _gzip_chunks(self, chunks):
+        "Generate the gzipped chunks of chunks"
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def fetch_study(self, study_id, ref=None):
         """Return the contents of the given study_id
 
+        If ref (a branch name or SHA) is given, the study is read from
+        the object database at that ref, otherwise it is read from the
+        working tree. Sharded studies are put back together.
+
         If the study_id does not exist, it returns the empty string.
         """
-        study_filename = "%s/study/%s/%s.json" % (self.repo, study_id, study_id)
+        if ref is not None:
+            sha = self.study_sha(study_id, ref)
+            if sha is None:
+                return ''
+            return self.read_study_sha(study_id, sha)
+
+        study_dir = "%s/study/%s" % (self.repo, study_id)
         try:
-            file = open(study_filename, 'r')
+            filenames = sort_shards(study_id, os.listdir(study_dir)) or [ "%s.json" % study_id ]
+            return "".join([ open("%s/%s" % (study_dir, f), 'r').read() for f in filenames ])
         except:
             return ''
-        return file.read()
 
     @preserve_cwd
     def branch_exists(self, branch):
@@ -109,41 +919,234 @@ class GitData(object):
         return True
 
     @preserve_cwd
-    def remove_study(self,study_id, branch, author="OpenTree API <api@opentreeoflife.org>"):
-        """Remove a study
+    def branch_sha(self, branch):
+        """Return the SHA at the tip of the local branch, or None if it does not exist"""
+        os.chdir(self.repo)
+        try:
+            return git("rev-parse", "--verify", "--quiet", "refs/heads/%s" % branch).strip()
+        except sh.ErrorReturnCode:
+            return None
 
-        Given a study_id, branch and optionally an
-        author, remove a study on the given branch
-        and attribute the commit to author.
+    @preserve_cwd
+    def is_ancestor(self, ancestor, descendant):
+        """Returns true if the commit ancestor is reachable from descendant"""
+        os.chdir(self.repo)
+        try:
+            git("merge-base", "--is-ancestor", ancestor, descendant)
+        except sh.ErrorReturnCode_1:
+            return False
+        return True
 
-        Returns the SHA of the commit on branch.
+    @preserve_cwd
+    def delete_branch(self, branch, old_sha):
+        """Delete the local branch, if it still points at old_sha
 
+        Like update_branch(), a concurrent update makes this raise an
+        exception instead of losing a commit.
         """
         os.chdir(self.repo)
+        git("update-ref", "-d", "refs/heads/%s" % branch, old_sha)
+        self.branch_index.update(branch, None)
+        self.invalidate_cache(branch)
 
-        study_dir      = "study/%s" % study_id
-        study_filename = "%s/%s.json" % (study_dir, study_id)
+    def _refs_stamp(self):
+        """Return the modification times of the files holding the local branches
 
-        if self.branch_exists(branch):
-            git.checkout(branch)
-            if not os.path.isdir(study_dir):
-                # branch already exists locally with study removed
-                # so just return the commit SHA
-                return git("rev-parse","HEAD").strip()
-        else:
-            # Create this new branch off of master, NOT the currently-checked out branch!
-            git.checkout("master")
-            git.checkout("-b",branch)
+        Creating, moving or deleting a branch, with any git command,
+        changes one of them, so this is how the branch index notices
+        what other processes did without running git.
+        """
+        stamp = []
+        for path in [ "%s/.git/refs/heads" % self.repo, "%s/.git/packed-refs" % self.repo ]:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @preserve_cwd
+    def ahead_behind(self, sha, base_sha):
+        "Return how many commits sha has which base_sha does not have, and the other way around"
+        os.chdir(self.repo)
+        behind, ahead = git("rev-list", "--left-right", "--count", "%s...%s" % (base_sha, sha)).split()
+        return int(ahead), int(behind)
 
-        git.rm("-rf", study_dir)
+    def study_branches(self, study_id):
+        """Return the WIP branches of study_id, from the branch index
 
-        git.commit(author=author, message="Delete Study #%s via OpenTree API" % study_id)
+        Each is a dict with the keys curator, branch, sha, ahead and
+        behind (the commits it has which master does not have, and the
+        other way around). Nothing is run for branches which did not
+        change since the last call, so this is cheap enough to call on
+        every page load.
+        """
+        return self.branch_index.study_branches(str(study_id))
+
+    def _checked_out_branch(self):
+        "Return the current branch name, or None if HEAD is detached"
+        try:
+            return self.current_branch()
+        except sh.ErrorReturnCode:
+            return None
+
+    @preserve_cwd
+    def update_branch(self, branch, new_sha, old_sha=None):
+        """Move branch to new_sha without a checkout
 
-        new_sha = git("rev-parse","HEAD")
+        The ref is only updated if it still points at old_sha (or does
+        not exist yet, if old_sha is None), so a concurrent update
+        makes this raise an exception instead of losing a commit.
 
-        return new_sha.strip()
+        If branch happens to be checked out, the index and working
+        tree are fast-forwarded to match.
+        """
+        os.chdir(self.repo)
+
+        git("update-ref", "-m", "OpenTree API", "refs/heads/%s" % branch,
+            new_sha, old_sha or "0" * 40)
+        self.branch_index.update(branch, new_sha)
+        self.invalidate_cache(branch)
+
+        if old_sha and branch == self._checked_out_branch():
+            try:
+                git("read-tree", "-m", "-u", old_sha, new_sha)
+            except sh.ErrorReturnCode:
+                # local modifications are in the way, leave them alone
+                pass
 
     @preserve_cwd
+    def commit_changes(self, branch, changes, author, message, base_branch="master"):
+        """Commit changes to branch without touching the working tree
+
+        changes is a dict mapping paths to their new content. A
+        content of None removes the path, which may be a directory
+        or have a glob pattern as its last part, like
+        "study/12/12-*.json". Removals are made before the new
+        content is written.
+
+        The new tree is built from the tree of the parent commit with
+        "git mktree", rewriting only the trees on the way to the
+        changed paths (see _update_tree), so the cost of a commit does
+        not grow with the size of the repository. "git commit-tree"
+        creates the commit, which then becomes the tip of branch via
+        update_branch(). If branch does not yet exist it is created
+        from base_branch, NOT the currently-checked out branch, and if
+        that does not exist either, a ValueError is raised.
+
+        Returns the SHA of the new commit, or of the existing tip of
+        branch if the changes do not modify anything. Changes that do
+        not modify anything on a new branch raise a ValueError.
+        """
+        os.chdir(self.repo)
+
+        old_sha = self.branch_sha(branch)
+        parent  = old_sha or self.branch_sha(base_branch)
+        if parent is None:
+            raise ValueError("Cannot create branch %s from non-existent branch %s" % (branch, base_branch))
+
+        mo = re.match(r"^(.*?)\s*<(.*)>$", author)
+        if not mo:
+            raise ValueError("Author must be of the form 'Name <email>': %s" % author)
+
+        parent_tree = self.cat_file_check.get("%s^{tree}" % parent)[0]
+        tree = self._update_tree(parent_tree,
+            [ (path.strip("/").split("/"), content) for path, content in changes.items() ])
+        if tree is None:
+            # everything was removed
+            tree = self._mktree({})
+
+        if tree == parent_tree:
+            if old_sha:
+                return old_sha
+            raise ValueError("Nothing to commit on new branch %s" % branch)
+
+        commit_env = os.environ.copy()
+        commit_env["GIT_AUTHOR_NAME"]  = mo.group(1)
+        commit_env["GIT_AUTHOR_EMAIL"] = mo.group(2)
+        new_sha = git("commit-tree", tree, "-p", parent, "-m", message, _env=commit_env).strip()
+
+        self.update_branch(branch, new_sha, old_sha)
+
+        return new_sha
+
+    def _update_tree(self, tree_sha, changes):
+        """Return the SHA of the tree tree_sha with changes made, or None if it ends up empty
+
+        changes is a list of (path as a list of names, content), see
+        commit_changes(). tree_sha can be None for a tree which does
+        not exist yet. Only the subtrees with changes in them are read
+        and written again, the others are kept by their SHA.
+        """
+        entries = {}
+        if tree_sha is not None:
+            entries = self._read_tree_entries(tree_sha) or {}
+        old_entries = dict(entries)
+
+        # removals first, so new content matching a pattern is kept
+        for path, content in changes:
+            if len(path) == 1 and content is None:
+                for name in [ name for name in entries if fnmatch.fnmatchcase(name, path[0]) ]:
+                    del entries[name]
+
+        subtrees = {}
+        for path, content in changes:
+            if len(path) > 1:
+                subtrees.setdefault(path[0], []).append((path[1:], content))
+        for name, subchanges in subtrees.items():
+            mode, sha = entries.get(name, (None, None))
+            subtree = self._update_tree(mode == "40000" and sha or None, subchanges)
+            if subtree is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = ("40000", subtree)
+
+        for path, content in changes:
+            if len(path) == 1 and content is not None:
+                entries[path[0]] = ("100644", self._git_with_input(["hash-object", "-w", "--stdin"], content).strip())
+
+        if entries == old_entries:
+            return tree_sha
+        if not entries:
+            return None
+        return self._mktree(entries)
+
+    def _mktree(self, entries):
+        "Write a tree of entries, a dict mapping names to (mode, SHA), returning its SHA"
+        types = { "40000": "tree", "160000": "commit" }
+        listing = "".join([ "%s %s %s\t%s\0" % (mode, types.get(mode, "blob"), sha, name)
+            for name, (mode, sha) in entries.items() ])
+        return self._git_with_input(["mktree", "-z"], listing).strip()
+
+    def _git_with_input(self, args, input):
+        """Run git with args, giving it input on stdin, and return its output
+
+        sh feeds stdin a little at a time, which takes seconds for a
+        study of a few MB, or the tree with an entry per study.
+        """
+        process = subprocess.Popen(["git"] + args, cwd=self.repo,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate(input)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, "git %s: %s" % (" ".join(args), error.strip()))
+        return output
+
+    def remove_study(self,study_id, branch, author="OpenTree API <api@opentreeoflife.org>"):
+        """Remove a study
+
+        Given a study_id, branch and optionally an
+        author, remove a study on the given branch
+        and attribute the commit to author.
+
+        Returns the SHA of the commit on branch.
+
+        """
+        study_dir = "study/%s" % study_id
+
+        # if the branch already exists locally with the study removed,
+        # this just returns the commit SHA
+        return self.commit_changes(branch, { study_dir: None }, author,
+            "Delete Study #%s via OpenTree API" % study_id)
+
     def write_study(self,study_id, content, branch, author="OpenTree API <api@opentreeoflife.org>"):
         """Write a study
 
@@ -151,82 +1154,293 @@ class GitData(object):
         optionally an author, write a study on the
         given branch and attribute the commit to
         author. If the branch does not yet exist,
-        it will be created. If the study is being
-        created, it's containing directory will be
-        created as well.
+        it will be created.
+
+        Studies bigger than shard_threshold are
+        split into shards, see study_shards.py.
+
+        The commit is made with commit_changes(),
+        so no branch is checked out and the working
+        tree is left alone.
 
         Returns the SHA of the new commit on branch.
 
+        """
+        study_dir = "study/%s" % study_id
+
+        # replace whichever layout the study had before
+        if len(content) > self.shard_threshold:
+            changes = { "%s/%s.json" % (study_dir, study_id): None }
+            for number, shard in enumerate(split_study(content, self.shard_size)):
+                changes["%s/%s" % (study_dir, shard_filename(study_id, number))] = shard
+        else:
+            changes = { "%s/%s.json" % (study_dir, study_id): content }
+        changes["%s/%s-*.json" % (study_dir, study_id)] = None
+
+        return self.commit_changes(branch, changes, author,
+            "Update Study #%s via OpenTree API" % study_id)
+
+    @preserve_cwd
+    def register_merge_driver(self):
+        """Make git merge studies with nexson_merge.py
+
+        The driver is configured in .git/config and assigned to study
+        files in .git/info/attributes, so it is used by merges made by
+        the API and on the command line alike. Doing it again is
+        harmless.
         """
         os.chdir(self.repo)
+        driver = "%s %s %%O %%A %%B %%P" % (sys.executable, os.path.abspath(nexson_merge.__file__).replace(".pyc", ".py"))
+        git.config("merge.nexson.name", "NexSON-aware merge of studies")
+        git.config("merge.nexson.driver", driver)
 
-        # If there are uncommitted changes to our repo, stash them so this commit can proceed
-        git.stash()
+        attributes = "%s/.git/info/attributes" % self.repo
+        line = "study/*/*.json merge=nexson\n"
+        try:
+            present = line in open(attributes).readlines()
+        except IOError:
+            present = False
+        if not present:
+            try:
+                os.makedirs(os.path.dirname(attributes))
+            except OSError:
+                # it already exists
+                pass
+            file = open(attributes, 'a')
+            file.write(line)
+            file.close()
+        return True
 
-        if self.branch_exists(branch):
-            git.checkout(branch)
-        else:
-            # Create this new branch off of master, NOT the currently-checked out branch!
-            git.checkout("master")
-            git.checkout("-b",branch)
+    @preserve_cwd
+    def merge_trees(self, ours, theirs):
+        """Merge two commits in memory, returning (tree SHA, conflicts)
 
-        study_dir      = "study/%s" % study_id
-        study_filename = "%s/%s.json" % (study_dir, study_id)
+        "git merge-tree --write-tree" does the merge in the object
+        database, without an index or a working tree, so it does not
+        disturb anything else going on in the repository.
 
-        # create a study directory if this is a new study
-        if not os.path.isdir(study_dir):
-            os.mkdir(study_dir)
+        conflicts is empty for a clean merge. Otherwise there is a dict
+        per conflicted path, with the keys path, base, ours and theirs
+        (the blob SHAs of each side, or None where the path does not
+        exist), types (like "CONFLICT (contents)") and messages.
 
-        file = open(study_filename, 'w')
-        file.write(content)
-        file.close()
+        Studies are merged by their structure (see nexson_merge.py),
+        so for a conflicted study, nexson lists the places in it
+        which both sides changed, like
+        "nexml/otus/otu[@id=otu4]/@label".
+        """
+        os.chdir(self.repo)
+        _shared_for(self.repo, "merge_driver", self.register_merge_driver)
+        output = git("merge-tree", "--write-tree", "-z", ours, theirs, _ok_code=[0, 1])
+        fields = output.stdout.split("\0")
+        tree   = fields.pop(0)
+
+        conflicts = {}
+        stages    = { "1": "base", "2": "ours", "3": "theirs" }
+        # the conflicted paths, "<mode> <SHA> <stage>\t<path>", up to an empty field
+        while fields and fields[0]:
+            info, path = fields.pop(0).split("\t", 1)
+            mode, sha, stage = info.split(" ")
+            conflict = conflicts.setdefault(path, {
+                "path": path, "base": None, "ours": None, "theirs": None, "types": [], "messages": [] })
+            conflict[stages[stage]] = sha
+        # then messages, "<number of paths>", the paths, "<type>", "<message>"
+        fields = fields[1:]
+        while len(fields) > 1:
+            count = int(fields.pop(0))
+            paths = fields[:count]
+            type, message = fields[count:count + 2]
+            del fields[:count + 2]
+            for path in paths:
+                if path in conflicts and type.startswith("CONFLICT"):
+                    conflicts[path]["types"].append(type)
+                    conflicts[path]["messages"].append(message.strip())
+
+        for conflict in conflicts.values():
+            if re.match(r"^study/([^/]+)/\1\.json$", conflict["path"]) and conflict["ours"] and conflict["theirs"]:
+                versions = [ conflict[side] and self.read_blob_sha(conflict[side]) or ""
+                    for side in ("base", "ours", "theirs") ]
+                try:
+                    conflict["nexson"] = nexson_merge.merge_json(*versions)[1]
+                except ValueError:
+                    pass
+
+        return tree, [ conflicts[path] for path in sorted(conflicts) ]
 
-        git.add(study_filename)
+    @preserve_cwd
+    def merge_commits(self, ours, theirs, message):
+        """Create a merge commit of theirs into ours, returning its SHA
+
+        Nothing is checked out and no ref is moved. If the merge has
+        conflicts, a MergeException is raised, listing them.
+        """
+        os.chdir(self.repo)
+        tree, conflicts = self.merge_trees(ours, theirs)
+        if conflicts:
+            raise MergeException("Merge conflicts in %s" % ", ".join([ c["path"] for c in conflicts ]), conflicts)
+        return git("commit-tree", tree, "-p", ours, "-p", theirs, "-m", message).strip()
+
+    def merge_check(self, branch, base_branch="master"):
+        """Find out if branch can be merged into base_branch, without merging
 
-        git.commit(author=author, message="Update Study #%s via OpenTree API" % study_id)
+        No ref is moved and nothing is checked out. Returns None if
+        one of the branches does not exist, otherwise a dict with the
+        keys branch_sha, base_sha, mergeable, already_merged and
+        conflicts (see merge_trees).
 
-        new_sha = git("rev-parse","HEAD")
+        The answer only depends on the tips of the two branches, so it
+        is cached by their SHAs, and asking again before either branch
+        moves costs two ref lookups.
+        """
+        branch_sha = self.resolve_ref(branch)
+        base_sha   = self.resolve_ref(base_branch)
+        if branch_sha is None or base_sha is None:
+            return None
 
-        return new_sha.strip()
+        result = self.merge_check_cache.get((base_sha, branch_sha))
+        if result is None:
+            if self.is_ancestor(branch_sha, base_sha):
+                conflicts, already_merged = [], True
+            else:
+                conflicts, already_merged = self.merge_trees(base_sha, branch_sha)[1], False
+            result = {
+                "branch_sha":     branch_sha,
+                "base_sha":       base_sha,
+                "mergeable":      not conflicts,
+                "already_merged": already_merged,
+                "conflicts":      conflicts,
+            }
+            self.merge_check_cache.put((base_sha, branch_sha), result)
+        return dict(result)
 
     @preserve_cwd
     def merge(self, branch, base_branch="master"):
         """
         Merge the the given WIP branch to master (or base_branch, if specified)
 
-        If the merge fails, the merge will be aborted
-        and then a MergeException will be thrown. The
-        message of the MergeException will be the
-        "git status" output, so details about merge
-        conflicts can be determined.
+        The merge is done in memory (see merge_trees), so nothing is
+        checked out, and base_branch is moved to the new merge commit
+        with a compare-and-swap, so a concurrent update of base_branch
+        makes the merge fail instead of being lost. The local WIP
+        branch is then deleted.
+
+        If the merge has conflicts, nothing is changed and a
+        MergeException is thrown. Its conflicts list says which
+        studies conflict, and how.
 
         """
 
         os.chdir(self.repo)
 
-        current_branch = self.current_branch()
-        if current_branch != base_branch:
-            git.checkout(base_branch)
+        base_sha   = self.branch_sha(base_branch)
+        branch_sha = self.branch_sha(branch)
 
-        # Always create a merge commit, even if we could fast forward, so we know
-        # when merges occured
-        try:
-            merge_output = git.merge("--no-ff", branch)
-        except sh.ErrorReturnCode:
-            # attempt to reset things so other operations can
-            # continue
-            output = git.status()
-            git.merge("--abort")
-
-            # re-raise the exception so other code can decide
-            # what to do with it
-            raise MergeException(output)
+        if self.is_ancestor(branch_sha, base_sha):
+            # already merged, like "git merge" we don't make a commit
+            new_sha = base_sha
+        else:
+            # Always create a merge commit, even if we could fast forward, so we know
+            # when merges occured
+            new_sha = self.merge_commits(base_sha, branch_sha, self._merge_message(branch, base_branch))
+            self.update_branch(base_branch, new_sha, base_sha)
 
         # the merge succeeded, so remove the local WIP branch
-        git.branch("-d", branch)
+        self.delete_branch(branch, branch_sha)
+        self.invalidate_cache(base_branch)
 
-        new_sha      = git("rev-parse","HEAD")
-        return new_sha.strip()
+        return new_sha
+
+    def _merge_message(self, branch, base_branch):
+        "The message of a merge commit, as git merge writes it"
+        if base_branch == "master":
+            return "Merge branch '%s'" % branch
+        return "Merge branch '%s' into %s" % (branch, base_branch)
+
+    @preserve_cwd
+    def merge_many(self, branches, base_branch="master", on_conflict="stop"):
+        """Merge the given WIP branches into base_branch, one after another
+
+        Each branch is merged in memory on top of the previous merges,
+        and base_branch is only moved once, to the last merge commit,
+        with a compare-and-swap. The WIP branches which were merged are
+        deleted.
+
+        If a branch conflicts, with on_conflict="stop" no more branches
+        are merged (those before it still are), with "skip" it is left
+        out and the next one is merged.
+
+        A branch given more than once is only merged the first time.
+
+        Returns (new SHA of base_branch, results), where results has a
+        dict per branch, in order, with the keys branch, status and sha
+        (the tip of the branch, or None if it does not exist). status
+        is "merged", "already_merged", "conflict" (see conflicts),
+        "missing" or "not_attempted", after a conflict with "stop".
+
+        Once base_branch was moved nothing raises, so the caller can
+        always push it. A merged branch which could not be deleted has
+        "deleted" set to False.
+        """
+        if on_conflict not in ("stop", "skip"):
+            raise ValueError("on_conflict must be stop or skip")
+        os.chdir(self.repo)
+
+        unique = []
+        for branch in branches:
+            if branch not in unique:
+                unique.append(branch)
+
+        base_sha = self.branch_sha(base_branch)
+        new_sha  = base_sha
+        results  = []
+        stopped  = False
+        for branch in unique:
+            branch_sha = self.branch_sha(branch)
+            result     = { "branch": branch, "sha": branch_sha }
+            results.append(result)
+            if stopped:
+                result["status"] = "not_attempted"
+            elif branch_sha is None:
+                result["status"] = "missing"
+            elif self.is_ancestor(branch_sha, new_sha):
+                result["status"] = "already_merged"
+            else:
+                try:
+                    new_sha = self.merge_commits(new_sha, branch_sha, self._merge_message(branch, base_branch))
+                    result["status"] = "merged"
+                except MergeException, e:
+                    result["status"]    = "conflict"
+                    result["conflicts"] = e.conflicts
+                    stopped = on_conflict == "stop"
+
+        if new_sha != base_sha:
+            self.update_branch(base_branch, new_sha, base_sha)
+
+        for result in results:
+            if result["status"] in ("merged", "already_merged"):
+                try:
+                    self.delete_branch(result["branch"], result["sha"])
+                    result["deleted"] = True
+                except sh.ErrorReturnCode:
+                    # it is merged, so leaving it behind loses nothing
+                    result["deleted"] = False
+        self.invalidate_cache(base_branch)
+
+        return new_sha, results
+
+    def queue_push(self, remote, branch, sha, env={}):
+        """Push branch to remote in the background
+
+        sha is the commit we want to reach the remote. Pending pushes
+        of the same branch are combined into one, see PushQueue. Use
+        push_status(sha) to find out how it went.
+        """
+        self.push_queue.start_worker(env)
+        self.push_queue.enqueue(remote, branch, sha)
+
+    def push_status(self, sha):
+        "Return the status of a queued push of sha, see PushQueue.status()"
+        return self.push_queue.status(sha)
 
     @preserve_cwd
     def delete_remote_branch(self, remote, branch, env={}):
@@ -236,7 +1450,20 @@ class GitData(object):
         self.push(remote, env, ":%s" % branch)
 
     @preserve_cwd
-    def push(self, remote, env={}, branch=None):
+    def remote_branch_known(self, remote, branch):
+        """Returns true if we have a remote-tracking ref for branch on remote
+
+        That is, the last time we talked to remote, branch existed.
+        """
+        os.chdir(self.repo)
+        try:
+            git("rev-parse", "--verify", "--quiet", "refs/remotes/%s/%s" % (remote, branch))
+        except sh.ErrorReturnCode:
+            return False
+        return True
+
+    @preserve_cwd
+    def push(self, remote, env={}, branch=None, atomic=False):
         """
         Push a branch to a given remote
 
@@ -248,6 +1475,13 @@ class GitData(object):
         If no branch is given, the current branch
         will be used.
 
+        branch can also be a list of refspecs, for
+        example [ "master", ":leto_study_12" ] to
+        update master and delete leto_study_12. They
+        are all pushed by one "git push", over a
+        single connection. If atomic is true, the
+        remote either accepts all of them or none.
+
         The ability to specify env is so that PKEY
         and GIT_SSH can be specified so Git can use
         different SSH credentials than the current
@@ -258,33 +1492,218 @@ class GitData(object):
         """
         os.chdir(self.repo)
 
-        if branch:
-            branch_to_push = branch
+        if isinstance(branch, list):
+            refspecs = branch
+        elif branch:
+            refspecs = [ branch ]
         else:
-            branch_to_push = self.current_branch()
+            refspecs = [ self.current_branch() ]
+
+        args = [ remote ] + refspecs
+        if atomic:
+            args.insert(0, "--atomic")
 
-        # if there is no PKEY, we don't need to override env
         # We are explicit about what we are pushing, since the default behavior
         # is different in different versions of Git and/or by configuration
-        if env["PKEY"]:
-            new_env = os.environ.copy()
-            new_env.update(env)
-            git.push(remote, branch_to_push, _env=new_env)
-        else:
-            git.push(remote, branch_to_push)
+        git.push(*args, **self._remote_kwargs(env, remote))
+
+        for refspec in refspecs:
+            src, _, dst = refspec.lstrip("+").partition(":")
+            dst = re.sub("^refs/heads/", "", dst or src)
+            self.remote_refs.update(remote, dst, self.resolve_ref(src) if src else None)
+
+    @preserve_cwd
+    def sync(self, remote, env={}):
+        """Fetch every branch of remote, and fast-forward ours
+
+        A single "git fetch --prune" updates all the remote-tracking
+        branches of remote. Then each local branch which is behind its
+        remote branch, without commits of its own, is fast-forwarded
+        without a checkout. Branches with local-only commits are left
+        to pull() and the push queue, and branches being written to
+        right now are left for the next sync.
+
+        This is meant to run periodically (see cron/sync_remote.py), so
+        requests rarely need to pull. When it was done is recorded, see
+        sync_status(), which is also what this returns.
+        """
+        os.chdir(self.repo)
+        started = time.time()
+        prefix  = "refs/remotes/%s/" % remote
+        git.fetch("--prune", "--quiet", remote, "+refs/heads/*:%s*" % prefix,
+            **self._remote_kwargs(env, remote))
+
+        remote_shas = self._ref_shas(prefix)
+        remote_shas.pop("HEAD", None)
+        local_shas  = self._ref_shas("refs/heads/")
+        self.remote_refs.put(remote, remote_shas)
+
+        updated = []
+        for branch, remote_sha in sorted(remote_shas.items()):
+            local_sha = local_shas.get(branch)
+            if local_sha is None or local_sha == remote_sha or not self.is_ancestor(local_sha, remote_sha):
+                continue
+            lock = self.branch_lock(branch, timeout=0)
+            try:
+                lock.acquire()
+            except LockError:
+                # somebody is writing to it
+                continue
+            try:
+                self.update_branch(branch, remote_sha, local_sha)
+                updated.append(branch)
+            except sh.ErrorReturnCode:
+                # it moved since we looked
+                pass
+            finally:
+                lock.release()
+
+        status = {
+            "remote":   remote,
+            "fetched":  started,
+            "duration": time.time() - started,
+            "branches": len(remote_shas),
+            "updated":  updated,
+        }
+        try:
+            os.makedirs(self.sync_dir)
+        except OSError:
+            # it already exists
+            pass
+        filename = "%s/%s" % (self.sync_dir, urllib.quote(remote, safe=''))
+        file = open("%s.tmp" % filename, 'w')
+        json.dump(status, file)
+        file.close()
+        os.rename("%s.tmp" % filename, filename)
+
+        return self.sync_status(remote)
+
+    def sync_status(self, remote=None):
+        """Return when remote was last fetched by sync(), or None if it never was
+
+        The status is a dict with the keys remote, fetched (a Unix
+        timestamp), duration, branches (how many the remote has),
+        updated (the branches which were fast-forwarded) and age (the
+        seconds since the fetch started), so reads of a branch which
+        follows the remote are at most age seconds out of date.
+
+        Without a remote, a dict mapping every remote ever synced to
+        its status is returned.
+        """
+        if remote is None:
+            if not os.path.isdir(self.sync_dir):
+                return {}
+            statuses = {}
+            for name in os.listdir(self.sync_dir):
+                if not name.endswith(".tmp"):
+                    statuses[urllib.unquote(name)] = self.sync_status(urllib.unquote(name))
+            return statuses
+        try:
+            status = json.load(open("%s/%s" % (self.sync_dir, urllib.quote(remote, safe=''))))
+        except (IOError, ValueError):
+            return None
+        status["age"] = time.time() - status["fetched"]
+        return status
+
+    @preserve_cwd
+    def _ref_shas(self, prefix):
+        "Return a dict mapping the refs under prefix, without it, to their SHAs"
+        os.chdir(self.repo)
+        shas = {}
+        for line in git("for-each-ref", "--format=%(objectname) %(refname)", prefix).splitlines():
+            sha, ref = line.split(" ", 1)
+            shas[ref[len(prefix):]] = sha
+        return shas
+
+    @preserve_cwd
+    def ls_remote(self, remote, env={}):
+        "Return a dict of the branches on remote and the SHAs of their tips"
+        os.chdir(self.repo)
+        output = git("ls-remote", "--heads", remote, **self._remote_kwargs(env, remote))
+        branches = {}
+        for line in output.splitlines():
+            sha, ref = line.split("\t", 1)
+            branches[re.sub("^refs/heads/", "", ref)] = sha
+        return branches
+
+    def needs_pull(self, remote, branch, env={}):
+        """Returns true if pulling branch from remote could change it
+
+        This is false if branch does not exist on remote, or if our
+        branch already contains the remote one, for example because
+        we pushed it. The branches on remote come from remote_refs,
+        so this usually does not talk to the remote.
+        """
+        remote_sha = self.remote_refs.get(remote, branch, env)
+        if remote_sha is None:
+            return False
+        local_sha = self.branch_sha(branch)
+        if local_sha is None or self.cat_file_check.get(remote_sha) is None:
+            # we don't have the remote commit yet
+            return True
+        return remote_sha != local_sha and not self.is_ancestor(remote_sha, local_sha)
+
+    @preserve_cwd
+    def ssh_master(self, remote, env={}):
+        """Return the SSHMaster for the shared connection to remote
+
+        There is one per host and deploy key (the PKEY in env).
+        remote can be the name of a remote or a URL.
+        """
+        os.chdir(self.repo)
+        try:
+            url = git.config("--get", "remote.%s.url" % remote).strip()
+        except sh.ErrorReturnCode:
+            url = remote
+        return SSHMaster(url, env.get("PKEY"))
+
+    def close_ssh_master(self, remote, env={}):
+        """Close the shared SSH connection to remote, if there is one
+
+        It closes by itself after ssh_control_persist idle seconds, so
+        this is only needed to drop it early.
+        """
+        return self.ssh_master(remote, env).stop()
+
+    def _remote_kwargs(self, env, remote=None):
+        """Keyword arguments for sh to run a remote git command with env
+
+        If there is no PKEY, we don't need to override the environment.
+        Otherwise, if remote is reached over SSH, bin/git.sh is told
+        to share one connection to it, see ssh_master.py.
+        """
+        if not env.get("PKEY"):
+            return {}
+        new_env = os.environ.copy()
+        new_env.update(env)
+        if remote:
+            control_path = self.ssh_master(remote, env).prepare()
+            if control_path:
+                new_env["SSH_CONTROL_PATH"]    = control_path
+                new_env["SSH_CONTROL_PERSIST"] = str(self.ssh_control_persist)
+        return { "_env": new_env }
 
     @preserve_cwd
     def pull(self, remote, env={}, branch=None):
         """
         Pull a branch from a given remote
 
-        Given a remote, env and branch, pull branch
+        Given a remote, env and branch, fetch branch
         from remote and add the environment variables
         in the env dict to the environment of the
-        "git pull" command.
+        "git fetch" command.
 
         If no branch is given, the current branch
         will be updated.
+
+        The local branch is created or fast-forwarded
+        without a checkout. If the local and remote
+        branches have diverged, the remote branch is
+        merged into it in memory, see merge_commits().
+        If that merge has conflicts, the local branch
+        is left alone and a MergeException is thrown.
+
+        Returns the SHA of the local branch.
         """
         os.chdir(self.repo)
         if branch:
@@ -292,15 +1711,134 @@ class GitData(object):
         else:
             branch_to_pull = self.current_branch()
 
-        # if there is no PKEY, we don't need to override env
-        # We are explicit about what we are pushing, since the default behavior
-        # is different in different versions of Git and/or by configuration
-        if env["PKEY"]:
-            new_env = os.environ.copy()
-            new_env.update(env)
-            git.pull(remote, branch_to_pull, _env=new_env)
-        else:
-            git.pull(remote, branch_to_pull)
+        remote_ref = "refs/remotes/%s/%s" % (remote, branch_to_pull)
+        try:
+            git.fetch(remote, "+refs/heads/%s:%s" % (branch_to_pull, remote_ref),
+                **self._remote_kwargs(env, remote))
+        except sh.ErrorReturnCode, e:
+            if "couldn't find remote ref" in e.message.lower():
+                self.remote_refs.update(remote, branch_to_pull, None)
+            raise
+
+        remote_sha = git("rev-parse", remote_ref).strip()
+        self.remote_refs.update(remote, branch_to_pull, remote_sha)
+        local_sha  = self.branch_sha(branch_to_pull)
+
+        if local_sha is None or self.is_ancestor(local_sha, remote_sha):
+            if local_sha != remote_sha:
+                self.update_branch(branch_to_pull, remote_sha, local_sha)
+            return remote_sha
+
+        if self.is_ancestor(remote_sha, local_sha):
+            # we are ahead of the remote, nothing to do
+            return local_sha
+
+        new_sha = self.merge_commits(local_sha, remote_sha,
+            "Merge remote-tracking branch '%s/%s' into %s" % (remote, branch_to_pull, branch_to_pull))
+        self.update_branch(branch_to_pull, new_sha, local_sha)
+        return new_sha
+
+    @preserve_cwd
+    def object_counts(self):
+        """Return the number of loose objects and packs, and their sizes in KiB
 
-        new_sha      = git("rev-parse","HEAD")
-        return new_sha.strip()
+        The keys are loose, loose_size, packs and pack_size, from
+        "git count-objects".
+        """
+        os.chdir(self.repo)
+        counts = {}
+        for line in git("count-objects", "-v").splitlines():
+            name, value = line.split(":", 1)
+            counts[name] = int(value)
+        return {
+            "loose":      counts["count"],
+            "loose_size": counts["size"],
+            "packs":      counts["packs"],
+            "pack_size":  counts["size-pack"],
+        }
+
+    def is_idle(self):
+        "Returns true if no branch was locked for writing in the last maintenance_idle seconds"
+        lock_files = [ self.lock_file ]
+        if os.path.isdir(self.lock_dir):
+            lock_files += [ "%s/%s" % (self.lock_dir, name) for name in os.listdir(self.lock_dir) ]
+        cutoff = time.time() - self.maintenance_idle
+        for lock_file in lock_files:
+            try:
+                if os.path.getmtime(lock_file) > cutoff:
+                    return False
+            except OSError:
+                pass
+        return True
+
+    @preserve_cwd
+    def maintain(self, force=False):
+        """Keep the object database fast to read as commits pile up
+
+        Every write adds loose objects, which makes looking up objects,
+        merges and "git log" slower. When there are more than
+        loose_object_limit loose objects or pack_limit packs, they are
+        repacked with "git repack --geometric=2", which only rolls up
+        the loose objects and the smaller packs, so it stays cheap as
+        the repository grows. A multi-pack index is written, so
+        objects are looked up once instead of once per pack. Then the
+        commit-graph is updated incrementally, with Bloom filters of
+        the changed paths, which speeds up walking history and finding
+        the commits that touched a study, and the history index is
+        brought up to date (see update_history).
+
+        The repack and the commit-graph are written under the
+        maintenance lock, held exclusively, so no writer (which holds
+        it shared, see acquire_branch_locks) commits, moves a branch
+        or pulls meanwhile. If a writer holds it, or (unless force is
+        true) the repository was written to lately (see is_idle),
+        nothing is done. It is meant to run periodically, see
+        cron/maintain_repo.py.
+
+        Returns a report, which is also kept for maintenance_status():
+        the object counts before and after, and how many seconds each
+        task took, or why nothing was done.
+        """
+        os.chdir(self.repo)
+        report = { "started": time.time(), "before": self.object_counts(), "tasks": {} }
+
+        lock = SharedLock(self.maintenance_lock_file, timeout=0)
+        if not force and not self.is_idle():
+            report["skipped"] = "the repository is busy"
+            return report
+        try:
+            lock.acquire()
+        except LockError:
+            report["skipped"] = "the repository is locked"
+            return report
+
+        def timed(task, *args):
+            started = time.time()
+            git(*args)
+            report["tasks"][task] = time.time() - started
+
+        try:
+            before = report["before"]
+            if force or before["loose"] > self.loose_object_limit or before["packs"] > self.pack_limit:
+                timed("repack", "repack", "-d", "-q", "--geometric=2", "--write-midx")
+            timed("commit-graph", "commit-graph", "write", "--reachable", "--changed-paths", "--split")
+        finally:
+            lock.release()
+
+        started = time.time()
+        self.update_history()
+        report["tasks"]["history"] = time.time() - started
+
+        report["after"] = self.object_counts()
+        file = open("%s.tmp" % self.maintenance_file, 'w')
+        json.dump(report, file)
+        file.close()
+        os.rename("%s.tmp" % self.maintenance_file, self.maintenance_file)
+        return report
+
+    def maintenance_status(self):
+        "Return the report of the last maintain() which did something, or None"
+        try:
+            return json.load(open(self.maintenance_file))
+        except (IOError, ValueError):
+            return None
@@ -0,0 +1,47 @@
+import os
+import json
+import threading
+
+class HistoryIndex(object):
+    """The commits which changed each study on a branch, kept in a file
+
+    Example:
+    index = HistoryIndex("/srv/treenexus/.git/API_HISTORY")
+    sha, studies = index.current()
+    studies.get("12", [])
+
+    sha is the commit of the branch the index was last brought up to
+    date with, and studies maps each study id to the SHAs of the
+    commits which changed it, newest first. GitData.update_history()
+    writes the file, and every process reads it again when it changed,
+    so the index costs one stat() per lookup.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.stamp    = None
+        self.sha      = None
+        self.studies  = {}
+        self.lock     = threading.Lock()
+
+    def current(self):
+        "Return (SHA the index is up to date with, { study id: [ commit SHAs ] }), or (None, {})"
+        try:
+            stamp = os.stat(self.filename).st_mtime
+        except OSError:
+            stamp = None
+        with self.lock:
+            if stamp != self.stamp:
+                try:
+                    data = json.load(open(self.filename))
+                    self.sha, self.studies = data["sha"], data["studies"]
+                except (IOError, ValueError, KeyError):
+                    self.sha, self.studies = None, {}
+                self.stamp = stamp
+            return self.sha, self.studies
+
+    def save(self, branch, sha, studies):
+        "Write a new index, made at the commit sha of branch"
+        file = open("%s.tmp" % self.filename, 'w')
+        json.dump({ "branch": branch, "sha": sha, "studies": studies }, file)
+        file.close()
+        os.rename("%s.tmp" % self.filename, self.filename)
@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """A thread-safe least-recently-used cache with a size bound
+
+    The size of each value is given by the sizeof function, which
+    defaults to len(), so a cache of strings is bounded by the number
+    of bytes it holds. When the total size goes over max_size, the
+    least recently used entries are evicted. A value bigger than
+    max_size is never cached.
+
+    Example:
+    cache = LRUCache(max_size=64 * 1024 * 1024)
+    cache.put(sha, content)
+    content = cache.get(sha)
+
+    Hits and misses are counted, see stats().
+    """
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof   = sizeof
+        self.size     = 0
+        self.hits     = 0
+        self.misses   = 0
+        self.entries  = OrderedDict()
+        self.lock     = threading.Lock()
+
+    def get(self, key, default=None):
+        "Return the value cached under key, or default"
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-insert it as the most recently used entry
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        "Cache value under key, evicting old entries as needed"
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.sizeof(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                old_key, old_value = self.entries.popitem(last=False)
+                self.size -= self.sizeof(old_value)
+
+    def pop(self, key):
+        "Remove key from the cache, returning its value or None"
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.size -= self.sizeof(value)
+            return value
+
+    def clear(self):
+        "Remove every entry, but keep the hit and miss counters"
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        "Return a dict of hits, misses, entries, size and max_size"
+        with self.lock:
+            return {
+                "hits":     self.hits,
+                "misses":   self.misses,
+                "entries":  len(self.entries),
+                "size":     self.size,
+                "max_size": self.max_size,
+            }
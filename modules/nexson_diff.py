@@ -0,0 +1,178 @@
+"""What changed in a NexSON study between two versions, element by element
+
+A line-based diff of two studies is long and hard to read, since they
+are written with json.dumps(..., indent=0). Instead, both versions are
+parsed and walked side by side in one pass, which indexes every
+element with an "@id" (otus, otu, trees, tree, node, edge, ...) by its
+@id, and every meta element by its parent and "@property". Then the
+two indexes are compared, giving the elements which were added,
+removed and modified.
+
+An element is modified when one of its own values changed, like the
+@label of an otu or the @source of an edge. Changes inside the
+elements it contains are reported for those elements, so changing a
+node does not also report its tree as modified.
+
+The index only refers to the parsed studies, and parts of them which
+are the same in both versions are skipped, so memory and time are
+linear in the size of the study.
+
+Example:
+diff_json(old_nexson, new_nexson)
+"""
+try:
+    # several times faster at parsing big studies
+    import simplejson as json
+except ImportError:
+    import json
+
+CHANGES = ("added", "removed", "modified")
+
+def _is_element(value):
+    return isinstance(value, dict) and ("@id" in value or "@property" in value)
+
+def _holds_elements(value):
+    "Return true if value is an element, or a list of them"
+    if isinstance(value, list):
+        return bool(value) and _is_element(value[0])
+    return _is_element(value)
+
+def _keyed(value, type, parent):
+    """Return [(key, id, element)] for the elements in value, which holds elements
+
+    Elements with an @id are keyed by it, meta elements by the key of
+    their parent and their @property (and #2, #3, ... for repeated
+    properties). The objects at the top of the study (with no parent),
+    like "nexml", are elements even without an @id, keyed by their name.
+    """
+    if value is None:
+        return []
+    keyed = []
+    seen  = {}
+    for element in (value if isinstance(value, list) else [ value ]):
+        if not _is_element(element):
+            if parent is None and isinstance(element, dict):
+                keyed.append((type, type, element))
+        elif "@id" in element:
+            keyed.append((element["@id"], element["@id"], element))
+        else:
+            id  = element["@property"]
+            seen[id] = seen.get(id, 0) + 1
+            key = "%s/@property=%s" % (parent, id)
+            if seen[id] > 1:
+                key = "%s#%d" % (key, seen[id])
+            keyed.append((key, id, element))
+    return keyed
+
+def changed_elements(old, new):
+    """Return the elements of two parsed studies which may have changed
+
+    Returns (old elements, new elements), dicts mapping keys to
+    (type, id, parent key, element), see _keyed().
+
+    Both studies are walked side by side, and a list of elements (or
+    an element) which is the same in both, as "==" finds out without
+    running any Python, is skipped with everything it contains. So
+    only the elements on the way to a change are looked at, and
+    nothing is copied.
+    """
+    old_elements, new_elements = {}, {}
+    # (type, old value, new value, parent key) at the same place in both
+    pending = [ (name, old.get(name), new.get(name), None) for name in sorted(set(old) | set(new))
+        if isinstance(old.get(name), (dict, list)) or isinstance(new.get(name), (dict, list)) ]
+    while pending:
+        type, old_value, new_value, parent = pending.pop()
+        if old_value == new_value:
+            continue
+        old_keyed = _keyed(old_value, type, parent)
+        old_by_key = dict([ (key, element) for key, id, element in old_keyed ])
+        new_keys  = set()
+        for key, id, element in _keyed(new_value, type, parent):
+            new_keys.add(key)
+            old_element = old_by_key.get(key)
+            if old_element == element:
+                continue
+            new_elements[key] = (type, id, parent, element)
+            if old_element is not None:
+                old_elements[key] = (type, id, parent, old_element)
+            pending.extend(_children(old_element or {}, element, key))
+        for key, id, element in old_keyed:
+            if key not in new_keys:
+                old_elements[key] = (type, id, parent, element)
+                pending.extend(_children(element, {}, key))
+    return old_elements, new_elements
+
+def _children(old, new, key):
+    "Return the values holding elements in either of two versions of the element key"
+    return [ (name, old.get(name), new.get(name), key) for name in set(old) | set(new)
+        if _holds_elements(old.get(name)) or _holds_elements(new.get(name)) ]
+
+def changed_fields(old, new):
+    "Return the names of the values of an element which differ, leaving out contained elements"
+    fields = []
+    for name in old:
+        if name not in new:
+            if not _holds_elements(old[name]):
+                fields.append(name)
+        elif old[name] != new[name] and not _holds_elements(old[name]) and not _holds_elements(new[name]):
+            fields.append(name)
+    fields.extend([ name for name in new if name not in old and not _holds_elements(new[name]) ])
+    return sorted(fields)
+
+def diff(old, new):
+    """Return the elements added, removed and modified between two parsed studies
+
+    The result is a dict with a list for each of "added", "removed"
+    and "modified", and a "summary" counting the changes of each type
+    of element. Each change has the type, id and parent (the key of the
+    element containing it, or None) of the element, and modified
+    elements also have the "fields" which changed. An element which
+    moved to another parent is modified, with "parent" in fields. The
+    changes are sorted by parent and id.
+
+    Either study can be None, for a study which did not exist.
+    """
+    old, new = old or {}, new or {}
+    old_elements, new_elements = changed_elements(old, new)
+    result  = dict([ (change, []) for change in CHANGES ])
+    summary = {}
+
+    def record(change, type, id, parent, **details):
+        details.update({ "type": type, "id": id, "parent": parent })
+        result[change].append(details)
+        counts = summary.setdefault(type, dict([ (c, 0) for c in CHANGES ]))
+        counts[change] += 1
+
+    for key, (type, id, parent, element) in new_elements.iteritems():
+        if key not in old_elements:
+            record("added", type, id, parent)
+            continue
+        old_type, old_id, old_parent, old_element = old_elements[key]
+        fields = changed_fields(old_element, element)
+        if old_parent != parent:
+            fields.append("parent")
+        if fields or old_type != type:
+            record("modified", type, id, parent, fields=fields)
+    for key, (type, id, parent, element) in old_elements.iteritems():
+        if key not in new_elements:
+            record("removed", type, id, parent)
+    for change in CHANGES:
+        result[change].sort(key=lambda c: (c["parent"] or "", c["id"]))
+
+    # changes of the values at the top of the study
+    fields = [ name for name in changed_fields(old, new)
+        if not isinstance(old.get(name), (dict, list)) and not isinstance(new.get(name), (dict, list)) ]
+    if fields:
+        record("modified", "study", None, None, fields=fields)
+
+    result["summary"] = summary
+    return result
+
+def diff_json(old, new):
+    """Diff the JSON text of two versions of a study, see diff()
+
+    Empty text means the study did not exist. Raises ValueError if
+    either is not valid JSON.
+    """
+    load = lambda text: json.loads(text) if text and text.strip() else None
+    return diff(load(old), load(new))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""A three-way merge of NexSON studies which understands their structure
+
+Studies are written with json.dumps(..., indent=0), so every value is
+on a line of its own and a line-based merge often reports a conflict
+when two curators changed different OTUs or trees that happen to be
+close together in the file, and can even produce invalid JSON.
+
+Instead, base, ours and theirs are parsed and merged element by
+element. Objects are merged key by key. Lists of elements with an
+"@id" (otus, trees, nodes, edges, ...) are matched by @id, and lists
+of meta elements by their "@property", so it does not matter where
+an element is in a list. A conflict is only reported when both sides
+changed the same value differently, or one side changed an element
+the other one deleted. Every element is visited once per side, so a
+merge takes time linear in the size of the study.
+
+This is registered as the "nexson" git merge driver for study files
+(see GitData.register_merge_driver), so both the API and merges on
+the command line use it:
+
+    python nexson_merge.py %O %A %B %P
+
+Conflicts are reported as paths into the study, like
+
+    nexml/trees/tree[@id=tree2]/node[@id=node7]/@label
+"""
+import sys
+import json
+import subprocess
+from collections import OrderedDict
+
+class _Missing(object):
+    "The value of a key or element which does not exist on one side"
+    def __repr__(self):
+        return "MISSING"
+
+MISSING = _Missing()
+
+def _element_key(element, seen):
+    """Return what identifies element in a list, or None
+
+    seen counts the meta elements of each property so far, so repeated
+    properties are matched in order.
+    """
+    if not isinstance(element, dict):
+        return None
+    if "@id" in element:
+        return "@id=%s" % element["@id"]
+    if "@property" in element:
+        property = element["@property"]
+        seen[property] = seen.get(property, 0) + 1
+        if seen[property] == 1:
+            return "@property=%s" % property
+        return "@property=%s#%d" % (property, seen[property])
+    return None
+
+def _keyed(elements):
+    "Return an OrderedDict of the elements of a list by key, or None if they can't all be keyed"
+    keyed = OrderedDict()
+    seen  = {}
+    for element in elements:
+        key = _element_key(element, seen)
+        if key is None or key in keyed:
+            return None
+        keyed[key] = element
+    return keyed
+
+def merge(base, ours, theirs, path="", conflicts=None):
+    """Merge theirs into ours, given their common ancestor base
+
+    Any of them can be MISSING, for a value which does not exist on
+    that side. Returns the merged value (or MISSING, if it was
+    deleted), and appends the path of each conflict to conflicts,
+    keeping ours there.
+    """
+    if conflicts is None:
+        conflicts = []
+    if ours == theirs:
+        return ours
+    if base == ours:
+        return theirs
+    if base == theirs:
+        return ours
+
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        if not isinstance(base, dict):
+            base = {}
+        merged = {}
+        for key in list(ours) + [ key for key in theirs if key not in ours ]:
+            value = merge(base.get(key, MISSING), ours.get(key, MISSING), theirs.get(key, MISSING),
+                "%s/%s" % (path, key), conflicts)
+            if value is not MISSING:
+                merged[key] = value
+        return merged
+
+    if isinstance(ours, list) and isinstance(theirs, list):
+        keyed_ours   = _keyed(ours)
+        keyed_theirs = _keyed(theirs)
+        keyed_base   = _keyed(base if isinstance(base, list) else [])
+        if None not in (keyed_ours, keyed_theirs, keyed_base):
+            merged = []
+            keys   = list(keyed_ours) + [ key for key in keyed_theirs if key not in keyed_ours ]
+            for key in keys:
+                value = merge(keyed_base.get(key, MISSING), keyed_ours.get(key, MISSING),
+                    keyed_theirs.get(key, MISSING), "%s[%s]" % (path, key), conflicts)
+                if value is not MISSING:
+                    merged.append(value)
+            return merged
+
+    # both changed a value, or a list we can't match up, in different ways
+    conflicts.append(path.lstrip("/") or "/")
+    if ours is MISSING:
+        return theirs
+    return ours
+
+def merge_json(base, ours, theirs):
+    """Merge the JSON text of three versions of a study
+
+    Returns (merged JSON text, list of conflicts). The merged JSON is
+    written like the API writes studies. Raises ValueError if any of
+    them is not valid JSON. An empty base means the study was added on
+    both sides.
+    """
+    load = lambda text: json.loads(text) if text.strip() else MISSING
+    conflicts = []
+    merged = merge(load(base), load(ours), load(theirs), "", conflicts)
+    return json.dumps(merged, sort_keys=True, indent=0), conflicts
+
+def main(argv):
+    """Run as a git merge driver: nexson_merge.py BASE OURS THEIRS [PATH]
+
+    The result is written to OURS. Exits with 0 if the merge is
+    clean, 1 if there are conflicts. Files which are not JSON, like
+    the shards of a big study, get git's usual line-based merge.
+    """
+    base_file, ours_file, theirs_file = argv[:3]
+    name = len(argv) > 3 and argv[3] or ours_file
+    try:
+        merged, conflicts = merge_json(open(base_file).read(), open(ours_file).read(), open(theirs_file).read())
+    except ValueError:
+        return subprocess.call(["git", "merge-file", "-q", ours_file, base_file, theirs_file]) and 1
+
+    file = open(ours_file, 'w')
+    file.write(merged)
+    file.close()
+    for conflict in conflicts:
+        sys.stderr.write("CONFLICT (nexson): %s: %s\n" % (name, conflict))
+    return conflicts and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import urllib
+import locket
+import logging
+import threading
+from locket import LockError
+
+class PushQueue(object):
+    """A durable queue of branches waiting to be pushed to a remote
+
+    Example:
+    queue = PushQueue(repo="/home/user/git/foo", push=push, branch_exists=branch_exists)
+    queue.enqueue("origin", "leto_study_12", sha)
+    queue.status(sha)
+
+    where push(remote, env, branch) pushes a branch, or a list of
+    branches, like GitData.push, and branch_exists(branch) returns
+    whether a local branch exists, like GitData.branch_exists.
+
+    Each queued branch is a file in .git/API_PUSH_QUEUE, holding one
+    line per commit waiting to be pushed. A branch is pushed once for
+    all of them, so a burst of commits to a WIP branch only causes a
+    single push. Since the queue is on disk, commits queued before a
+    restart are pushed afterwards: the environment of the worker is
+    kept in .git/API_PUSH_ENV, and a PushQueue which finds pushes
+    waiting starts a worker with it straight away.
+
+    The status of each commit ("pending", "pushed", "failed" or
+    "dropped") is kept in .git/API_PUSH_STATUS, see status().
+    """
+    # seconds between looking for work, if nobody wakes the worker up
+    poll_interval = 10
+    # seconds the status of a commit is kept after it was pushed
+    status_ttl    = 7 * 24 * 3600
+
+    def __init__(self, repo, push, branch_exists=None):
+        self.repo        = repo
+        self.push        = push
+        self.branch_exists = branch_exists or (lambda branch: True)
+        self.queue_dir   = "%s/.git/API_PUSH_QUEUE" % repo
+        self.status_dir  = "%s/.git/API_PUSH_STATUS" % repo
+        self.env_file    = "%s/.git/API_PUSH_ENV" % repo
+        # guards changes to the queue files
+        self.lock        = locket.lock_file("%s/.git/API_PUSH_QUEUE.lock" % repo, timeout=30)
+        # only one worker pushes at a time, across processes
+        self.worker_lock = locket.lock_file("%s/.git/API_PUSH_WORKER.lock" % repo, timeout=0)
+        self.wakeup      = threading.Event()
+        self.worker      = None
+
+        for d in [ self.queue_dir, self.status_dir ]:
+            try:
+                os.makedirs(d)
+            except OSError:
+                # it already exists
+                pass
+
+        # pushes left over from before a restart or crash
+        if self.pending():
+            self.wakeup.set()
+            self.start_worker(self._saved_env())
+
+    def _saved_env(self):
+        "Return the env the last worker was started with, or {}"
+        try:
+            return json.load(open(self.env_file))
+        except (IOError, ValueError):
+            return {}
+
+    def _save_env(self, env):
+        file = open("%s.tmp" % self.env_file, 'w')
+        json.dump(env, file)
+        file.close()
+        os.rename("%s.tmp" % self.env_file, self.env_file)
+
+    def _queue_file(self, branch):
+        return "%s/%s" % (self.queue_dir, urllib.quote(branch, safe=''))
+
+    def _read_queue_file(self, filename):
+        try:
+            return [ tuple(line.split()) for line in open(filename) if line.strip() ]
+        except IOError:
+            return []
+
+    def _write_status(self, sha, status, branch, description=""):
+        filename = "%s/%s" % (self.status_dir, sha)
+        file = open("%s.tmp" % filename, 'w')
+        json.dump({
+            "sha":         sha,
+            "branch":      branch,
+            "status":      status,
+            "description": description,
+            "updated":     time.time(),
+        }, file)
+        file.close()
+        os.rename("%s.tmp" % filename, filename)
+
+    def enqueue(self, remote, branch, sha):
+        """Queue sha, the new tip of branch, to be pushed to remote
+
+        Returns immediately, the push happens in the worker.
+        """
+        self._write_status(sha, "pending", branch)
+        with self.lock:
+            file = open(self._queue_file(branch), 'a')
+            file.write("%s %s\n" % (remote, sha))
+            file.close()
+        self.wakeup.set()
+
+    def status(self, sha):
+        """Return the push status of sha as a dict, or None if it was never queued
+
+        The dict has the keys sha, branch, status, description and
+        updated (a Unix timestamp).
+        """
+        try:
+            return json.load(open("%s/%s" % (self.status_dir, sha)))
+        except (IOError, ValueError):
+            return None
+
+    def pending(self):
+        "Return a dict mapping queued branches to their queued SHAs"
+        queued = {}
+        for name in os.listdir(self.queue_dir):
+            entries = self._read_queue_file("%s/%s" % (self.queue_dir, name))
+            if entries:
+                queued[urllib.unquote(name)] = [ sha for remote, sha in entries ]
+        return queued
+
+    def discard(self, branch, status, description=""):
+        """Drop the queued pushes of branch, setting their status
+
+        This is used when the commits reached the remote some other
+        way, e.g. as part of a merge, and pushing the branch itself
+        would recreate it.
+        """
+        with self.lock:
+            filename = self._queue_file(branch)
+            entries  = self._read_queue_file(filename)
+            if os.path.exists(filename):
+                os.remove(filename)
+        for remote, sha in entries:
+            self._write_status(sha, status, branch, description)
+
+    def _dequeue(self, filename, entries):
+        "Remove entries from a queue file, keeping anything queued since"
+        with self.lock:
+            remaining = self._read_queue_file(filename)[len(entries):]
+            if remaining:
+                file = open(filename, 'w')
+                file.writelines([ "%s %s\n" % entry for entry in remaining ])
+                file.close()
+            elif os.path.exists(filename):
+                os.remove(filename)
+
+    def process(self, env={}):
+        """Push every queued branch once
+
+        All commits queued for a branch are covered by a single push
+        of its current tip, and all queued branches of a remote are
+        pushed together, over one connection. If that fails, they are
+        pushed one by one to find out which of them failed. A failed
+        push stays in the queue, so it is retried the next time.
+
+        A branch which no longer exists locally, e.g. because it was
+        merged and deleted, can never be pushed, so its commits are
+        "dropped" from the queue instead.
+        Returns the number of branches pushed.
+        """
+        queued = {}
+        for name in os.listdir(self.queue_dir):
+            entries = self._read_queue_file("%s/%s" % (self.queue_dir, name))
+            if entries:
+                branch = urllib.unquote(name)
+                if self.branch_exists(branch):
+                    queued[branch] = entries
+                else:
+                    self.discard(branch, "dropped", "Branch %s no longer exists" % branch)
+
+        branches_of = {}
+        for branch, entries in queued.items():
+            for remote, sha in entries:
+                branches_of.setdefault(remote, set()).add(branch)
+
+        # (remote, branch) -> why pushing it failed
+        failed = {}
+        for remote, branches in sorted(branches_of.items()):
+            branches = sorted(branches)
+            try:
+                self.push(remote, env, branches)
+            except Exception:
+                for branch in branches:
+                    try:
+                        self.push(remote, env, branch)
+                    except Exception, e:
+                        failed[(remote, branch)] = str(e)
+
+        for branch, entries in queued.items():
+            for remote, sha in entries:
+                if (remote, branch) in failed:
+                    self._write_status(sha, "failed", branch, failed[(remote, branch)])
+                else:
+                    self._write_status(sha, "pushed", branch)
+            if not [ remote for remote, sha in entries if (remote, branch) in failed ]:
+                self._dequeue(self._queue_file(branch), entries)
+
+        self._expire_statuses()
+        return sum([ len(branches) for branches in branches_of.values() ]) - len(failed)
+
+    def _expire_statuses(self):
+        cutoff = time.time() - self.status_ttl
+        for name in os.listdir(self.status_dir):
+            filename = "%s/%s" % (self.status_dir, name)
+            try:
+                if os.path.getmtime(filename) < cutoff:
+                    os.remove(filename)
+            except OSError:
+                pass
+
+    def start_worker(self, env={}):
+        """Start a background thread which pushes queued branches
+
+        It runs process() whenever something is enqueued, or every
+        poll_interval seconds. Calling this again is harmless. env is
+        saved, so pushes queued before a restart can be resumed with
+        it.
+        """
+        if self.worker and self.worker.is_alive():
+            return
+
+        if env != self._saved_env():
+            self._save_env(env)
+
+        def work():
+            while True:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                try:
+                    self.worker_lock.acquire()
+                except LockError:
+                    # another process is pushing
+                    continue
+                try:
+                    self.process(env)
+                except Exception:
+                    logging.exception("Pushing the queued branches of %s failed" % self.repo)
+                finally:
+                    self.worker_lock.release()
+
+        self.worker = threading.Thread(target=work, name="push queue worker for %s" % self.repo)
+        self.worker.daemon = True
+        self.worker.start()
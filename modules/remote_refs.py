@@ -0,0 +1,74 @@
+import time
+import threading
+
+class RemoteRefs(object):
+    """A cache of the branches on each remote and the SHAs of their tips
+
+    Example:
+    refs = RemoteRefs(ls_remote=ls_remote, ttl=30)
+    refs.get("origin", "leto_study_12")
+
+    where ls_remote(remote, env) returns a dict mapping every branch on
+    remote to its SHA, like GitData.ls_remote. All branches of a remote
+    are listed at once, and the listing is reused for ttl seconds, so
+    most lookups don't talk to the remote at all.
+
+    What we push and fetch ourselves is recorded with update(), which
+    keeps the cache right in between listings. Changes made by others
+    are seen within ttl seconds.
+    """
+    def __init__(self, ls_remote, ttl=30):
+        self.ls_remote = ls_remote
+        self.ttl       = ttl
+        # remote -> (time it was listed, { branch: sha })
+        self.remotes   = {}
+        self.lock      = threading.Lock()
+
+    def branches(self, remote, env={}):
+        "Return a dict of the branches on remote and their SHAs"
+        with self.lock:
+            listed, branches = self.remotes.get(remote, (None, None))
+        if listed is None or time.time() - listed > self.ttl:
+            listed   = time.time()
+            branches = self.ls_remote(remote, env)
+            with self.lock:
+                self.remotes[remote] = (listed, branches)
+        return dict(branches)
+
+    def get(self, remote, branch, env={}):
+        "Return the SHA of branch on remote, or None if it does not exist there"
+        return self.branches(remote, env).get(branch)
+
+    def put(self, remote, branches):
+        """Record a complete listing of the branches on remote
+
+        branches maps every branch to its SHA, as from a fetch of all
+        branches. It is trusted for ttl seconds, like one made by
+        ls_remote.
+        """
+        with self.lock:
+            self.remotes[remote] = (time.time(), dict(branches))
+
+    def update(self, remote, branch, sha):
+        """Record that branch on remote is now at sha
+
+        A sha of None means that branch was deleted. Nothing is
+        recorded for a remote which has not been listed yet, since
+        the other branches on it are not known.
+        """
+        with self.lock:
+            if remote not in self.remotes:
+                return
+            listed, branches = self.remotes[remote]
+            if sha is None:
+                branches.pop(branch, None)
+            else:
+                branches[branch] = sha
+
+    def invalidate(self, remote=None):
+        "Forget what we know about remote, or about all remotes"
+        with self.lock:
+            if remote is None:
+                self.remotes.clear()
+            else:
+                self.remotes.pop(remote, None)
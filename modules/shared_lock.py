@@ -0,0 +1,48 @@
+import time
+import fcntl
+from locket import LockError
+
+class SharedLock(object):
+    """A lock file which many can hold at once, or one alone
+
+    Example:
+    lock = SharedLock("/srv/treenexus/.git/API_MAINTENANCE.lock", shared=True, timeout=30)
+    lock.acquire()
+    ...
+    lock.release()
+
+    Shared holders only exclude an exclusive holder (shared=False),
+    who excludes everyone else, like a readers-writer lock across
+    processes and threads. It is a flock() of the file, as with
+    locket, so it is released when the process dies. Like a locket
+    lock, acquiring it gives up with a LockError after timeout
+    seconds (0 means trying once, None waiting forever).
+    """
+    retry_period = 0.05
+
+    def __init__(self, filename, shared=False, timeout=None):
+        self.filename = filename
+        self.shared   = shared
+        self.timeout  = timeout
+        self.file     = None
+
+    def acquire(self):
+        mode    = self.shared and fcntl.LOCK_SH or fcntl.LOCK_EX
+        file    = open(self.filename, 'a')
+        started = time.time()
+        while True:
+            try:
+                fcntl.flock(file.fileno(), mode | fcntl.LOCK_NB)
+                self.file = file
+                return
+            except IOError:
+                if self.timeout is not None and time.time() - started >= self.timeout:
+                    file.close()
+                    raise LockError("Couldn't lock %s" % self.filename)
+                time.sleep(self.retry_period)
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
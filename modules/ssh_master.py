@@ -0,0 +1,131 @@
+"""Shared SSH connections for git remote operations
+
+Every "git fetch" or "git push" over SSH normally opens a new
+connection, paying for a TCP and SSH handshake each time. With the
+OpenSSH ControlMaster option, the first connection to a host becomes
+a master which listens on a control socket, and later connections go
+through it instead. ControlPersist keeps the master running for a
+while after the last connection closed, and then it exits by itself.
+
+bin/git.sh turns this on when SSH_CONTROL_PATH is in its environment.
+There is one control socket per deploy key and host, so connections
+made with different keys are never mixed up.
+
+Example:
+master = SSHMaster("git@github.com:OpenTreeOfLife/treenexus.git", pkey)
+env["SSH_CONTROL_PATH"] = master.control_path
+master.check()
+"""
+import os
+import re
+import stat
+import errno
+import hashlib
+import tempfile
+import subprocess
+
+# where the control sockets live. Unix sockets have a short maximum
+# path length (about 100 bytes), so this is not inside the repo
+CONTROL_DIR     = os.path.join(tempfile.gettempdir(), "opentree-ssh-%d" % os.getuid())
+
+# seconds an idle master connection is kept open
+CONTROL_PERSIST = 300
+
+_ssh_url_re = re.compile(r"^ssh://(?:([^@/]+)@)?([^:/]+)(?::(\d+))?/")
+_scp_url_re = re.compile(r"^(?:([^@/]+)@)?([^:/]+):(?!//)")
+
+def ssh_destination(url):
+    """Return (user, host, port) for an SSH remote URL, or None
+
+    Both ssh://user@host:port/path and the scp-like user@host:path are
+    understood. user and port are None if the URL does not give them.
+    Other URLs (file://, https://, a local path) don't use SSH, so None
+    is returned for them.
+    """
+    mo = _ssh_url_re.match(url)
+    if mo:
+        user, host, port = mo.groups()
+        return (user, host, port and int(port))
+    if "://" in url:
+        return None
+    mo = _scp_url_re.match(url)
+    if mo:
+        user, host = mo.groups()
+        return (user, host, None)
+    return None
+
+class SSHMaster(object):
+    """The shared SSH connection to the host of a remote URL
+
+    url is the URL of the remote and pkey the path of the private key
+    used to connect (or None for the default key). is_ssh is false if
+    the URL does not use SSH, in which case there is nothing to share
+    and check() and stop() do nothing.
+    """
+    def __init__(self, url, pkey=None, control_dir=CONTROL_DIR):
+        self.url          = url
+        self.pkey         = pkey
+        self.destination  = ssh_destination(url)
+        self.is_ssh       = self.destination is not None
+        self.control_dir  = control_dir
+        self.control_path = None
+
+        if self.is_ssh:
+            user, host, port = self.destination
+            key = "%s %s@%s:%s" % (pkey or "", user or "", host, port or "")
+            self.control_path = "%s/%s" % (control_dir, hashlib.sha1(key).hexdigest()[:16])
+
+    def _ssh_args(self, command):
+        user, host, port = self.destination
+        args = [ "ssh", "-oControlPath=%s" % self.control_path, "-O", command ]
+        if port:
+            args += [ "-p", str(port) ]
+        if user:
+            args += [ "-l", user ]
+        return args + [ host ]
+
+    def _control(self, command):
+        "Send command to the master, returning true if it was running"
+        devnull = open(os.devnull, 'w')
+        try:
+            return subprocess.call(self._ssh_args(command), stdout=devnull, stderr=devnull) == 0
+        finally:
+            devnull.close()
+
+    def prepare(self):
+        """Get ready for a new connection, and return the control path
+
+        Creates the control directory, readable only by us, and
+        removes a stale control socket left behind by a master which
+        died, since ssh won't start a new master on top of it.
+        """
+        if not self.is_ssh:
+            return None
+        try:
+            os.makedirs(self.control_dir, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if os.path.exists(self.control_path) and not self.check():
+            try:
+                os.remove(self.control_path)
+            except OSError:
+                pass
+        return self.control_path
+
+    def check(self):
+        "Return true if a master connection is up and answering"
+        if not self.is_ssh or not os.path.exists(self.control_path):
+            return False
+        if not stat.S_ISSOCK(os.stat(self.control_path).st_mode):
+            return False
+        return self._control("check")
+
+    def stop(self):
+        """Close the master connection now, instead of when it is idle
+
+        Returns true if there was a master to close.
+        """
+        if not self.check():
+            return False
+        return self._control("exit")
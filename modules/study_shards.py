@@ -0,0 +1,90 @@
+"""Splitting very large studies into shards
+
+Studies bigger than a threshold are stored as
+
+    study/N/N-0.json
+    study/N/N-1.json
+    ...
+
+where the concatenation of the shards, in numeric order, is exactly
+the JSON of the study. So reading a sharded study is just streaming
+its shards one after the other.
+
+Studies are written with json.dumps(..., indent=0), which puts every
+element of an array or object on a new line. A comma at the end of a
+line can't be inside a string, since JSON strings can't contain a raw
+newline, so the start of the next line is always the start of a
+sibling element (an OTU, a tree, a node, an edge, ...). Shards are
+only cut there.
+
+Which of those places are used is decided by a hash of the text that
+follows them (content-defined chunking), not by the offset in the
+file. An edit in one part of a study therefore only changes the
+shards around it, and every other shard keeps its blob SHA.
+"""
+import re
+import zlib
+
+# the size of shard we aim for
+SHARD_SIZE     = 16 * 1024 * 1024
+
+# roughly how many bytes there are between places we can cut, in NexSON
+CUT_SPACING    = 32
+# how many bytes after a cut are hashed to decide if we cut there
+WINDOW         = 64
+
+_cut_re   = re.compile(r",[ \t]*\n")
+_shard_re = re.compile(r"^(.+)-(\d+)\.json$")
+
+def split_study(content, shard_size=SHARD_SIZE, min_size=None, max_size=None):
+    """Split the JSON text of a study into a list of shards
+
+    The shards are cut after a line ending in a comma, aiming for
+    shard_size bytes, never less than min_size (except the last one)
+    and not more than max_size unless there is nowhere to cut. The
+    concatenation of the shards is always content.
+    """
+    if min_size is None:
+        min_size = shard_size / 4
+    if max_size is None:
+        max_size = shard_size * 2
+    divisor = max(1, (shard_size - min_size) / CUT_SPACING)
+
+    shards = []
+    start  = 0
+    while len(content) - start > min_size:
+        cut  = None
+        last = None
+        for m in _cut_re.finditer(content, start + min_size, min(start + max_size, len(content) - 1)):
+            last = m.end()
+            if (zlib.crc32(content[last:last + WINDOW]) & 0xffffffff) % divisor == 0:
+                cut = last
+                break
+        if cut is None:
+            if len(content) - start <= max_size or last is None:
+                break
+            # no natural place to cut, so cut as late as we can
+            cut = last
+        shards.append(content[start:cut])
+        start = cut
+
+    shards.append(content[start:])
+    return shards
+
+def shard_filename(study_id, number):
+    "Return the file name of a shard of study_id"
+    return "%s-%d.json" % (study_id, number)
+
+def sort_shards(study_id, filenames):
+    """Return the names of the shards of study_id in filenames, in order
+
+    Other file names are ignored. Shards are sorted numerically, so
+    N-10.json comes after N-9.json.
+    """
+    shards = []
+    for filename in filenames:
+        mo = _shard_re.match(filename)
+        if mo and mo.group(1) == str(study_id):
+            shards.append((int(mo.group(2)), filename))
+    shards.sort()
+    return [ filename for number, filename in shards ]
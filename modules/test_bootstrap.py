@@ -0,0 +1,100 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import subprocess
+from bootstrap import clone, validate, prefetch_blobs
+from gitdata import GitData
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        self.dir    = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, "source")
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        env = dict(os.environ, GIT_AUTHOR_NAME="t", GIT_AUTHOR_EMAIL="t@t",
+            GIT_COMMITTER_NAME="t", GIT_COMMITTER_EMAIL="t@t")
+        # a remote with three revisions of three studies
+        subprocess.check_call(["git", "init", "-q", "-b", "master", self.source])
+        subprocess.check_call(["git", "config", "uploadpack.allowFilter", "true"], cwd=self.source)
+        for study_id in range(1, 4):
+            os.makedirs("%s/study/%d" % (self.source, study_id))
+        for revision in range(3):
+            for study_id in range(1, 4):
+                open("%s/study/%d/%d.json" % (self.source, study_id, study_id), 'w').write('{"study": %d, "revision": %d}' % (study_id, revision))
+            open("%s/README.md" % self.source, 'w').write("revision %d" % revision)
+            subprocess.check_call(["git", "add", "-A"], cwd=self.source)
+            subprocess.check_call(["git", "commit", "-q", "-m", "revision %d" % revision], cwd=self.source, env=env)
+        self.url = "file://%s" % self.source
+
+        for name in [ "GIT_COMMITTER_NAME", "GIT_COMMITTER_EMAIL" ]:
+            if name not in os.environ:
+                os.environ[name] = env[name]
+                self.addCleanup(os.environ.pop, name)
+
+    def missing(self, repo, *args):
+        objects = subprocess.check_output(["git", "rev-list", "--objects", "--missing=print"] + list(args), cwd=repo)
+        return [ line for line in objects.splitlines() if line.startswith("?") ]
+
+    def test_sparse(self):
+        repo = os.path.join(self.dir, "sparse")
+        clone(self.url, repo, history="lazy")
+        self.assertEqual(self.missing(repo, "--no-walk", "master"), [], "the blobs of master were fetched")
+        self.assertEqual(len(self.missing(repo, "master")), 8, "older blobs were not")
+        self.assertEqual(sorted(os.listdir(repo)), [".git", "README.md"])
+
+        for check, ok, detail in validate(repo):
+            self.assertTrue(ok, "%s: %s" % (check, detail))
+
+        # an old revision is fetched when it is read
+        self.assertEqual(GitData(repo=repo).fetch_study(2, "master~2"), '{"study": 2, "revision": 0}')
+        self.assertEqual(prefetch_blobs(repo, "origin", "master"), 0)
+
+    def test_no_checkout(self):
+        repo = os.path.join(self.dir, "none")
+        clone(self.url, repo, checkout="none")
+        self.assertEqual(os.listdir(repo), [".git"])
+        self.assertEqual(self.missing(repo, "master"), [], "every revision was cloned")
+        self.assertEqual(subprocess.check_output(["git", "status", "--porcelain"], cwd=repo), "")
+        for check, ok, detail in validate(repo):
+            self.assertTrue(ok, "%s: %s" % (check, detail))
+
+    def test_validate(self):
+        repo = os.path.join(self.dir, "full")
+        clone(self.url, repo, checkout="full")
+        self.assertTrue(os.path.exists("%s/study/1/1.json" % repo))
+        results = validate(repo, branch="no_such_branch")
+        self.assertFalse(results[0][1], "a missing branch fails validation")
+
+        # API studies like study/o7 come after study/3
+        os.makedirs("%s/study/o7" % repo)
+        open("%s/study/o7/o7.json" % repo, 'w').write('{"study": "o7"}')
+        subprocess.check_call(["git", "add", "-A"], cwd=repo)
+        subprocess.check_call(["git", "commit", "-q", "-m", "o7", "--author", "t <t@t>"], cwd=repo)
+        results = dict([ (check, (ok, detail)) for check, ok, detail in validate(repo) ])
+        self.assertTrue(results["last study id"][0], results["last study id"][1])
+        self.assertTrue(results["last study id"][1].startswith("o7 "))
+        self.assertTrue(results["study SHA"][0], results["study SHA"][1])
+        self.assertTrue(results["read study o7"][0], results["read study o7"][1])
+
+        # and an empty study fails
+        open("%s/study/o7/o7.json" % repo, 'w').write('')
+        subprocess.check_call(["git", "commit", "-q", "-a", "-m", "empty o7", "--author", "t <t@t>"], cwd=repo)
+        results = dict([ (check, (ok, detail)) for check, ok, detail in validate(repo) ])
+        self.assertFalse(results["read study o7"][0], "an empty study fails validation")
+        self.assertRaises(ValueError, clone, self.url, os.path.join(self.dir, "bad"), checkout="some")
+        self.assertRaises(ValueError, clone, self.url, os.path.join(self.dir, "bad"), history="some")
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestBootstrap)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
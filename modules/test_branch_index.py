@@ -0,0 +1,78 @@
+import unittest
+import sys
+from branch_index import BranchIndex, parse_wip_branch
+
+class TestBranchIndex(unittest.TestCase):
+    def setUp(self):
+        self.listings = 0
+        self.counted  = []
+        self.refs     = { "master": "a" * 40, "leto_study_12": "b" * 40,
+                          "jessica_study_12": "c" * 40, "paul_study_o7": "d" * 40 }
+        self.current_stamp = 1
+        def list_branches():
+            self.listings += 1
+            return dict(self.refs)
+        def ahead_behind(sha, base_sha):
+            self.counted.append(sha)
+            return (1, 2)
+        self.index = BranchIndex(list_branches, lambda: self.current_stamp, ahead_behind)
+
+    def test_parse_wip_branch(self):
+        self.assertEqual(parse_wip_branch("leto_study_12"), ("leto", "12"))
+        self.assertEqual(parse_wip_branch("paul_study_o7"), ("paul", "o7"))
+        self.assertEqual(parse_wip_branch("master"), None)
+
+    def test_study_branches(self):
+        self.assertEqual([ b["branch"] for b in self.index.study_branches("12") ],
+            [ "jessica_study_12", "leto_study_12" ])
+        self.assertEqual(self.index.study_branches("12")[1],
+            { "curator": "leto", "branch": "leto_study_12", "sha": "b" * 40, "ahead": 1, "behind": 2 })
+        self.assertEqual(self.index.study_branches("13"), [])
+        self.assertEqual(sorted(self.index.study_ids()), [ "12", "o7" ])
+        self.assertEqual(self.listings, 1, "branches are listed once")
+        self.assertEqual(sorted(self.counted), [ "b" * 40, "c" * 40 ], "counts are remembered")
+
+    def test_stamp(self):
+        self.assertEqual(self.index.sha("leto_study_12"), "b" * 40)
+        self.refs["leto_study_12"] = "e" * 40
+        self.assertEqual(self.index.sha("leto_study_12"), "b" * 40)
+        self.current_stamp = 2
+        self.assertEqual(self.index.sha("leto_study_12"), "e" * 40)
+        self.assertEqual(self.listings, 2)
+
+    def test_update(self):
+        # nothing is recorded before the first listing
+        self.index.update("leto_study_13", "e" * 40)
+        self.assertEqual(self.listings, 0)
+
+        self.assertEqual(self.index.sha("leto_study_13"), None)
+        self.index.update("leto_study_13", "e" * 40)
+        self.index.update("leto_study_12", None)
+        self.index.update("jessica_study_12", None)
+        self.assertEqual(self.index.sha("leto_study_13"), "e" * 40)
+        self.assertEqual([ b["branch"] for b in self.index.study_branches("13") ], [ "leto_study_13" ])
+        self.assertEqual(sorted(self.index.study_ids()), [ "13", "o7" ])
+        self.assertEqual(self.listings, 1)
+
+        self.index.invalidate()
+        self.assertEqual(self.index.sha("leto_study_13"), None)
+        self.assertEqual(self.listings, 2)
+
+    def test_master_moved(self):
+        self.index.study_branches("12")
+        self.index.update("master", "f" * 40)
+        self.index.study_branches("12")
+        self.assertEqual(len(self.counted), 4, "counts are by the SHA of master too")
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestBranchIndex)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
@@ -2,7 +2,14 @@ import unittest
 import os
 import sys
 import time
-from gitdata import GitData, MergeException
+import shutil
+import tempfile
+import gzip
+import tarfile
+from cStringIO import StringIO
+from gitdata import GitData, MergeException, GitVersionError, MIN_GIT_VERSION, git_version, check_git_version
+from locket import LockError
+from shared_lock import SharedLock
 import simplejson as json
 from sh import git
 from ConfigParser import SafeConfigParser
@@ -96,8 +103,325 @@ class TestGitData(unittest.TestCase):
         git.add("foo.txt")
         git.commit("-m","Test commit")
 
+        to_merge_2 = self.gd.branch_sha("to_merge_2")
+
+        # a dry run finds the conflict, and remembers it
+        check = self.gd.merge_check("to_merge_1", "to_merge_2")
+        self.assertFalse( check["mergeable"] )
+        self.assertEqual( [ "foo.txt" ], [ c["path"] for c in check["conflicts"] ] )
+        self.assertEqual( to_merge_2, check["base_sha"] )
+        hits = self.gd.cache_stats()["merge_checks"]["hits"]
+        self.assertEqual( check, self.gd.merge_check("to_merge_1", "to_merge_2") )
+        self.assertEqual( hits + 1, self.gd.cache_stats()["merge_checks"]["hits"] )
+        self.assertEqual( None, self.gd.merge_check("to_merge_1", "no_such_branch") )
+
         self.assertRaises(MergeException, lambda:  self.gd.merge("to_merge_1", "to_merge_2") )
 
+        # the conflicts are reported, and nothing was changed
+        try:
+            self.gd.merge("to_merge_1", "to_merge_2")
+        except MergeException, e:
+            self.assertEqual( [ "foo.txt" ], [ c["path"] for c in e.conflicts ] )
+            self.assertEqual( None, e.conflicts[0]["base"] )
+            self.assertEqual( git("rev-parse", "to_merge_2:foo.txt").strip(), e.conflicts[0]["ours"] )
+            self.assertEqual( git("rev-parse", "to_merge_1:foo.txt").strip(), e.conflicts[0]["theirs"] )
+            self.assertEqual( [ "CONFLICT (contents)" ], e.conflicts[0]["types"] )
+        self.assertEqual( to_merge_2, self.gd.branch_sha("to_merge_2") )
+        self.assertTrue( self.gd.branch_exists("to_merge_1") )
+        self.assertEqual( "XYZ\n", open("foo.txt").read(), "the working tree is untouched" )
+
+    def test_merge_nexson(self):
+        author = "John Doe <john@doe.com>"
+        branches = [ "merge_nexson_base", "johndoe_study_9989", "janedoe_study_9989" ]
+        def cleanup_merge_nexson():
+            for branch in branches:
+                if self.gd.branch_exists(branch):
+                    git.branch("-D", branch)
+
+        self.addCleanup(cleanup_merge_nexson)
+
+        def study(labels):
+            otus = [ { "@id": "otu_%s" % label.lower(), "@label": label } for label in labels ]
+            return json.dumps({ "nexml": { "otus": { "@id": "otus1", "otu": otus } } }, sort_keys=True, indent=0)
+
+        git.branch("merge_nexson_base", "master")
+        self.gd.write_study(9989, study([ "a", "b" ]), "merge_nexson_base", author)
+        git.branch("johndoe_study_9989", "merge_nexson_base")
+        git.branch("janedoe_study_9989", "merge_nexson_base")
+        self.gd.write_study(9989, study([ "a", "b", "c" ]), "johndoe_study_9989", author)
+        self.gd.write_study(9989, study([ "a", "b", "d" ]), "janedoe_study_9989", author)
+
+        # both added an OTU at the same place, which a line-based merge can't do
+        self.gd.merge("johndoe_study_9989", "merge_nexson_base")
+        self.assertEqual( "nexson", git("check-attr", "merge", "study/9989/9989.json").strip().split(": ")[-1] )
+        self.gd.merge("janedoe_study_9989", "merge_nexson_base")
+        self.assertEqual( json.loads(study([ "a", "b", "c", "d" ])), json.loads(self.gd.fetch_study(9989, "merge_nexson_base")) )
+
+        # a real conflict is reported as a place in the study
+        git.branch("johndoe_study_9989", "merge_nexson_base")
+        git.branch("janedoe_study_9989", "merge_nexson_base")
+        self.gd.write_study(9989, study([ "a", "b", "c", "d" ]).replace('"@label": "a"', '"@label": "X"'), "johndoe_study_9989", author)
+        self.gd.write_study(9989, study([ "a", "b", "c", "d" ]).replace('"@label": "a"', '"@label": "Y"'), "janedoe_study_9989", author)
+        self.gd.merge("johndoe_study_9989", "merge_nexson_base")
+        try:
+            self.gd.merge("janedoe_study_9989", "merge_nexson_base")
+            self.fail("the merge has a conflict")
+        except MergeException, e:
+            self.assertEqual( "study/9989/9989.json", e.conflicts[0]["path"] )
+            self.assertEqual( [ "nexml/otus/otu[@id=otu_a]/@label" ], e.conflicts[0]["nexson"] )
+
+    def test_merge_in_memory(self):
+        author = "John Doe <john@doe.com>"
+        def cleanup_merge_in_memory():
+            for branch in [ "johndoe_study_9991", "merge_base" ]:
+                if self.gd.branch_exists(branch):
+                    git.branch("-D", branch)
+
+        self.addCleanup(cleanup_merge_in_memory)
+
+        git.checkout("master")
+        head     = self.gd.branch_sha("master")
+        git.branch("merge_base", "master")
+        base_sha = self.gd.write_study(9990,'{"foo":"base"}',"merge_base",author)
+        wip_sha  = self.gd.write_study(9991,'{"foo":"wip"}',"johndoe_study_9991",author)
+
+        check = self.gd.merge_check("johndoe_study_9991", "merge_base")
+        self.assertTrue( check["mergeable"] )
+        self.assertFalse( check["already_merged"] )
+        self.assertEqual( base_sha, self.gd.branch_sha("merge_base"), "a merge check changes nothing" )
+        self.assertTrue( self.gd.merge_check("merge_base", "johndoe_study_9991")["mergeable"] )
+        self.assertTrue( self.gd.merge_check("master", "merge_base")["already_merged"] )
+
+        new_sha = self.gd.merge("johndoe_study_9991", "merge_base")
+        self.assertEqual( new_sha, self.gd.branch_sha("merge_base") )
+        self.assertEqual( [ base_sha, wip_sha ], git("rev-parse", "%s^1" % new_sha, "%s^2" % new_sha).split() )
+        self.assertEqual( "Merge branch 'johndoe_study_9991' into merge_base", git("--no-pager", "log", "-1", "--format=%s", new_sha).strip() )
+        self.assertEqual( '{"foo":"wip"}', self.gd.fetch_study(9991, "merge_base") )
+        self.assertEqual( '{"foo":"base"}', self.gd.fetch_study(9990, "merge_base") )
+        self.assertFalse( self.gd.branch_exists("johndoe_study_9991"), "the WIP branch was deleted" )
+        self.assertEqual( "master", self.gd.current_branch() )
+        self.assertEqual( head, self.gd.branch_sha("master") )
+
+    def test_git_version(self):
+        self.assertTrue( git_version() >= MIN_GIT_VERSION )
+        self.assertEqual( git_version(), check_git_version() )
+        self.assertEqual( (2, 38), check_git_version((2, 38)) )
+        self.assertRaises( GitVersionError, check_git_version, (2, 37, 9) )
+        self.assertRaises( GitVersionError, check_git_version, (1, 8) )
+
+    def test_merge_many(self):
+        author = "John Doe <john@doe.com>"
+        branches = [ "johndoe_study_9981", "johndoe_study_9982", "johndoe_study_9983", "johndoe_study_9984" ]
+        def cleanup_merge_many():
+            for branch in branches + [ "merge_base" ]:
+                if self.gd.branch_exists(branch):
+                    git.branch("-D", branch)
+
+        self.addCleanup(cleanup_merge_many)
+
+        git.branch("merge_base", "master")
+        base_sha = self.gd.write_study(9980,'{"foo":"base"}',"merge_base",author)
+        self.gd.write_study(9981,'{"foo":"one"}',branches[0],author)
+        self.gd.write_study(9980,'{"foo":"conflict"}',branches[1],author)
+        self.gd.write_study(9983,'{"foo":"three"}',branches[2],author)
+
+        self.assertRaises(ValueError, self.gd.merge_many, branches, "merge_base", "ignore")
+
+        new_sha, results = self.gd.merge_many(branches, "merge_base", "stop")
+        self.assertEqual( [ "merged", "conflict", "not_attempted", "not_attempted" ], [ r["status"] for r in results ] )
+        self.assertEqual( [ "study/9980/9980.json" ], [ c["path"] for c in results[1]["conflicts"] ] )
+        self.assertEqual( new_sha, self.gd.branch_sha("merge_base") )
+        self.assertEqual( base_sha, git("rev-parse", "%s^1" % new_sha).strip() )
+        self.assertFalse( self.gd.branch_exists(branches[0]) )
+        self.assertTrue( self.gd.branch_exists(branches[1]) )
+
+        git.branch(branches[0], base_sha)
+        new_sha, results = self.gd.merge_many(branches, "merge_base", "skip")
+        self.assertEqual( [ "already_merged", "conflict", "merged", "missing" ], [ r["status"] for r in results ] )
+        self.assertEqual( None, results[3]["sha"] )
+        self.assertEqual( 1, len(git("rev-list", "--merges", "%s^1..%s" % (new_sha, new_sha)).split()), "the base is moved once per call" )
+        self.assertEqual( '{"foo":"three"}', self.gd.fetch_study(9983, "merge_base") )
+        self.assertEqual( '{"foo":"one"}', self.gd.fetch_study(9981, "merge_base") )
+        self.assertEqual( '{"foo":"base"}', self.gd.fetch_study(9980, "merge_base") )
+        self.assertEqual( [ branches[1] ], [ b for b in branches if self.gd.branch_exists(b) ] )
+
+        # a branch given twice is merged once
+        sha = self.gd.write_study(9984,'{"foo":"four"}',branches[3],author)
+        new_sha, results = self.gd.merge_many([ branches[3], branches[3] ], "merge_base")
+        self.assertEqual( [ (branches[3], "merged", True) ], [ (r["branch"], r["status"], r["deleted"]) for r in results ] )
+        self.assertEqual( new_sha, self.gd.branch_sha("merge_base") )
+        self.assertFalse( self.gd.branch_exists(branches[3]) )
+
+        # once the base moved, a branch which cannot be deleted is left behind
+        sha = self.gd.write_study(9985,'{"foo":"five"}',branches[3],author)
+        delete_branch = self.gd.delete_branch
+        def failing_delete(branch, old_sha):
+            git("update-ref", "-d", "refs/heads/%s" % branch, base_sha)
+        self.gd.delete_branch = failing_delete
+        try:
+            new_sha, results = self.gd.merge_many([ branches[3] ], "merge_base")
+        finally:
+            self.gd.delete_branch = delete_branch
+        self.assertEqual( [ ("merged", False) ], [ (r["status"], r["deleted"]) for r in results ] )
+        self.assertEqual( new_sha, self.gd.branch_sha("merge_base") )
+        self.assertEqual( sha, self.gd.branch_sha(branches[3]) )
+
+    def test_study_branches(self):
+        author = "John Doe <john@doe.com>"
+        def cleanup_study_branches():
+            for branch in [ "johndoe_study_9971", "janedoe_study_9971" ]:
+                if self.gd.branch_exists(branch):
+                    git.branch("-D", branch)
+
+        self.addCleanup(cleanup_study_branches)
+
+        self.assertEqual( [], self.gd.study_branches(9971) )
+        wip_sha = self.gd.write_study(9971,'{"foo":"wip"}',"johndoe_study_9971",author)
+        self.assertEqual( [{ "curator": "johndoe", "branch": "johndoe_study_9971", "sha": wip_sha, "ahead": 1, "behind": 0 }],
+            self.gd.study_branches(9971) )
+
+        # branches made by other processes are noticed too
+        git.branch("janedoe_study_9971", "%s~1" % wip_sha)
+        self.assertEqual( [ ("janedoe", 0, 0), ("johndoe", 1, 0) ],
+            [ (b["curator"], b["ahead"], b["behind"]) for b in GitData(repo=self.gd.repo).study_branches(9971) ] )
+
+        self.gd.delete_branch("johndoe_study_9971", wip_sha)
+        self.assertFalse( self.gd.branch_exists("johndoe_study_9971") )
+        self.assertEqual( [ ("janedoe", 0, 0) ],
+            [ (b["curator"], b["ahead"], b["behind"]) for b in self.gd.study_branches(9971) ] )
+
+    def test_resolve_ref(self):
+        master_sha = git("rev-parse", "master").strip()
+        tree_sha   = git("rev-parse", "master^{tree}").strip()
+        unknown    = "0123456789" * 4
+        self.assertEqual( master_sha, self.gd.resolve_ref("master") )
+        self.assertEqual( master_sha, self.gd.resolve_ref(master_sha) )
+        self.assertEqual( None, self.gd.resolve_ref(unknown), "an unknown SHA" )
+        self.assertEqual( None, self.gd.resolve_ref(tree_sha), "a SHA which is not a commit" )
+        self.assertEqual( None, self.gd.resolve_ref("no_such_branch") )
+
+        # which callers report as missing, rather than failing
+        for ref in [ unknown, tree_sha ]:
+            self.assertEqual( None, self.gd.study_history(438, ref) )
+            self.assertEqual( None, self.gd.merge_check(ref, "master") )
+            self.assertEqual( None, self.gd.export_studies(ref) )
+            self.assertEqual( None, self.gd.study_sha(438, ref) )
+
+    def test_study_history(self):
+        author = "John Doe <john@doe.com>"
+        def cleanup_study_history():
+            if self.gd.branch_exists("johndoe_study_9961"):
+                git.branch("-D", "johndoe_study_9961")
+            if os.path.exists(self.gd.history_index.filename):
+                os.remove(self.gd.history_index.filename)
+
+        self.addCleanup(cleanup_study_history)
+
+        shas = []
+        for n in range(3):
+            shas.append(self.gd.write_study(9961,'{"foo":%d}' % n,"johndoe_study_9961",author))
+        self.gd.write_study(9962,'{"foo":"other"}',"johndoe_study_9961",author)
+
+        def check_history():
+            self.gd.history_cache.clear()
+            history = self.gd.study_history(9961, "johndoe_study_9961", limit=2)
+            self.assertEqual( self.gd.branch_sha("johndoe_study_9961"), history["sha"] )
+            self.assertEqual( [ shas[2], shas[1] ], [ c["sha"] for c in history["commits"] ] )
+            self.assertEqual( 2, history["next"] )
+            self.assertEqual( "John Doe", history["commits"][0]["author_name"] )
+            self.assertEqual( "john@doe.com", history["commits"][0]["author_email"] )
+            self.assertEqual( "Update Study #9961 via OpenTree API", history["commits"][0]["message"] )
+
+            history = self.gd.study_history(9961, "johndoe_study_9961", skip=2, limit=2)
+            self.assertEqual( [ shas[0] ], [ c["sha"] for c in history["commits"] ] )
+            self.assertEqual( None, history["next"] )
+
+            self.assertEqual( [], self.gd.study_history(9961, "master")["commits"] )
+            self.assertEqual( [], self.gd.study_history(9961, shas[0], skip=1)["commits"] )
+            self.assertEqual( None, self.gd.study_history(9961, "no_such_branch") )
+
+        # with git log, an index of master, which the WIP commits are
+        # added to, and an index of the WIP branch, which master lacks
+        check_history()
+        self.assertEqual( self.gd.branch_sha("master"), self.gd.update_history("master") )
+        check_history()
+        self.gd.update_history("johndoe_study_9961")
+        self.assertEqual( [ shas[2], shas[1], shas[0] ], self.gd.history_index.current()[1]["9961"] )
+        check_history()
+
+    def test_study_diff(self):
+        author = "John Doe <john@doe.com>"
+        def cleanup_study_diff():
+            if self.gd.branch_exists("johndoe_study_9951"):
+                git.branch("-D", "johndoe_study_9951")
+
+        self.addCleanup(cleanup_study_diff)
+
+        old = { "nexml": { "@id": "study", "otus": { "@id": "otus1", "otu": [ { "@id": "otu1", "@label": "A" } ] } } }
+        new = { "nexml": { "@id": "study", "otus": { "@id": "otus1", "otu": [ { "@id": "otu1", "@label": "B" } ] } } }
+        old_sha = self.gd.write_study(9951, json.dumps(old), "johndoe_study_9951", author)
+        new_sha = self.gd.write_study(9951, json.dumps(new), "johndoe_study_9951", author)
+
+        result = self.gd.study_diff(9951, old_sha, "johndoe_study_9951")
+        self.assertEqual( [ { "type": "otu", "id": "otu1", "parent": "otus1", "fields": [ "@label" ] } ], result["modified"] )
+        self.assertEqual( self.gd.study_sha(9951, new_sha), result["new_sha"] )
+        self.assertEqual( result, self.gd.study_diff(9951, old_sha, new_sha), "diffs are cached by study SHAs" )
+
+        result = self.gd.study_diff(9951, "master", new_sha)
+        self.assertEqual( None, result["old_sha"] )
+        self.assertEqual( [ "nexml", "otu", "otus" ], sorted([ change["type"] for change in result["added"] ]) )
+        self.assertEqual( [], self.gd.study_diff(9951, new_sha, new_sha)["modified"] )
+        self.assertEqual( None, self.gd.study_diff(9951, "master", "master") )
+
+        # a ref which does not exist is not a study which does not exist
+        self.assertEqual( None, self.gd.study_diff(438, "no_such_branch_typo", "master") )
+        self.assertEqual( None, self.gd.study_diff(438, "master", "no_such_branch_typo") )
+        self.assertEqual( None, self.gd.study_diff(438, "0123456789" * 4, "master") )
+
+    def test_export_studies(self):
+        author = "John Doe <john@doe.com>"
+        branch = "johndoe_study_9941"
+        def cleanup_export_studies():
+            if self.gd.branch_exists(branch):
+                git.branch("-D", branch)
+
+        self.addCleanup(cleanup_export_studies)
+
+        gd = GitData(repo=self.repo)
+        gd.shard_threshold = 10000
+        gd.shard_size      = 5000
+        elements = [ '{\n"@id": "otu%d", \n"@label": "%s"\n}' % (i, "x" * 100) for i in range(200) ]
+        gd.write_study(9941, '{\n"otu": [\n' + ', \n'.join(elements) + '\n]\n}', branch, author)
+        gd.write_study(9942, '{\n"nexml": {\n"@id": "study"\n}\n}', branch, author)
+        self.assertTrue( len(git("ls-tree", "--name-only", "%s:study/9941" % branch).split()) > 1 )
+
+        lines   = "".join(self.gd.export_studies(branch)).splitlines()
+        studies = [ json.loads(line) for line in lines ]
+        ids     = git("ls-tree", "--name-only", "%s:study" % branch).split()
+        self.assertEqual( ids, [ study["id"] for study in studies ] )
+        for study in studies:
+            self.assertEqual( self.gd.study_sha(study["id"], branch), study["sha"] )
+            self.assertEqual( json.loads(self.gd.fetch_study(study["id"], branch)), study["nexson"] )
+
+        compressed = "".join(self.gd.export_studies(branch, compress=True))
+        self.assertEqual( "\n".join(lines) + "\n", gzip.GzipFile(fileobj=StringIO(compressed)).read() )
+
+        for compress, mode in [ (False, "r:"), (True, "r:gz") ]:
+            archive = tarfile.open(fileobj=StringIO("".join(self.gd.export_studies(branch, "tar", compress))), mode=mode)
+            self.assertEqual( self.gd.fetch_study(9942, branch), archive.extractfile("study/9942/9942.json").read() )
+            self.assertTrue( "study/9941/9941-0.json" in archive.getnames() )
+
+        # a consumer which stops early, like a client which went away, is not an error
+        gd.stream_chunk_size = 512
+        for format in gd.export_formats:
+            chunks = gd.export_studies(branch, format)
+            chunks.next()
+            chunks.close()
+
+        self.assertEqual( None, self.gd.export_studies("no_such_branch") )
+        self.assertEqual( None, self.gd.export_studies("0123456789" * 4), "nor an unknown SHA" )
+        self.assertRaises( ValueError, self.gd.export_studies, branch, "zip" )
+
     def test_current_branch(self):
         git.checkout(self.testing_branch_name)
         branch_name = self.gd.current_branch()
@@ -113,6 +437,170 @@ class TestGitData(unittest.TestCase):
             valid = 0
         self.assertTrue( valid, "fetch_study(%s) returned valid JSON" % study_id)
 
+    def test_fetch_at_ref(self):
+        def cleanup_fetch_at_ref():
+            git.checkout("master")
+            git.branch("-D","johndoe_study_9997")
+
+        self.addCleanup(cleanup_fetch_at_ref)
+
+        study_id = 438
+        master_nexson = self.gd.fetch_study(study_id, "master")
+        self.assertEqual(master_nexson, self.gd.fetch_study(study_id), "master matches the working tree")
+
+        master_sha = git("rev-parse","master").strip()
+        self.assertEqual(master_nexson, self.gd.fetch_study(study_id, master_sha), "fetch by SHA")
+
+        author   = "John Doe <john@doe.com>"
+        content  = '{"foo":"baz"}'
+        self.gd.write_study(9997,content,"johndoe_study_9997",author)
+        git.checkout("master")
+
+        self.assertEqual(content, self.gd.fetch_study(9997, "johndoe_study_9997"), "read from a branch that is not checked out")
+        self.assertEqual('', self.gd.fetch_study(9997, "master"), "study does not exist on master")
+        self.assertEqual('', self.gd.fetch_study(study_id, "nothisdoesnotexist"), "non-existent ref")
+
+    def test_fetch_cache(self):
+        def cleanup_fetch_cache():
+            git.branch("-D","johndoe_study_9995")
+
+        self.addCleanup(cleanup_fetch_cache)
+
+        author   = "John Doe <john@doe.com>"
+        branch   = "johndoe_study_9995"
+        self.gd.write_study(9995,'{"foo":"one"}',branch,author)
+        self.assertEqual('{"foo":"one"}', self.gd.fetch_study(9995, branch))
+
+        hits = self.gd.cache_stats()["blobs"]["hits"]
+        self.assertEqual('{"foo":"one"}', self.gd.fetch_study(9995, branch))
+        self.assertEqual(hits + 1, self.gd.cache_stats()["blobs"]["hits"], "second read is a cache hit")
+
+        # a write invalidates the cached path
+        self.gd.write_study(9995,'{"foo":"two"}',branch,author)
+        self.assertEqual('{"foo":"two"}', self.gd.fetch_study(9995, branch))
+
+        # and so does moving the branch behind our back
+        git("update-ref", "refs/heads/%s" % branch, "%s^" % branch)
+        self.assertEqual('{"foo":"one"}', self.gd.fetch_study(9995, branch))
+
+    def test_study_sha(self):
+        study_id = 438
+        sha = self.gd.study_sha(study_id, "master")
+        self.assertEqual(sha, git("hash-object", "study/%s/%s.json" % (study_id, study_id)).strip())
+        self.assertEqual(self.gd.fetch_study(study_id, "master"), self.gd.read_study_sha(study_id, sha))
+        self.assertEqual(None, self.gd.study_sha(9999999, "master"))
+
+    def test_fetch_studies(self):
+        studies = list(self.gd.fetch_studies([438, 9999999, 10], "master"))
+        self.assertEqual([ s[0] for s in studies ], [438, 9999999, 10], "studies are returned in order")
+        self.assertEqual(studies[0][2], self.gd.fetch_study(438, "master"))
+        self.assertEqual(studies[1], (9999999, None, None), "a missing study does not fail the batch")
+        self.assertEqual(studies[2][1], self.gd.study_sha(10, "master"))
+
+        studies = list(self.gd.fetch_studies([438], "nothisdoesnotexist"))
+        self.assertEqual(studies, [(438, None, None)])
+
+    def test_stream_study_sha(self):
+        def cleanup_stream():
+            git.branch("-D","johndoe_study_9994")
+
+        self.addCleanup(cleanup_stream)
+
+        content  = '{"foo": "%s"}' % ("x" * 100000)
+        self.gd.write_study(9994,content,"johndoe_study_9994","John Doe <john@doe.com>")
+        sha = self.gd.study_sha(9994, "johndoe_study_9994")
+        self.assertEqual(len(content), self.gd.study_size(9994, sha))
+
+        self.gd.stream_chunk_size = 4096
+        chunks = list(self.gd.stream_study_sha(9994, sha))
+        self.assertEqual(content, "".join(chunks))
+        self.assertEqual(len(chunks[0]), 4096, "streamed in fixed-size chunks")
+        self.assertFalse(sha in self.gd.blob_cache, "streamed blobs are not cached")
+
+        # and compressed as they are streamed, for clients taking gzip
+        compressed = "".join(self.gd.stream_study_sha_gzipped(9994, sha))
+        self.assertEqual(content, gzip.GzipFile(mode='rb', fileobj=StringIO(compressed)).read())
+        self.assertFalse(sha in self.gd.blob_cache, "nor are gzip-streamed blobs")
+        self.assertFalse(sha in self.gd.gzip_cache, "or their compressed content")
+
+        # cached blobs are streamed from memory
+        self.gd.read_blob_sha(sha)
+        self.assertEqual(content, "".join(self.gd.stream_study_sha(9994, sha)))
+
+    def test_read_study_sha_gzipped(self):
+        sha = self.gd.study_sha(438, "master")
+        compressed = self.gd.read_study_sha_gzipped(438, sha)
+        uncompressed = gzip.GzipFile(mode='rb', fileobj=StringIO(compressed)).read()
+        self.assertEqual(self.gd.read_study_sha(438, sha), uncompressed)
+
+        hits = self.gd.cache_stats()["gzip"]["hits"]
+        self.assertEqual(compressed, self.gd.read_study_sha_gzipped(438, sha))
+        self.assertEqual(hits + 1, self.gd.cache_stats()["gzip"]["hits"], "compressed once, then cached")
+
+    def test_sharded_write(self):
+        def cleanup_sharded_write():
+            git.branch("-D","johndoe_study_9993")
+
+        self.addCleanup(cleanup_sharded_write)
+
+        author   = "John Doe <john@doe.com>"
+        branch   = "johndoe_study_9993"
+        elements = [ '{\n"@id": "otu%d", \n"^ot:originalLabel": "%s"\n}' % (i, "x" * 200) for i in range(2000) ]
+        content  = '{\n"otu": [\n' + ', \n'.join(elements) + '\n]\n}'
+
+        self.gd.shard_threshold = 100000
+        self.gd.shard_size      = 50000
+        self.gd.write_study(9993,content,branch,author)
+
+        files = git("ls-tree", "--name-only", "%s:study/9993" % branch).split()
+        self.assertTrue(len(files) > 2, "study was sharded into %s" % files)
+        self.assertFalse("9993.json" in files)
+        self.assertEqual(content, self.gd.fetch_study(9993, branch), "shards are put back together")
+        self.assertEqual(len(content), self.gd.study_size(9993, self.gd.study_sha(9993, branch)))
+
+        # a small edit only changes the shard it is in
+        old_blobs = set(git("ls-tree", "%s:study/9993" % branch).split())
+        content   = content.replace('"otu1000"', '"otu1000a"')
+        self.gd.write_study(9993,content,branch,author)
+        new_blobs = set(git("ls-tree", "%s:study/9993" % branch).split())
+        self.assertEqual(content, self.gd.fetch_study(9993, branch))
+        self.assertTrue(len(new_blobs - old_blobs) <= 3, "only the edited shard changed")
+
+        # and a study which shrinks goes back to a single file
+        self.gd.shard_threshold = 50 * 1024 * 1024
+        self.gd.write_study(9993,'{"foo":"bar"}',branch,author)
+        files = git("ls-tree", "--name-only", "%s:study/9993" % branch).split()
+        self.assertEqual(files, ["9993.json"])
+
+    def test_sharded_rewrite(self):
+        def cleanup_sharded_rewrite():
+            self.gd.shard_threshold = 50 * 1024 * 1024
+            git.checkout("master")
+            for b in ("sharded_base", "dave_study_9994"):
+                if self.gd.branch_exists(b):
+                    git.branch("-D", b)
+
+        self.addCleanup(cleanup_sharded_rewrite)
+
+        author   = "Dave <dave@example.com>"
+        elements = [ '{\n"@id": "otu%d", \n"^ot:originalLabel": "%s"\n}' % (i, "x" * 20) for i in range(50) ]
+        content  = '{\n"otu": [\n' + ', \n'.join(elements) + '\n]\n}'
+
+        # a sharded study which is on the checked out branch, like a
+        # big study once it was merged to master
+        self.gd.shard_threshold = 200
+        self.gd.shard_size      = 500
+        self.gd.write_study(9994, content, "sharded_base", author)
+        git.checkout("sharded_base")
+        git.branch("dave_study_9994", "sharded_base")
+
+        # edited more than once on a WIP branch
+        for i in range(2):
+            content = content.replace('"otu%d"' % i, '"otu%da"' % i)
+            sha = self.gd.write_study(9994, content, "dave_study_9994", author)
+            self.assertEqual(sha, self.gd.branch_sha("dave_study_9994"))
+            self.assertEqual(content, self.gd.fetch_study(9994, "dave_study_9994"), "edit %d was written" % i)
+
     def test_write(self):
         def cleanup_write():
             git.checkout("master")
@@ -128,7 +616,12 @@ class TestGitData(unittest.TestCase):
         new_sha  = self.gd.write_study(study_id,content,branch,author)
         self.assertTrue( new_sha != "", "new_sha is non-empty")
         self.assertEqual(len(new_sha), 40, "SHA is 40 chars")
-        self.assertEqual( content, self.gd.fetch_study(9999), "correct content found via fetch_study")
+        self.assertEqual( content, self.gd.fetch_study(9999, branch), "correct content found via fetch_study")
+        self.assertEqual( "master", self.gd.current_branch(), "write_study does not check out the branch")
+        self.assertFalse( os.path.exists("%s/study/9999" % self.repo), "working tree is untouched")
+
+        second_sha = self.gd.write_study(study_id,content,branch,author)
+        self.assertEqual( new_sha, second_sha, "writing the same content again is a no-op")
 
         author   = "John Doe <john@doe.com>"
         content  = '{"foo2":"bar2"}'
@@ -142,10 +635,40 @@ class TestGitData(unittest.TestCase):
 
         self.assertEqual(master_sha1, merge_base_sha1, "Verify that writing new study branches from master and not the current branch")
 
+    def test_commit_changes(self):
+        author = "John Doe <john@doe.com>"
+        branch = "johndoe_study_9931"
+        def cleanup_commit_changes():
+            if self.gd.branch_exists(branch):
+                git.branch("-D", branch)
+        self.addCleanup(cleanup_commit_changes)
+
+        sha = self.gd.commit_changes(branch, { "study/9931/9931.json": "{}", "study/9931/extra/x.json": "[]" },
+            author, "Add study 9931")
+        self.assertEqual( "[]", git("cat-file", "blob", "%s:study/9931/extra/x.json" % sha).stdout )
+        self.assertEqual( git("rev-parse", "master:study/438").strip(), git("rev-parse", "%s:study/438" % sha).strip(),
+            "untouched trees are kept as they are" )
+
+        # removals are made first, so new content matching them stays
+        sha = self.gd.commit_changes(branch, { "study/9931/extra": None, "study/9931/9931.json": None,
+            "study/9931/9931-*.json": None, "study/9931/9931-0.json": "{", "study/9931/9931-1.json": "}" },
+            author, "Shard study 9931")
+        self.assertEqual( [ "9931-0.json", "9931-1.json" ], git("ls-tree", "--name-only", "%s:study/9931" % sha).split() )
+        self.assertEqual( "", git("fsck", "--no-dangling", "--no-progress").stdout, "the trees are well-formed" )
+
+        # a study whose files are all removed is gone, trees and all
+        sha = self.gd.commit_changes(branch, { "study/9931/9931-*.json": None }, author, "Remove study 9931")
+        self.assertEqual( git("rev-parse", "master:study").strip(), git("rev-parse", "%s:study" % sha).strip() )
+
+        self.assertRaises( ValueError, self.gd.commit_changes, "johndoe_study_9932", { "study/9932/9932.json": "{}" },
+            author, "No base", base_branch="no_such_branch" )
+
     def test_remove(self):
         def cleanup_remove():
             git.checkout("master")
             git.branch("-D","johndoe_study_777")
+            if self.gd.branch_exists("johndoe_study_438"):
+                git.branch("-D","johndoe_study_438")
 
         self.addCleanup(cleanup_remove)
 
@@ -158,10 +681,262 @@ class TestGitData(unittest.TestCase):
         self.assertTrue( new_sha != "", "new_sha is non-empty")
         self.assertEqual(len(new_sha), 40, "SHA is 40 chars")
 
-        deleted_study_dir = "%s/study/%s" % (self.repo, study_id)
-        self.assertFalse( os.path.exists(deleted_study_dir), "%s should no longer exist" % deleted_study_dir )
+        self.assertEqual( '', self.gd.fetch_study(study_id, branch), "study %s should no longer exist on %s" % (study_id, branch) )
+        self.assertNotEqual( '', self.gd.fetch_study(study_id, "master"), "study %s still exists on master" % study_id )
+
+        self.assertEqual( new_sha, self.gd.remove_study(study_id, branch, author), "removing it again returns the same SHA")
+
+        # a study which was edited on the branch, and so differs from
+        # the one on the checked out master, can be removed too
+        self.gd.write_study(438, '{"foo2":"bar4"}', "johndoe_study_438", author)
+        new_sha = self.gd.remove_study(438, "johndoe_study_438", author)
+        self.assertEqual( new_sha, self.gd.branch_sha("johndoe_study_438") )
+        self.assertEqual( '', self.gd.fetch_study(438, "johndoe_study_438"), "edited study was removed" )
+        self.assertNotEqual( '', self.gd.fetch_study(438, "master"), "study 438 still exists on master" )
 
 
+    def test_pull(self):
+        remote_dir = tempfile.mkdtemp()
+        def cleanup_pull():
+            git.checkout("master")
+            git.remote("rm", "test_remote")
+            if self.gd.branch_exists("johndoe_study_9996"):
+                git.branch("-D", "johndoe_study_9996")
+            shutil.rmtree(remote_dir)
+
+        self.addCleanup(cleanup_pull)
+
+        # a bare clone sharing our objects stands in for Github
+        git.clone("--bare", "--shared", "--quiet", self.repo, remote_dir)
+        git.remote("add", "test_remote", remote_dir)
+
+        author   = "John Doe <john@doe.com>"
+        branch   = "johndoe_study_9996"
+        sha      = self.gd.write_study(9996,'{"foo":"remote"}',branch,author)
+        self.gd.push("test_remote", branch=branch)
+        git("update-ref", "-d", "refs/heads/%s" % branch)
+
+        # the branch does not exist locally, so it is created
+        self.assertEqual( sha, self.gd.pull("test_remote", branch=branch) )
+        self.assertEqual( sha, self.gd.branch_sha(branch) )
+        self.assertEqual( "master", self.gd.current_branch(), "pull does not check out the branch")
+
+        # a fast-forward
+        git("update-ref", "refs/heads/%s" % branch, "master")
+        self.assertEqual( sha, self.gd.pull("test_remote", branch=branch) )
+
+        # the local and remote branches have diverged, so they are merged
+        local_sha  = self.gd.write_study(9997,'{"foo":"local"}',branch,author)
+        tree       = git("rev-parse", "%s^{tree}" % sha).strip()
+        remote_sha = git("commit-tree", tree, "-p", sha, "-m", "elsewhere").strip()
+        git("--git-dir=%s" % remote_dir, "update-ref", "refs/heads/%s" % branch, remote_sha)
+        merged_sha = self.gd.pull("test_remote", branch=branch)
+        self.assertEqual( merged_sha, self.gd.branch_sha(branch) )
+        self.assertEqual( [ local_sha, remote_sha ], git("rev-parse", "%s^1" % merged_sha, "%s^2" % merged_sha).split() )
+        self.assertEqual( "master", self.gd.current_branch(), "pull does not check out the branch")
+        self.gd.push("test_remote", branch=branch)
+
+        # and a queued push
+        new_sha = self.gd.write_study(9996,'{"foo":"queued"}',branch,author)
+        self.gd.push_queue.enqueue("test_remote", branch, new_sha)
+        self.gd.push_queue.process()
+        self.assertEqual( "pushed", self.gd.push_status(new_sha)["status"] )
+        self.assertEqual( new_sha, git("--git-dir=%s" % remote_dir, "rev-parse", branch).strip() )
+
+        # update one branch and delete another in a single, atomic push
+        self.assertTrue( self.gd.remote_branch_known("test_remote", branch) )
+        git("update-ref", "refs/heads/johndoe_study_9996_b", branch)
+        self.gd.push("test_remote", branch=["johndoe_study_9996_b", ":%s" % branch], atomic=True)
+        remote_branches = git("--git-dir=%s" % remote_dir, "for-each-ref", "--format=%(refname:short)")
+        self.assertTrue( "johndoe_study_9996_b" in remote_branches )
+        self.assertFalse( "%s\n" % branch in remote_branches )
+        self.assertFalse( self.gd.remote_branch_known("test_remote", branch) )
+        git.branch("-D", "johndoe_study_9996_b")
+
+    def test_needs_pull(self):
+        remote_dir = tempfile.mkdtemp()
+        author     = "John Doe <john@doe.com>"
+        branch     = "johndoe_study_9995"
+        def cleanup_needs_pull():
+            git.remote("rm", "test_refs_remote")
+            if self.gd.branch_exists(branch):
+                git.branch("-D", branch)
+            self.gd.remote_refs.invalidate()
+            shutil.rmtree(remote_dir)
+
+        self.addCleanup(cleanup_needs_pull)
+
+        git.clone("--bare", "--shared", "--quiet", self.repo, remote_dir)
+        git.remote("add", "test_refs_remote", remote_dir)
+        self.gd.remote_refs.invalidate()
+
+        self.assertEqual( self.gd.branch_sha("master"), self.gd.ls_remote("test_refs_remote")["master"] )
+        self.assertFalse( self.gd.needs_pull("test_refs_remote", branch), "branch is not on the remote" )
+
+        # what we push is recorded without listing the remote again
+        sha = self.gd.write_study(9995,'{"foo":"refs"}',branch,author)
+        self.gd.push("test_refs_remote", branch=branch)
+        self.assertEqual( sha, self.gd.remote_refs.get("test_refs_remote", branch) )
+        self.assertFalse( self.gd.needs_pull("test_refs_remote", branch), "remote tip is our tip" )
+        self.gd.write_study(9995,'{"foo":"ahead"}',branch,author)
+        self.assertFalse( self.gd.needs_pull("test_refs_remote", branch), "we are ahead of the remote" )
+
+        # somebody else pushes to the branch
+        tree    = git("rev-parse", "%s^{tree}" % sha).strip()
+        new_sha = git("commit-tree", tree, "-p", sha, "-m", "elsewhere").strip()
+        git("--git-dir=%s" % remote_dir, "update-ref", "refs/heads/%s" % branch, new_sha)
+        self.assertFalse( self.gd.needs_pull("test_refs_remote", branch), "remote listing is cached" )
+        self.gd.remote_refs.invalidate("test_refs_remote")
+        self.assertTrue( self.gd.needs_pull("test_refs_remote", branch) )
+
+        # deleting the branch on the remote is recorded too
+        self.gd.delete_remote_branch("test_refs_remote", branch)
+        self.assertEqual( None, self.gd.remote_refs.get("test_refs_remote", branch) )
+
+    def test_sync(self):
+        remote_dir = tempfile.mkdtemp()
+        author     = "John Doe <john@doe.com>"
+        def cleanup_sync():
+            git.remote("rm", "test_sync_remote")
+            for branch in [ "johndoe_study_9993", "johndoe_study_9994" ]:
+                if self.gd.branch_exists(branch):
+                    git.branch("-D", branch)
+            shutil.rmtree(remote_dir)
+            shutil.rmtree(self.gd.sync_dir)
+
+        self.addCleanup(cleanup_sync)
+
+        git.clone("--bare", "--shared", "--quiet", self.repo, remote_dir)
+        git.remote("add", "test_sync_remote", remote_dir)
+        self.assertEqual( None, self.gd.sync_status("test_sync_remote") )
+
+        # one branch is behind the remote, the other has local-only commits
+        behind = self.gd.write_study(9993,'{"foo":"behind"}',"johndoe_study_9993",author)
+        local  = self.gd.write_study(9994,'{"foo":"local"}',"johndoe_study_9994",author)
+        self.gd.push("test_sync_remote", branch=["johndoe_study_9993", "johndoe_study_9994"])
+        self.gd.write_study(9994,'{"foo":"local only"}',"johndoe_study_9994",author)
+        local_only = self.gd.branch_sha("johndoe_study_9994")
+        tree   = git("rev-parse", "%s^{tree}" % behind).strip()
+        ahead  = git("commit-tree", tree, "-p", behind, "-m", "elsewhere").strip()
+        git("--git-dir=%s" % remote_dir, "update-ref", "refs/heads/johndoe_study_9993", ahead)
+
+        status = self.gd.sync("test_sync_remote")
+        self.assertEqual( ahead, self.gd.branch_sha("johndoe_study_9993"), "fast-forwarded" )
+        self.assertEqual( local_only, self.gd.branch_sha("johndoe_study_9994"), "local commits are kept" )
+        self.assertEqual( [ "johndoe_study_9993" ], status["updated"] )
+        self.assertTrue( 0 <= status["age"] < 60 )
+        self.assertEqual( ahead, self.gd.remote_refs.get("test_sync_remote", "johndoe_study_9993") )
+        self.assertEqual( status["fetched"], self.gd.sync_status()["test_sync_remote"]["fetched"] )
+
+        # branches deleted on the remote are pruned, and locked branches are skipped
+        git("--git-dir=%s" % remote_dir, "update-ref", "-d", "refs/heads/johndoe_study_9994")
+        git("--git-dir=%s" % remote_dir, "update-ref", "refs/heads/johndoe_study_9993", "master")
+        git("update-ref", "refs/heads/johndoe_study_9993", "master")
+        git("--git-dir=%s" % remote_dir, "update-ref", "refs/heads/johndoe_study_9993", ahead)
+        self.gd.acquire_branch_locks("johndoe_study_9993")
+        try:
+            status = self.gd.sync("test_sync_remote")
+        finally:
+            self.gd.release_branch_locks()
+        self.assertEqual( [], status["updated"] )
+        self.assertFalse( self.gd.remote_branch_known("test_sync_remote", "johndoe_study_9994") )
+        self.assertEqual( ahead, self.gd.sync("test_sync_remote") and self.gd.branch_sha("johndoe_study_9993") )
+
+    def test_maintain(self):
+        author = "John Doe <john@doe.com>"
+        branch = "johndoe_study_9992"
+        def cleanup_maintain():
+            if self.gd.branch_exists(branch):
+                git.branch("-D", branch)
+        self.addCleanup(cleanup_maintain)
+
+        # writing locks a branch, so the repository is busy for a while
+        self.gd.acquire_branch_locks(branch)
+        self.gd.write_study(9992,'{"foo":"maintain"}',branch,author)
+        self.gd.release_branch_locks()
+        self.assertTrue( self.gd.object_counts()["loose"] > 0 )
+        self.assertFalse( self.gd.is_idle() )
+        self.assertEqual( "the repository is busy", self.gd.maintain()["skipped"] )
+
+        # even forced, maintenance waits for writers holding branch locks
+        writer = GitData(repo=self.repo)
+        writer.acquire_branch_locks(branch)
+        try:
+            self.assertEqual( "the repository is locked", self.gd.maintain(force=True)["skipped"] )
+            # and writers wait for maintenance
+            maintenance = SharedLock(self.gd.maintenance_lock_file, timeout=0)
+            writer.release_branch_locks()
+            maintenance.acquire()
+            writer.lock_timeout = 0
+            self.assertRaises( LockError, writer.acquire_branch_locks, branch )
+            maintenance.release()
+        finally:
+            writer.release_branch_locks()
+
+        report = self.gd.maintain(force=True)
+        self.assertEqual( 0, report["after"]["loose"], "loose objects were packed" )
+        self.assertTrue( "repack" in report["tasks"] and "commit-graph" in report["tasks"] )
+        self.assertTrue( os.path.exists("%s/.git/objects/info/commit-graphs/commit-graph-chain" % self.repo) )
+        self.assertTrue( os.path.exists("%s/.git/objects/pack/multi-pack-index" % self.repo) )
+        self.assertEqual( report["started"], self.gd.maintenance_status()["started"] )
+
+        # reads still work
+        self.assertEqual( '{"foo":"maintain"}', self.gd.fetch_study(9992, branch) )
+
+    def test_ssh_master(self):
+        remote_dir = tempfile.mkdtemp()
+        def cleanup_ssh():
+            git.remote("rm", "test_file_remote")
+            git.remote("rm", "test_ssh_remote")
+            git("update-ref", "-d", "refs/remotes/test_file_remote/master")
+            shutil.rmtree(remote_dir)
+
+        self.addCleanup(cleanup_ssh)
+
+        git.init("--bare", "--quiet", remote_dir)
+        git.remote("add", "test_file_remote", "file://%s" % remote_dir)
+        git.remote("add", "test_ssh_remote", "git@github.com:OpenTreeOfLife/treenexus.git")
+
+        git_sh = os.path.abspath("../bin/git.sh")
+        env    = { "GIT_SSH": git_sh, "PKEY": "/nonexistent/deploy_key" }
+
+        # file:// remotes don't use SSH, so there is no connection to share
+        self.assertFalse( self.gd.ssh_master("test_file_remote", env).is_ssh )
+        self.assertFalse( "SSH_CONTROL_PATH" in self.gd._remote_kwargs(env, "test_file_remote")["_env"] )
+        self.gd.push("test_file_remote", env, "master")
+        self.assertEqual( self.gd.branch_sha("master"), git("--git-dir=%s" % remote_dir, "rev-parse", "master").strip() )
+        self.assertEqual( self.gd.branch_sha("master"), self.gd.pull("test_file_remote", env, "master") )
+        self.assertFalse( self.gd.close_ssh_master("test_file_remote", env) )
+
+        # SSH remotes share one connection per host and deploy key
+        master = self.gd.ssh_master("test_ssh_remote", env)
+        self.assertTrue( master.is_ssh )
+        self.assertEqual( master.destination, ("git", "github.com", None) )
+        self.assertNotEqual( master.control_path, self.gd.ssh_master("test_ssh_remote", { "PKEY": "/other/key" }).control_path )
+        kwargs = self.gd._remote_kwargs(env, "test_ssh_remote")
+        self.assertEqual( kwargs["_env"]["SSH_CONTROL_PATH"], master.control_path )
+        self.assertFalse( master.check(), "no master connection was started" )
+        self.assertEqual( {}, self.gd._remote_kwargs({}, "test_ssh_remote"), "without PKEY the environment is untouched" )
+
+    def test_branch_locks(self):
+        other_gd = GitData(repo=self.repo)
+        other_gd.lock_timeout = 0.1
+
+        self.gd.acquire_branch_locks("johndoe_study_1", "master")
+        self.addCleanup(self.gd.release_branch_locks)
+
+        # a different branch can still be locked
+        other_gd.acquire_branch_locks("johndoe_study_2")
+        other_gd.release_branch_locks()
+
+        self.assertRaises(LockError, lambda: other_gd.acquire_branch_locks("johndoe_study_2", "master"))
+        self.assertEqual(other_gd.branch_locks, [], "locks are released after a failure")
+        self.assertTrue(other_gd.lock_wait >= 0.1, "lock wait time is recorded")
+
+        self.gd.release_branch_locks()
+        other_gd.acquire_branch_locks("master")
+        other_gd.release_branch_locks()
+
     def test_branch_exists(self):
         exists = self.gd.branch_exists("nothisdoesnotexist")
         self.assertTrue( exists == 0, "branch does not exist")
@@ -187,6 +962,16 @@ class TestGitData(unittest.TestCase):
         newest_id = self.gd.newest_study_id()
         self.assertGreaterEqual( newest_id, 9999 )
 
+    def test_reserve_study_ids(self):
+        first_id = self.gd.reserve_study_ids()
+        self.assertGreater( first_id, 2600 )
+
+        other_gd = GitData(repo=self.repo)
+        next_id  = other_gd.reserve_study_ids(10)
+        self.assertEqual( next_id, first_id + 1, "ids are shared between GitData objects" )
+
+        self.assertEqual( self.gd.reserve_study_ids(), next_id + 10, "a range of 10 ids was reserved" )
+
 def suite():
     loader = unittest.TestLoader()
     testsuite = loader.loadTestsFromTestCase(TestGitData)
@@ -0,0 +1,45 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+from history_index import HistoryIndex
+
+class TestHistoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir   = tempfile.mkdtemp()
+        self.index = HistoryIndex(os.path.join(self.dir, "API_HISTORY"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_missing(self):
+        self.assertEqual(self.index.current(), (None, {}))
+
+    def test_save(self):
+        self.index.save("master", "a" * 40, { "12": [ "b" * 40, "c" * 40 ] })
+        self.assertEqual(self.index.current(), ("a" * 40, { "12": [ "b" * 40, "c" * 40 ] }))
+        self.assertEqual(os.listdir(self.dir), [ "API_HISTORY" ])
+
+        # another process reads the file again when it changed
+        other = HistoryIndex(self.index.filename)
+        other.save("master", "d" * 40, {})
+        os.utime(other.filename, (0, 0))
+        self.assertEqual(self.index.current(), ("d" * 40, {}))
+
+    def test_corrupt(self):
+        open(self.index.filename, 'w').write("{")
+        self.assertEqual(self.index.current(), (None, {}))
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestHistoryIndex)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
@@ -0,0 +1,60 @@
+import unittest
+import sys
+from lrucache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = LRUCache(max_size=10)
+        self.assertEqual(cache.get("a"), None)
+        cache.put("a", "12345")
+        self.assertEqual(cache.get("a"), "12345")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["size"], 5)
+
+    def test_eviction(self):
+        cache = LRUCache(max_size=10)
+        cache.put("a", "1234")
+        cache.put("b", "1234")
+        # "a" is now the most recently used
+        cache.get("a")
+        cache.put("c", "1234")
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache, "least recently used entry was evicted")
+        self.assertTrue("c" in cache)
+        self.assertEqual(cache.size, 8)
+
+    def test_too_big(self):
+        cache = LRUCache(max_size=10)
+        cache.put("a", "12345678901")
+        self.assertFalse("a" in cache, "values bigger than the cache are not cached")
+        self.assertEqual(cache.size, 0)
+
+    def test_replace_and_pop(self):
+        cache = LRUCache(max_size=10)
+        cache.put("a", "1234")
+        cache.put("a", "123456")
+        self.assertEqual(cache.size, 6)
+        self.assertEqual(cache.pop("a"), "123456")
+        self.assertEqual(cache.pop("a"), None)
+        self.assertEqual(cache.size, 0)
+
+    def test_sizeof(self):
+        cache = LRUCache(max_size=2, sizeof=lambda value: 1)
+        cache.put("a", {})
+        cache.put("b", {})
+        cache.put("c", {})
+        self.assertEqual(len(cache), 2)
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestLRUCache)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
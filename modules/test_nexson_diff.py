@@ -0,0 +1,96 @@
+import unittest
+import sys
+import json
+import time
+from nexson_diff import diff, diff_json
+
+def study(otus=3, nodes=3):
+    "Return a small NexSON study as a dict"
+    return { "nexml": {
+        "@id": "study",
+        "meta": [ { "@property": "ot:studyId", "$": "10" }, { "@property": "ot:curatorName", "$": "leto" } ],
+        "otus": { "@id": "otus1", "otu": [ { "@id": "otu%d" % i, "@label": "Species %d" % i } for i in range(otus) ] },
+        "trees": { "@id": "trees1", "tree": [ {
+            "@id": "tree1",
+            "node": [ { "@id": "node%d" % i, "@otu": "otu%d" % (i % otus) } for i in range(nodes) ],
+            "edge": [ { "@id": "edge%d" % i, "@source": "node0", "@target": "node%d" % i } for i in range(1, nodes) ],
+        } ] },
+    } }
+
+def dumps(value):
+    return json.dumps(value, sort_keys=True, indent=0)
+
+class TestNexsonDiff(unittest.TestCase):
+    def test_same(self):
+        result = diff(study(), study())
+        self.assertEqual(result, { "added": [], "removed": [], "modified": [], "summary": {} })
+
+    def test_changes(self):
+        old = study()
+        new = study()
+        new["nexml"]["otus"]["otu"][1]["@label"] = "Homo sapiens"
+        new["nexml"]["trees"]["tree"][0]["node"].append({ "@id": "node9", "@otu": "otu2" })
+        del new["nexml"]["trees"]["tree"][0]["edge"][0]
+        new["nexml"]["meta"][1]["$"] = "jessica"
+        new["nexml"]["otus"]["otu"].reverse()
+
+        result = diff(old, new)
+        self.assertEqual(result["added"], [ { "type": "node", "id": "node9", "parent": "tree1" } ])
+        self.assertEqual(result["removed"], [ { "type": "edge", "id": "edge1", "parent": "tree1" } ])
+        self.assertEqual(result["modified"], [
+            { "type": "otu", "id": "otu1", "parent": "otus1", "fields": [ "@label" ] },
+            { "type": "meta", "id": "ot:curatorName", "parent": "study", "fields": [ "$" ] },
+        ])
+        self.assertEqual(result["summary"]["node"], { "added": 1, "removed": 0, "modified": 0 })
+        self.assertEqual(sorted(result["summary"]), [ "edge", "meta", "node", "otu" ])
+
+    def test_moved(self):
+        old = study()
+        new = study()
+        new["nexml"]["trees"]["tree"].append({ "@id": "tree2",
+            "node": [ new["nexml"]["trees"]["tree"][0]["node"].pop() ] })
+        result = diff(old, new)
+        self.assertEqual(result["added"], [ { "type": "tree", "id": "tree2", "parent": "trees1" } ])
+        self.assertEqual(result["modified"], [ { "type": "node", "id": "node2", "parent": "tree2", "fields": [ "parent" ] } ])
+
+    def test_new_study(self):
+        result = diff_json("", dumps(study(otus=2, nodes=1)))
+        self.assertEqual(result["summary"]["otu"]["added"], 2)
+        self.assertEqual(result["summary"]["meta"]["added"], 2)
+        self.assertEqual(result["removed"], [])
+        result = diff_json(dumps(study()), "")
+        self.assertEqual(result["summary"]["edge"]["removed"], 2)
+        self.assertRaises(ValueError, diff_json, "{", "{}")
+
+    def test_top_level(self):
+        old = { "nexml": { "otus": { "@id": "otus1", "otu": [] } }, "@version": "0.0.0" }
+        new = { "nexml": { "otus": { "@id": "otus1", "otu": [] }, "@generator": "API" }, "@version": "1.0.0" }
+        result = diff(old, new)
+        self.assertEqual(result["modified"], [
+            { "type": "nexml", "id": "nexml", "parent": None, "fields": [ "@generator" ] },
+            { "type": "study", "id": None, "parent": None, "fields": [ "@version" ] },
+        ])
+
+    def test_linear_time(self):
+        old = study(otus=20000, nodes=100000)
+        new = study(otus=20000, nodes=100000)
+        new["nexml"]["otus"]["otu"][10]["@label"] = "changed"
+        new["nexml"]["trees"]["tree"][0]["edge"][50000]["@source"] = "node1"
+        texts = [ dumps(old), dumps(new) ]
+        started = time.time()
+        result = diff_json(*texts)
+        self.assertEqual([ change["id"] for change in result["modified"] ], [ "otu10", "edge50001" ])
+        self.assertTrue(time.time() - started < 5, "%d bytes diffed in %.1fs" % (len(texts[0]), time.time() - started))
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestNexsonDiff)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
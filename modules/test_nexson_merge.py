@@ -0,0 +1,127 @@
+import unittest
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+from nexson_merge import merge_json, main
+
+def study(otus=3, nodes=3):
+    "Return a small NexSON study as a dict"
+    return { "nexml": {
+        "@id": "study",
+        "meta": [ { "@property": "ot:studyId", "$": "10" }, { "@property": "ot:curatorName", "$": "leto" } ],
+        "otus": { "@id": "otus1", "otu": [ { "@id": "otu%d" % i, "@label": "Species %d" % i } for i in range(otus) ] },
+        "trees": { "@id": "trees1", "tree": [ {
+            "@id": "tree1",
+            "node": [ { "@id": "node%d" % i, "@otu": "otu%d" % (i % otus) } for i in range(nodes) ],
+            "edge": [ { "@id": "edge%d" % i, "@source": "node0", "@target": "node%d" % i } for i in range(1, nodes) ],
+        } ] },
+    } }
+
+def dumps(value):
+    return json.dumps(value, sort_keys=True, indent=0)
+
+class TestNexsonMerge(unittest.TestCase):
+    def test_different_elements(self):
+        base   = study()
+        ours   = study()
+        theirs = study()
+        ours["nexml"]["otus"]["otu"][0]["@label"]   = "Homo sapiens"
+        theirs["nexml"]["otus"]["otu"][1]["@label"] = "Pan troglodytes"
+        theirs["nexml"]["trees"]["tree"][0]["node"].append({ "@id": "node9", "@otu": "otu2" })
+        del ours["nexml"]["trees"]["tree"][0]["edge"][0]
+
+        merged, conflicts = merge_json(dumps(base), dumps(ours), dumps(theirs))
+        self.assertEqual(conflicts, [])
+        merged = json.loads(merged)
+        self.assertEqual([ otu["@label"] for otu in merged["nexml"]["otus"]["otu"] ],
+            [ "Homo sapiens", "Pan troglodytes", "Species 2" ])
+        tree = merged["nexml"]["trees"]["tree"][0]
+        self.assertEqual([ node["@id"] for node in tree["node"] ], [ "node0", "node1", "node2", "node9" ])
+        self.assertEqual([ edge["@id"] for edge in tree["edge"] ], [ "edge2" ])
+
+    def test_reordered_elements(self):
+        base   = study()
+        ours   = study()
+        theirs = study()
+        ours["nexml"]["otus"]["otu"].reverse()
+        theirs["nexml"]["otus"]["otu"][0]["@label"] = "Homo sapiens"
+        merged, conflicts = merge_json(dumps(base), dumps(ours), dumps(theirs))
+        self.assertEqual(conflicts, [])
+        self.assertEqual(json.loads(merged)["nexml"]["otus"]["otu"][2], { "@id": "otu0", "@label": "Homo sapiens" })
+
+    def test_conflicts(self):
+        base   = study()
+        ours   = study()
+        theirs = study()
+        ours["nexml"]["otus"]["otu"][0]["@label"]   = "Homo sapiens"
+        theirs["nexml"]["otus"]["otu"][0]["@label"] = "Homo neanderthalensis"
+        ours["nexml"]["meta"][1]["$"]   = "jim"
+        theirs["nexml"]["meta"][1]["$"] = "karen"
+        # changed on one side, deleted on the other
+        ours["nexml"]["trees"]["tree"][0]["node"][2]["@label"] = "root"
+        del theirs["nexml"]["trees"]["tree"][0]["node"][2]
+
+        merged, conflicts = merge_json(dumps(base), dumps(ours), dumps(theirs))
+        self.assertEqual(sorted(conflicts), [
+            "nexml/meta[@property=ot:curatorName]/$",
+            "nexml/otus/otu[@id=otu0]/@label",
+            "nexml/trees/tree[@id=tree1]/node[@id=node2]",
+        ])
+        self.assertEqual(json.loads(merged)["nexml"]["otus"]["otu"][0]["@label"], "Homo sapiens", "ours is kept")
+
+    def test_same_change(self):
+        base = study()
+        ours = study()
+        ours["nexml"]["otus"]["otu"][0]["@label"] = "Homo sapiens"
+        merged, conflicts = merge_json(dumps(base), dumps(ours), dumps(ours))
+        self.assertEqual((merged, conflicts), (dumps(ours), []))
+
+    def test_linear_time(self):
+        base   = study(otus=20000, nodes=40000)
+        ours   = study(otus=20000, nodes=40000)
+        theirs = study(otus=20000, nodes=40000)
+        ours["nexml"]["otus"]["otu"][10]["@label"]    = "ours"
+        theirs["nexml"]["otus"]["otu"][19990]["@label"] = "theirs"
+        texts = [ dumps(base), dumps(ours), dumps(theirs) ]
+        started = time.time()
+        merged, conflicts = merge_json(*texts)
+        self.assertEqual(conflicts, [])
+        self.assertTrue(time.time() - started < 10, "%d bytes merged in %.1fs" % (len(texts[0]), time.time() - started))
+
+    def test_driver(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        def write(name, content):
+            open(os.path.join(dir, name), 'w').write(content)
+            return os.path.join(dir, name)
+
+        base   = study()
+        ours   = study()
+        theirs = study()
+        theirs["nexml"]["otus"]["otu"][1]["@label"] = "Pan troglodytes"
+        files = [ write("base", dumps(base)), write("ours", dumps(ours)), write("theirs", dumps(theirs)) ]
+        self.assertEqual(main(files + [ "study/10/10.json" ]), 0)
+        self.assertEqual(open(files[1]).read(), dumps(theirs))
+
+        # not JSON, like a shard of a big study: a line-based merge
+        files = [ write("base", "a,\nb,\nc,\n"), write("ours", "A,\nb,\nc,\n"), write("theirs", "a,\nb,\nC,\n") ]
+        self.assertEqual(main(files), 0)
+        self.assertEqual(open(files[1]).read(), "A,\nb,\nC,\n")
+        files = [ write("base", "a,\n"), write("ours", "A,\n"), write("theirs", "B,\n") ]
+        self.assertEqual(main(files), 1)
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestNexsonMerge)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
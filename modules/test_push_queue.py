@@ -0,0 +1,146 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import logging
+from push_queue import PushQueue
+
+class TestPushQueue(unittest.TestCase):
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        os.mkdir("%s/.git" % self.repo)
+        self.addCleanup(shutil.rmtree, self.repo)
+
+        self.pushes = []
+        self.fail   = False
+        def push(remote, env, branch):
+            if self.fail:
+                raise Exception("Could not push")
+            self.pushes.append((remote, branch))
+        self.queue = PushQueue(self.repo, push)
+
+    def test_coalesce(self):
+        self.queue.enqueue("origin", "leto_study_12", "a" * 40)
+        self.queue.enqueue("origin", "leto_study_12", "b" * 40)
+        self.queue.enqueue("origin", "leto_study_13", "c" * 40)
+        self.assertEqual(self.queue.status("a" * 40)["status"], "pending")
+        self.assertEqual(self.queue.pending(), {
+            "leto_study_12": [ "a" * 40, "b" * 40 ],
+            "leto_study_13": [ "c" * 40 ],
+        })
+
+        self.assertEqual(self.queue.process(), 2)
+        self.assertEqual(self.pushes, [ ("origin", [ "leto_study_12", "leto_study_13" ]) ],
+            "one push for all branches")
+        for sha in [ "a" * 40, "b" * 40, "c" * 40 ]:
+            self.assertEqual(self.queue.status(sha)["status"], "pushed")
+        self.assertEqual(self.queue.pending(), {})
+
+        self.assertEqual(self.queue.process(), 0, "nothing left to push")
+
+    def test_failure(self):
+        self.queue.enqueue("origin", "leto_study_12", "a" * 40)
+        self.fail = True
+        self.assertEqual(self.queue.process(), 0)
+        self.assertEqual(self.queue.status("a" * 40)["status"], "failed")
+        self.assertEqual(self.queue.status("a" * 40)["description"], "Could not push")
+
+        # failed pushes are retried
+        self.fail = False
+        self.assertEqual(self.queue.process(), 1)
+        self.assertEqual(self.queue.status("a" * 40)["status"], "pushed")
+
+    def test_partial_failure(self):
+        def push(remote, env, branch):
+            if isinstance(branch, list) or branch == "leto_study_13":
+                raise Exception("Could not push %s" % branch)
+            self.pushes.append((remote, branch))
+        self.queue.push = push
+
+        self.queue.enqueue("origin", "leto_study_12", "a" * 40)
+        self.queue.enqueue("origin", "leto_study_13", "b" * 40)
+        self.assertEqual(self.queue.process(), 1)
+        self.assertEqual(self.queue.status("a" * 40)["status"], "pushed")
+        self.assertEqual(self.queue.status("b" * 40)["status"], "failed")
+        self.assertEqual(self.queue.pending(), { "leto_study_13": [ "b" * 40 ] })
+
+    def test_discard(self):
+        self.queue.enqueue("origin", "leto_study_12", "a" * 40)
+        self.queue.discard("leto_study_12", "pushed", "Pushed as part of master")
+        self.assertEqual(self.queue.process(), 0)
+        self.assertEqual(self.pushes, [])
+        self.assertEqual(self.queue.status("a" * 40)["description"], "Pushed as part of master")
+
+    def test_missing_branch(self):
+        branches = [ "leto_study_12" ]
+        self.queue.branch_exists = lambda branch: branch in branches
+
+        self.queue.enqueue("origin", "leto_study_12", "a" * 40)
+        self.queue.enqueue("origin", "leto_study_13", "b" * 40)
+        self.assertEqual(self.queue.process(), 1)
+        self.assertEqual(self.pushes, [ ("origin", [ "leto_study_12" ]) ], "a deleted branch is not pushed")
+        self.assertEqual(self.queue.status("b" * 40)["status"], "dropped")
+        self.assertEqual(self.queue.status("b" * 40)["description"], "Branch leto_study_13 no longer exists")
+        self.assertEqual(self.queue.pending(), {}, "nor retried")
+
+    def test_unknown(self):
+        self.assertEqual(self.queue.status("d" * 40), None)
+
+    def test_worker(self):
+        self.queue.start_worker()
+        self.queue.enqueue("origin", "leto_study_12", "a" * 40)
+        for i in range(100):
+            if self.pushes:
+                break
+            self.queue.worker.join(0.05)
+        self.assertEqual(self.pushes, [ ("origin", [ "leto_study_12" ]) ], "the worker pushed the branch")
+
+    def test_resume(self):
+        # a worker was started with env, and the process went away
+        # before it pushed
+        self.queue._save_env({ "PKEY": "/srv/key" })
+        self.queue.enqueue("origin", "leto_study_12", "a" * 40)
+
+        # after a restart, the pushes left in the queue are picked up
+        # without waiting for the next enqueue, with the saved env
+        pushes = []
+        queue  = PushQueue(self.repo, lambda remote, env, branch: pushes.append((remote, env, branch)))
+        for i in range(100):
+            if pushes:
+                break
+            queue.worker.join(0.05)
+        self.assertEqual(pushes[:1], [ ("origin", { "PKEY": "/srv/key" }, [ "leto_study_12" ]) ])
+
+    def test_worker_errors(self):
+        errors = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                errors.append(record.getMessage())
+        handler = Handler()
+        logging.getLogger().addHandler(handler)
+        self.addCleanup(logging.getLogger().removeHandler, handler)
+
+        def process(env):
+            raise IOError("disk full")
+        self.queue.process = process
+        self.queue.start_worker()
+        self.queue.wakeup.set()
+        for i in range(100):
+            if errors:
+                break
+            self.queue.worker.join(0.05)
+        self.assertEqual(errors[:1], [ "Pushing the queued branches of %s failed" % self.repo ])
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestPushQueue)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
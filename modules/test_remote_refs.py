@@ -0,0 +1,64 @@
+import unittest
+import sys
+from remote_refs import RemoteRefs
+
+class TestRemoteRefs(unittest.TestCase):
+    def setUp(self):
+        self.listings = []
+        def ls_remote(remote, env):
+            self.listings.append(remote)
+            return { "master": "a" * 40, "leto_study_12": "b" * 40 }
+        self.refs = RemoteRefs(ls_remote, ttl=30)
+
+    def test_get(self):
+        self.assertEqual(self.refs.get("origin", "master"), "a" * 40)
+        self.assertEqual(self.refs.get("origin", "leto_study_12"), "b" * 40)
+        self.assertEqual(self.refs.get("origin", "leto_study_13"), None)
+        self.assertEqual(self.listings, ["origin"], "remote is listed once")
+        self.refs.get("upstream", "master")
+        self.assertEqual(self.listings, ["origin", "upstream"])
+
+    def test_ttl(self):
+        self.refs.get("origin", "master")
+        self.refs.ttl = -1
+        self.refs.get("origin", "master")
+        self.assertEqual(self.listings, ["origin", "origin"], "listing expired")
+
+    def test_update(self):
+        # nothing is known about a remote which was never listed
+        self.refs.update("origin", "leto_study_13", "c" * 40)
+        self.assertEqual(self.listings, [])
+
+        self.refs.get("origin", "master")
+        self.refs.update("origin", "leto_study_13", "c" * 40)
+        self.refs.update("origin", "leto_study_12", None)
+        self.assertEqual(self.refs.branches("origin"), { "master": "a" * 40, "leto_study_13": "c" * 40 })
+        self.assertEqual(self.listings, ["origin"])
+
+    def test_put(self):
+        self.refs.put("origin", { "master": "c" * 40 })
+        self.assertEqual(self.refs.get("origin", "master"), "c" * 40)
+        self.assertEqual(self.refs.get("origin", "leto_study_12"), None)
+        self.assertEqual(self.listings, [], "a complete listing needs no ls-remote")
+
+    def test_invalidate(self):
+        self.refs.get("origin", "master")
+        self.refs.update("origin", "leto_study_12", None)
+        self.refs.invalidate("origin")
+        self.assertEqual(self.refs.get("origin", "leto_study_12"), "b" * 40)
+        self.refs.invalidate()
+        self.refs.get("origin", "master")
+        self.assertEqual(self.listings, ["origin", "origin", "origin"])
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestRemoteRefs)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
@@ -0,0 +1,51 @@
+import unittest
+import sys
+import shutil
+import tempfile
+from locket import LockError
+from shared_lock import SharedLock
+
+class TestSharedLock(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.filename = "%s/lock" % self.dir
+
+    def lock(self, shared):
+        lock = SharedLock(self.filename, shared=shared, timeout=0)
+        lock.acquire()
+        self.addCleanup(lock.release)
+        return lock
+
+    def test_shared(self):
+        self.lock(True)
+        self.lock(True)
+        self.assertRaises(LockError, SharedLock(self.filename, timeout=0).acquire)
+
+    def test_exclusive(self):
+        lock = self.lock(False)
+        self.assertRaises(LockError, SharedLock(self.filename, shared=True, timeout=0).acquire)
+        self.assertRaises(LockError, SharedLock(self.filename, timeout=0).acquire)
+
+        lock.release()
+        self.lock(True)
+
+    def test_timeout(self):
+        self.lock(True)
+        lock = SharedLock(self.filename, timeout=0.2)
+        lock.retry_period = 0.05
+        self.assertRaises(LockError, lock.acquire)
+        self.assertEqual(lock.file, None, "nothing is left open")
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestSharedLock)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
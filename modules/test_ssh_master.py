@@ -0,0 +1,82 @@
+import unittest
+import sys
+import os
+import shutil
+import socket
+import tempfile
+import subprocess
+from ssh_master import SSHMaster, ssh_destination
+
+class TestSSHMaster(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_ssh_destination(self):
+        self.assertEqual(ssh_destination("git@github.com:OpenTreeOfLife/treenexus.git"), ("git", "github.com", None))
+        self.assertEqual(ssh_destination("github.com:treenexus.git"), (None, "github.com", None))
+        self.assertEqual(ssh_destination("ssh://git@github.com/OpenTreeOfLife/treenexus.git"), ("git", "github.com", None))
+        self.assertEqual(ssh_destination("ssh://git@example.org:2222/treenexus.git"), ("git", "example.org", 2222))
+        self.assertEqual(ssh_destination("file:///home/user/treenexus.git"), None)
+        self.assertEqual(ssh_destination("https://github.com/OpenTreeOfLife/treenexus.git"), None)
+        self.assertEqual(ssh_destination("/home/user/treenexus.git"), None)
+        self.assertEqual(ssh_destination("../treenexus"), None)
+
+    def test_control_path(self):
+        url    = "git@github.com:OpenTreeOfLife/treenexus.git"
+        master = SSHMaster(url, "/keys/a", control_dir=self.dir)
+        self.assertEqual(master.control_path, SSHMaster(url, "/keys/a", control_dir=self.dir).control_path)
+        self.assertNotEqual(master.control_path, SSHMaster(url, "/keys/b", control_dir=self.dir).control_path)
+        self.assertNotEqual(master.control_path, SSHMaster("git@example.org:t.git", "/keys/a", control_dir=self.dir).control_path)
+        self.assertTrue(len(master.control_path) < 100, "fits in a unix socket path")
+        self.assertEqual(SSHMaster("file:///tmp/t.git", "/keys/a").control_path, None)
+
+    def test_stale_socket(self):
+        control_dir = os.path.join(self.dir, "sockets")
+        master = SSHMaster("git@github.com:OpenTreeOfLife/treenexus.git", "/keys/a", control_dir=control_dir)
+        self.assertEqual(master.prepare(), master.control_path)
+        self.assertEqual(os.stat(control_dir).st_mode & 0777, 0700)
+
+        # a socket nobody listens on, as left behind by a master which died
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(master.control_path)
+        sock.close()
+        self.assertTrue(os.path.exists(master.control_path))
+        self.assertFalse(master.check())
+        self.assertFalse(master.stop())
+
+        master.prepare()
+        self.assertFalse(os.path.exists(master.control_path), "stale socket was removed")
+
+    def test_git_sh(self):
+        # a fake ssh which shows how bin/git.sh runs it
+        fake_ssh = os.path.join(self.dir, "ssh")
+        file = open(fake_ssh, 'w')
+        file.write('#!/bin/sh\necho "$@"\n')
+        file.close()
+        os.chmod(fake_ssh, 0755)
+
+        git_sh = os.path.abspath("../bin/git.sh")
+        env = dict(os.environ, PATH="%s:%s" % (self.dir, os.environ["PATH"]), PKEY="/keys/a")
+        env.pop("SSH_CONTROL_PATH", None)
+        args = subprocess.Popen([git_sh, "git@github.com", "git-upload-pack"], stdout=subprocess.PIPE, env=env).communicate()[0]
+        self.assertFalse("ControlPath" in args)
+        self.assertTrue("-i /keys/a" in args)
+
+        env["SSH_CONTROL_PATH"] = "/tmp/socket"
+        args = subprocess.Popen([git_sh, "git@github.com", "git-upload-pack"], stdout=subprocess.PIPE, env=env).communicate()[0]
+        self.assertTrue("-oControlMaster=auto -oControlPath=/tmp/socket -oControlPersist=300" in args)
+        self.assertTrue(args.strip().endswith("git@github.com git-upload-pack"))
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestSSHMaster)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
@@ -0,0 +1,53 @@
+import unittest
+import sys
+import json
+from study_shards import split_study, sort_shards
+
+def nexson(count, label="x"):
+    otus = [ { "@id": "otu%d" % i, "^ot:originalLabel": label * 100 } for i in range(count) ]
+    return json.dumps({ "nexml": { "otus": { "otu": otus } } }, sort_keys=True, indent=0)
+
+class TestStudyShards(unittest.TestCase):
+    def test_small(self):
+        content = nexson(10)
+        self.assertEqual(split_study(content, shard_size=len(content)), [ content ])
+
+    def test_split(self):
+        content = nexson(5000)
+        shards  = split_study(content, shard_size=20000)
+        self.assertTrue(len(shards) > 5)
+        self.assertEqual("".join(shards), content, "shards put back together are the study")
+        for shard in shards[:-1]:
+            self.assertTrue(shard.rstrip(" \n").endswith(","), "shards end between two elements")
+            self.assertTrue(len(shard) >= 5000)
+            self.assertTrue(len(shard) <= 40000)
+
+    def test_stable(self):
+        content = nexson(5000)
+        shards  = split_study(content, shard_size=20000)
+        edited  = content.replace('"otu2500"', '"otu2500-edited"')
+        edited_shards = split_study(edited, shard_size=20000)
+        self.assertEqual("".join(edited_shards), edited)
+        changed = set(edited_shards) - set(shards)
+        self.assertTrue(len(changed) <= 2, "only the shards around the edit changed")
+
+    def test_no_place_to_cut(self):
+        content = json.dumps({ "foo": [ "x" * 100 ] * 1000 })
+        self.assertEqual(split_study(content, shard_size=1000), [ content ])
+
+    def test_sort_shards(self):
+        filenames = [ "10-10.json", "10-9.json", "10-0.json", "10.json", "100-1.json", "README" ]
+        self.assertEqual(sort_shards(10, filenames), [ "10-0.json", "10-9.json", "10-10.json" ])
+
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(TestStudyShards)
+    return testsuite
+
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    result = runner.run(testsuite)
+
+if __name__ == "__main__":
+    test_main()
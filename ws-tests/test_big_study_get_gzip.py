@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+import sys, os
+import gzip
+import json
+import requests
+from cStringIO import StringIO
+from opentreetesting import config
+
+# a study bigger than GitData.stream_threshold (4MB)
+if len(sys.argv) > 1:
+    study_id = sys.argv[1]
+else:
+    study_id = 9
+
+DOMAIN = config('host', 'apihost')
+SUBMIT_URI = DOMAIN + '/v1/study/%s' % study_id
+STREAM_THRESHOLD = 4 * 1024 * 1024
+
+plain = requests.get(SUBMIT_URI, headers={'Accept-Encoding': 'identity'})
+if plain.status_code != 200:
+    sys.stderr.write('Expected a 200 response from %s\n' % SUBMIT_URI)
+    sys.exit(1)
+
+# requests transparently decompresses .content, so read the raw stream
+resp = requests.get(SUBMIT_URI, headers={'Accept-Encoding': 'gzip'}, stream=True)
+if resp.status_code != 200 or resp.headers.get('content-encoding') != 'gzip':
+    sys.stderr.write('Expected a gzipped response from %s\n' % SUBMIT_URI)
+    sys.exit(1)
+if len(plain.content) > STREAM_THRESHOLD and resp.headers.get('content-length'):
+    sys.stderr.write('Expected a big study to be streamed, without a Content-Length\n')
+    sys.exit(1)
+if gzip.GzipFile(mode='rb', fileobj=StringIO(resp.raw.read())).read() != plain.content:
+    sys.stderr.write('Gzipped response differs from the study\n')
+    sys.exit(1)
+sys.exit(0)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+import sys, os
+import requests
+from opentreetesting import config
+DOMAIN = config('host', 'apihost')
+SUBMIT_URI = DOMAIN + '/merge/v1/master/master/check'
+
+# master is always merged into itself
+resp = requests.get(SUBMIT_URI)
+etag = resp.headers.get('etag')
+if resp.status_code != 200 or not etag or not resp.json()['mergeable']:
+    sys.stderr.write('Expected a mergeable 200 response with an ETag from %s\n' % SUBMIT_URI)
+    sys.exit(1)
+
+resp = requests.get(SUBMIT_URI, headers={'If-None-Match': etag})
+if resp.status_code != 304:
+    sys.stderr.write('Expected a 304 response for If-None-Match: %s, got %d\n' % (etag, resp.status_code))
+    sys.exit(1)
+
+resp = requests.get(DOMAIN + '/merge/v1/no_such_branch_xyz/master/check')
+if resp.status_code != 404:
+    sys.exit(1)
+sys.exit(0)
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+import sys, os
+from opentreetesting import test_http_json_method, config
+DOMAIN = config('host', 'apihost')
+SUBMIT_URI = DOMAIN + '/v1/studies'
+data = {
+    'study_ids': ['9', 'nothisdoesnotexist'],
+}
+if test_http_json_method(SUBMIT_URI, 'POST', data=data, expected_status=200):
+    sys.exit(0)
+sys.exit(1)
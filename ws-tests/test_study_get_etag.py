@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+import sys, os
+import requests
+from opentreetesting import config
+DOMAIN = config('host', 'apihost')
+SUBMIT_URI = DOMAIN + '/v1/study/9'
+
+resp = requests.get(SUBMIT_URI)
+etag = resp.headers.get('etag')
+if resp.status_code != 200 or not etag:
+    sys.stderr.write('Expected a 200 response with an ETag from %s\n' % SUBMIT_URI)
+    sys.exit(1)
+
+# asking again for the version we already have should get a 304 with no body
+resp = requests.get(SUBMIT_URI, headers={'If-None-Match': etag})
+if resp.status_code != 304 or resp.content:
+    sys.stderr.write('Expected a 304 response for If-None-Match: %s, got %d\n' % (etag, resp.status_code))
+    sys.exit(1)
+
+resp = requests.get(SUBMIT_URI, headers={'If-None-Match': '"0000000000000000000000000000000000000000"'})
+if resp.status_code != 200:
+    sys.exit(1)
+sys.exit(0)
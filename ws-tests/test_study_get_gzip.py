@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+import sys, os
+import gzip
+import json
+import requests
+from cStringIO import StringIO
+from opentreetesting import config
+DOMAIN = config('host', 'apihost')
+SUBMIT_URI = DOMAIN + '/v1/study/9'
+
+# requests transparently decompresses .content, so read the raw stream
+resp = requests.get(SUBMIT_URI, headers={'Accept-Encoding': 'gzip'}, stream=True)
+if resp.status_code != 200 or resp.headers.get('content-encoding') != 'gzip':
+    sys.stderr.write('Expected a gzipped response from %s\n' % SUBMIT_URI)
+    sys.exit(1)
+try:
+    json.loads(gzip.GzipFile(mode='rb', fileobj=StringIO(resp.raw.read())).read())
+except:
+    sys.stderr.write('Response is not gzipped JSON\n')
+    sys.exit(1)
+sys.exit(0)